@@ -1,4 +1,4 @@
-import subprocess, time, os
+import argparse, json, queue, random, subprocess, sys, threading, time, os
 from pathlib import Path
 
 TASK_FILE = "./practice.txt"
@@ -7,54 +7,301 @@ SNAPSHOT_NAME = r"snap_2025-07-21_15-17-21"
 APP_NAME = "com.google.android.apps.maps"
 METHOD = "baseline"
 TASK_APP = "google_maps"
-# TASK_NUMBER = 
+# TASK_NUMBER =
 PAV_CLIENT_SCRIPT = "./client/client.py"
 IMAGE_BASE_PATH = f"./{METHOD}/1/{TASK_APP}"
 
 ADB_CMD = "adb"
 EMULATOR_CMD = r"C:\Users\audgj\AppData\Local\Android\Sdk\emulator\emulator.exe"
 
-def start_emulator():
-    print(f"Starting emulator {AVD_NAME}...")
-    subprocess.Popen([EMULATOR_CMD, "-avd", AVD_NAME, "-snapshot", SNAPSHOT_NAME, "-no-boot-anim", "-no-snapshot-save"])
-    print("Waiting for device...")
-    subprocess.run([ADB_CMD, "wait-for-device"], check=True)
+# 에뮬레이터 N개를 동시에 띄워 task를 나눠 실행 (포트 5554, 5556, ... → serial emulator-5554, emulator-5556, ...)
+NUM_DEVICES = 1
+BASE_PORT = 5554
+BOOT_TIMEOUT_S = 300
+# 실패한 episode는 (가능하면 다른 기기에서) 최대 MAX_RETRIES번 재시도, 연속 MAX_DEVICE_FAILURES번 실패한 기기는 제외
+MAX_RETRIES = 2
+MAX_DEVICE_FAILURES = 3
+# task 사이 초기화: snapshot (에뮬레이터는 켜 둔 채 SNAPSHOT_NAME 로드, 실패하면 cold boot) / cold (매 task마다 에뮬레이터 재시작)
+RESET_MODE = "snapshot"
+# episode를 client.py 프로세스로 띄우지 않고 EpisodeRunner로 같은 프로세스에서 실행 (HTTP / adb 연결, import 재사용)
+IN_PROCESS = True
 
-    while True:
-        result = subprocess.run([ADB_CMD, "shell", "getprop", "sys.boot_completed"],
-                                stdout=subprocess.PIPE, text=True)
-        if result.stdout.strip() == "1":
-            break
-        time.sleep(1)
-    print("Emulator booted.")
 
-def stop_emulator():
-    print("Stopping emulator...")
-    subprocess.run([ADB_CMD, "emu", "kill"])
+def load_client():
+    sys.path.insert(0, str(Path(PAV_CLIENT_SCRIPT).resolve().parent))
+    import client
+    return client
 
-def main():
-    with open(TASK_FILE, "r", encoding="utf-8") as f:
-        tasks = [line.strip() for line in f if line.strip()]
 
-    for idx, task in enumerate(tasks):
-        print(f"---- task #{idx}: {task}")
-        start_emulator()
-        time.sleep(10)
+class EmulatorDevice:
+    """
+    One emulator instance on its own console port; episodes run `client.py --serial <serial>`.
+    """
+
+    def __init__(self, index, read_only=False, in_process=IN_PROCESS):
+        self.port = BASE_PORT + 2 * index
+        self.serial = f"emulator-{self.port}"
+        # 같은 AVD를 여러 개 띄우려면 -read-only 필요
+        self.read_only = read_only
+        self.process = None
+        self.runner = load_client().EpisodeRunner(method=METHOD, app_name=TASK_APP, serial=self.serial) if in_process else None
 
-        current_image_path = Path(IMAGE_BASE_PATH) / str(idx)
-        os.makedirs(current_image_path, exist_ok=True)
+    def start(self):
+        print(f"[{self.serial}] Starting emulator {AVD_NAME}...")
+        read_only = ["-read-only"] if self.read_only else []
+        self.process = subprocess.Popen([EMULATOR_CMD, "-avd", AVD_NAME, "-port", str(self.port), "-snapshot", SNAPSHOT_NAME, "-no-boot-anim", "-no-snapshot-save"] + read_only)
+        self.wait_for_boot()
+        print(f"[{self.serial}] Emulator booted.")
 
+    def wait_for_boot(self):
+        print(f"[{self.serial}] Waiting for device...")
+        subprocess.run([ADB_CMD, "-s", self.serial, "wait-for-device"], check=True, timeout=BOOT_TIMEOUT_S)
+
+        deadline = time.time() + BOOT_TIMEOUT_S
+        while True:
+            result = subprocess.run([ADB_CMD, "-s", self.serial, "shell", "getprop", "sys.boot_completed"],
+                                    stdout=subprocess.PIPE, text=True)
+            if result.stdout.strip() == "1":
+                break
+            if time.time() > deadline:
+                raise TimeoutError(f"{self.serial} did not boot in {BOOT_TIMEOUT_S}s")
+            time.sleep(1)
+        if self.runner is not None:
+            # 재부팅 / snapshot 로드 전의 adb shell은 끊겼을 수 있음
+            self.runner.close()
+
+    def load_snapshot(self):
+        # 에뮬레이터 콘솔로 snapshot 복원: 프로세스 재시작 / 부팅 없이 task 시작 상태로 되돌림
+        result = subprocess.run([ADB_CMD, "-s", self.serial, "emu", "avd", "snapshot", "load", SNAPSHOT_NAME],
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, timeout=120)
+        if result.returncode != 0 or "KO" in result.stdout:
+            raise RuntimeError(f"snapshot load failed: {result.stdout.strip()}")
+        self.wait_for_boot()
+
+    def stop(self):
+        print(f"[{self.serial}] Stopping emulator...")
+        subprocess.run([ADB_CMD, "-s", self.serial, "emu", "kill"])
+        if self.process is not None:
+            try:
+                self.process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+            self.process = None
+
+    def run_episode(self, idx, task, image_path):
+        os.makedirs(image_path, exist_ok=True)
+        # 고정 sleep(10) 대신 client가 첫 step 전에 화면이 안정될 때까지 대기 (--initial_settle_timeout)
+        if self.runner is not None:
+            return self.runner.run(idx, task, image_path)
         subprocess.run([
             "python", PAV_CLIENT_SCRIPT,
             "--method", METHOD,
             "--task_number", str(idx),
             "--task", task,
-            "--image_path", str(current_image_path),
-            "--app_name", TASK_APP
+            "--image_path", str(image_path),
+            "--app_name", TASK_APP,
+            "--serial", self.serial,
+            "--launched_at", str(time.time()),
         ], check=True)
 
-        stop_emulator()
 
+class FakeDevice:
+    """
+    Emulator stand-in for testing the scheduler without Android: episodes sleep for
+    `episode_s` and fail with probability `failure_rate`.
+    """
+
+    def __init__(self, index, episode_s=0.5, failure_rate=0.2, seed=0):
+        self.serial = f"fake-{index}"
+        self.episode_s = episode_s
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed + index)
+
+    def start(self):
+        time.sleep(self.episode_s / 2)
+
+    def load_snapshot(self):
+        time.sleep(self.episode_s / 20)
+        if self.random.random() < self.failure_rate / 2:
+            raise RuntimeError("fake snapshot load failure")
+
+    def stop(self):
+        pass
+
+    def run_episode(self, idx, task, image_path):
+        time.sleep(self.episode_s * (0.5 + self.random.random()))
+        if self.random.random() < self.failure_rate:
+            raise RuntimeError(f"fake failure on task #{idx}")
+
+
+class DeviceHealth:
+    def __init__(self, device):
+        self.device = device
+        self.healthy = True
+        self.consecutive_failures = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.busy_s = 0.0
+        self.running = False
+        self.reset_s = []
+
+    def summary(self) -> dict:
+        return {
+            "serial": self.device.serial,
+            "healthy": self.healthy,
+            "succeeded": self.succeeded,
+            "failed": self.failed,
+            "busy_s": round(self.busy_s, 1),
+            "avg_reset_s": round(sum(self.reset_s) / len(self.reset_s), 2) if self.reset_s else None,
+        }
+
+
+def reset_device(device, running, reset_mode):
+    """
+    Brings `device` to the task start state; returns how ("snapshot" or "cold").
+    """
+    if running and reset_mode == "snapshot":
+        try:
+            device.load_snapshot()
+            return "snapshot"
+        except Exception as e:
+            print(f"[{device.serial}] {e!r}; falling back to cold boot")
+    if running:
+        device.stop()
+    device.start()
+    return "cold"
+
+
+def run_pool(tasks, devices, max_retries=MAX_RETRIES, reset_mode=RESET_MODE):
+    """
+    Runs every (idx, task) on the first free device. A failed episode goes back on the
+    queue (up to `max_retries` times); a device failing MAX_DEVICE_FAILURES episodes in a
+    row is retired. With reset_mode="snapshot" emulators stay up between tasks and are
+    reset by loading SNAPSHOT_NAME. Returns ({idx: result}, [device summaries]).
+    """
+    work = queue.Queue()
+    for idx, task in enumerate(tasks):
+        work.put((idx, task, 0))
+
+    results = {}
+    lock = threading.Lock()
+    health = [DeviceHealth(device) for device in devices]
+
+    def finish(idx, result):
+        with lock:
+            results[idx] = result
+
+    def worker(state):
+        device = state.device
+        try:
+            work_loop(state)
+        finally:
+            if state.running:
+                device.stop()
+
+    def work_loop(state):
+        device = state.device
+        while True:
+            with lock:
+                if len(results) == len(tasks):
+                    return
+                if not any(h.healthy for h in health):
+                    return
+            try:
+                idx, task, attempt = work.get(timeout=0.5)
+            except queue.Empty:
+                # 다른 기기가 실패한 task를 다시 넣을 수 있으므로 모든 task가 끝날 때까지 대기
+                continue
+
+            print(f"---- task #{idx} (attempt {attempt + 1}) on {device.serial}: {task}")
+            image_path = Path(IMAGE_BASE_PATH) / str(idx)
+            start = time.time()
+            reset = {}
+            try:
+                try:
+                    reset["reset_mode"] = reset_device(device, state.running, reset_mode)
+                    state.running = True
+                except Exception:
+                    # 반쯤 뜬 에뮬레이터가 남지 않도록 정리 후 다음 시도는 cold boot
+                    device.stop()
+                    state.running = False
+                    raise
+                reset["reset_s"] = round(time.time() - start, 2)
+                state.reset_s.append(reset["reset_s"])
+                try:
+                    episode = device.run_episode(idx, task, image_path) or {}
+                finally:
+                    if reset_mode == "cold":
+                        device.stop()
+                        state.running = False
+            except Exception as e:
+                state.busy_s += time.time() - start
+                state.failed += 1
+                state.consecutive_failures += 1
+                print(f"[{device.serial}] task #{idx} failed: {e!r}")
+                if attempt < max_retries:
+                    work.put((idx, task, attempt + 1))
+                else:
+                    finish(idx, dict({"status": "failed", "attempts": attempt + 1, "serial": device.serial, "error": repr(e)}, **reset))
+                if state.consecutive_failures >= MAX_DEVICE_FAILURES:
+                    print(f"[{device.serial}] {state.consecutive_failures} failures in a row; retiring device")
+                    with lock:
+                        state.healthy = False
+                    return
+                continue
+
+            state.busy_s += time.time() - start
+            state.succeeded += 1
+            state.consecutive_failures = 0
+            finish(idx, dict({"status": "ok", "attempts": attempt + 1, "serial": device.serial, "duration_s": round(time.time() - start, 1)}, **reset, **episode))
+
+    threads = [threading.Thread(target=worker, args=(state,), name=state.device.serial) for state in health]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # 모든 기기가 제외되어 남은 task
+    while not work.empty():
+        idx, task, attempt = work.get()
+        results.setdefault(idx, {"status": "failed", "attempts": attempt, "error": "no healthy device left"})
+    for idx in range(len(tasks)):
+        results.setdefault(idx, {"status": "failed", "attempts": 0, "error": "no healthy device left"})
+    return results, [state.summary() for state in health]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run every task in TASK_FILE on a pool of emulators")
+    parser.add_argument("--devices", type=int, default=NUM_DEVICES, help="Number of emulator instances to run concurrently")
+    parser.add_argument("--retries", type=int, default=MAX_RETRIES, help="Retries per failed episode")
+    parser.add_argument("--reset", type=str, default=RESET_MODE, choices=["snapshot", "cold"], help="Reset between tasks: load SNAPSHOT_NAME on the running emulator (cold boot on failure) or restart the emulator")
+    parser.add_argument("--subprocess", action="store_true", help="Run each episode as a separate `python client.py` process instead of in-process")
+    parser.add_argument("--fake", action="store_true", help="Use fake devices (no emulator / client) to test the scheduler")
+    parser.add_argument("--fake_failure_rate", type=float, default=0.2, help="Failure probability per fake episode")
+    args = parser.parse_args()
+
+    with open(TASK_FILE, "r", encoding="utf-8") as f:
+        tasks = [line.strip() for line in f if line.strip()]
+
+    if args.fake:
+        devices = [FakeDevice(i, failure_rate=args.fake_failure_rate) for i in range(args.devices)]
+    else:
+        devices = [EmulatorDevice(i, read_only=args.devices > 1, in_process=not args.subprocess) for i in range(args.devices)]
+
+    start = time.time()
+    results, device_summaries = run_pool(tasks, devices, max_retries=args.retries, reset_mode=args.reset)
+    summary = {
+        "wall_s": round(time.time() - start, 1),
+        "succeeded": sum(r["status"] == "ok" for r in results.values()),
+        "failed": sum(r["status"] != "ok" for r in results.values()),
+        "devices": device_summaries,
+        "tasks": {idx: results[idx] for idx in sorted(results)},
+    }
+    os.makedirs(IMAGE_BASE_PATH, exist_ok=True)
+    with open(Path(IMAGE_BASE_PATH) / "run_summary.json", "w", encoding="utf-8") as f:
+        json.dump(summary, f, indent=2, ensure_ascii=False)
+
+    print(json.dumps({k: v for k, v in summary.items() if k != "tasks"}, indent=2))
     print("All tasks completed.")
 
 if __name__ == "__main__":
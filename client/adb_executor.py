@@ -0,0 +1,117 @@
+import queue, statistics, subprocess, threading, time, uuid
+
+
+class AdbError(RuntimeError):
+    pass
+
+
+class AdbShell:
+    """
+    One long-lived `adb -s <serial> shell` per device. Commands are written to its stdin
+    instead of spawning `adb shell ...` per action, so each action costs one round trip
+    instead of a process start + adb handshake.
+
+    `run(*commands)` sends several commands in one round trip and waits for a marker
+    echoed after the last one. A shell that died is restarted transparently before
+    sending; a shell that times out is killed and restarted, and the call raises AdbError.
+    """
+
+    def __init__(self, serial="emulator-5554", adb="adb", timeout=10.0):
+        self.serial = serial
+        self.adb = adb
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._proc = None
+        self._lines = None
+        self.num_reconnects = 0
+        self.latencies_ms = []
+
+    def _start(self):
+        self._proc = subprocess.Popen(
+            [self.adb, "-s", self.serial, "shell"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            bufsize=0,
+        )
+        self._lines = queue.Queue()
+        threading.Thread(target=self._read, args=(self._proc, self._lines), daemon=True).start()
+
+    @staticmethod
+    def _read(proc, lines):
+        for line in iter(proc.stdout.readline, b""):
+            lines.put(line.decode("utf-8", errors="replace"))
+        lines.put(None)  # EOF: 셸 종료 (기기 연결 끊김 등)
+
+    def close(self):
+        proc, self._proc = self._proc, None
+        if proc is None:
+            return
+        try:
+            proc.stdin.close()
+            proc.wait(timeout=2)
+        except (OSError, subprocess.TimeoutExpired):
+            proc.kill()
+
+    def reconnect(self):
+        self.close()
+        self.num_reconnects += 1
+        self._start()
+
+    def _send(self, script: bytes):
+        for attempt in range(2):
+            if self._proc is None or self._proc.poll() is not None:
+                self.reconnect() if self._proc is not None else self._start()
+            try:
+                self._proc.stdin.write(script)
+                self._proc.stdin.flush()
+                return
+            except OSError as e:
+                # 쓰기 실패 = 명령이 전달되지 않음 → 재연결 후 한 번만 재시도 (탭이 두 번 실행될 일은 없음)
+                if attempt:
+                    raise AdbError(f"adb shell on {self.serial} is not writable: {e}")
+                self.reconnect()
+
+    def run(self, *commands, timeout=None):
+        """
+        Runs shell commands (each a list of words, joined like `adb shell a b c`) in one
+        round trip. Returns (output, exit status of the last command).
+        """
+        marker = f"__adb_done_{uuid.uuid4().hex[:8]}__"
+        script = "".join(" ".join(str(word) for word in command) + "\n" for command in commands)
+        script += f"echo {marker} $?\n"
+
+        with self._lock:
+            start = time.perf_counter()
+            self._send(script.encode("utf-8"))
+            deadline = start + (timeout or self.timeout)
+
+            output = []
+            while True:
+                try:
+                    line = self._lines.get(timeout=max(0.0, deadline - time.perf_counter()))
+                except queue.Empty:
+                    # 응답 없는 셸은 버리고 다음 호출을 위해 새로 연결
+                    self.reconnect()
+                    raise AdbError(f"adb shell on {self.serial} timed out after {timeout or self.timeout}s")
+                if line is None:
+                    self.close()
+                    raise AdbError(f"adb shell on {self.serial} exited: {''.join(output).strip()}")
+                if marker in line:
+                    before, _, status = line.partition(marker)
+                    output.append(before)
+                    break
+                output.append(line)
+
+            self.latencies_ms.append((time.perf_counter() - start) * 1000.0)
+        return "".join(output), int(status.strip() or 0)
+
+    def stats(self) -> dict:
+        latencies = sorted(self.latencies_ms)
+        return {
+            "serial": self.serial,
+            "num_actions": len(latencies),
+            "num_reconnects": self.num_reconnects,
+            "avg_ms": statistics.mean(latencies) if latencies else 0.0,
+            "p90_ms": latencies[int(0.9 * (len(latencies) - 1))] if latencies else 0.0,
+        }
@@ -0,0 +1,76 @@
+import argparse, io, json, statistics, subprocess, tempfile, time
+from pathlib import Path
+
+from PIL import Image
+
+from client import ADB_SERIAL, capture_png, capture_raw
+
+# 스크린샷 캡처 방식별 latency 비교 (에뮬레이터 필요)
+# python client/bench_capture.py [--serial emulator-5554] [--iterations 20]
+#   png-tempfile: 기존 take_screenshot (screencap -p → 임시 파일 → PIL decode → RGB PNG 재저장)
+#   png-pipe:     screencap -p를 pipe로 받아 메모리에서 decode
+#   raw:          screencap 원본 framebuffer → NumPy zero-copy
+# capture ms = 업로드 직전 이미지가 준비될 때까지 (에피소드 루프를 막는 시간), archive ms = 아카이브 PNG 저장 (raw/png-pipe는 백그라운드)
+
+def png_tempfile(serial, output_file):
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".png") as tmp_file:
+        subprocess.run(["adb", "-s", serial, "exec-out", "screencap", "-p"], stdout=tmp_file, check=True)
+        tmp_path = Path(tmp_file.name)
+    with open(tmp_path, "rb") as f:
+        image_bytes = f.read()
+        image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+        image.save(output_file)
+    tmp_path.unlink()
+    return Image.open(io.BytesIO(image_bytes))
+
+def png_pipe(serial, output_file):
+    image = Image.open(io.BytesIO(capture_png(serial)))
+    image.load()
+    return image
+
+def raw(serial, output_file):
+    return capture_raw(serial)
+
+MODES = [
+    ("png-tempfile", png_tempfile, False),
+    ("png-pipe", png_pipe, True),
+    ("raw", raw, True),
+]
+
+def main():
+    parser = argparse.ArgumentParser(description="Screenshot capture benchmark")
+    parser.add_argument("--serial", type=str, default=ADB_SERIAL, help="Device serial")
+    parser.add_argument("--iterations", type=int, default=20, help="Captures per mode")
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        output_file = Path(tmp_dir) / "screenshot.png"
+        for name, capture, archive_async in MODES:
+            capture(args.serial, output_file)  # warmup
+            capture_ms, archive_ms = [], []
+            for _ in range(args.iterations):
+                start = time.perf_counter()
+                image = capture(args.serial, output_file)
+                capture_ms.append((time.perf_counter() - start) * 1000.0)
+                if archive_async:
+                    start = time.perf_counter()
+                    image.convert("RGB").save(output_file)
+                    archive_ms.append((time.perf_counter() - start) * 1000.0)
+
+            results[name] = {
+                "size": list(image.size),
+                "avg_capture_ms": statistics.mean(capture_ms),
+                "p90_capture_ms": sorted(capture_ms)[int(0.9 * (len(capture_ms) - 1))],
+                "avg_archive_ms": statistics.mean(archive_ms) if archive_ms else None,
+            }
+
+    print(f"{args.iterations} captures per mode from {args.serial}")
+    print(f"{'mode':<14}{'capture ms':>12}{'p90 ms':>12}{'archive ms':>14}")
+    for name, r in results.items():
+        archive = f"{r['avg_archive_ms']:.1f} (bg)" if r["avg_archive_ms"] is not None else "(inline)"
+        print(f"{name:<14}{r['avg_capture_ms']:>12.1f}{r['p90_capture_ms']:>12.1f}{archive:>14}")
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
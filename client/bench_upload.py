@@ -0,0 +1,92 @@
+import argparse, base64, glob, io, json, statistics, time
+from types import SimpleNamespace
+
+import requests
+from PIL import Image
+
+from client import encode_screenshot, server_url, smart_resize, fetch_server_config
+
+# Upload mode별 payload 크기 / 인코딩 시간 / (서버가 있으면) step당 end-to-end latency 비교
+# python client/bench_upload.py --screenshots "dataset/AITA/**/screenshot_*.png" [--server http://host:8000/predict]
+
+MODES = [
+    ("json-png", "json", "png", False),
+    ("binary-png", "binary", "png", False),
+    ("binary-jpeg", "binary", "jpeg", False),
+    ("binary-webp", "binary", "webp", False),
+    ("resized-png", "binary", "png", True),
+    ("resized-jpeg", "binary", "jpeg", True),
+]
+
+def build_request(mode, image_format, image_bytes, quality, step, target_size=None):
+    """
+    (body bytes, content-type, encode ms) 반환. 실제 전송되는 body 크기를 재기 위해 requests로 prepare만 함
+    """
+    meta = {"task": "benchmark", "step": step, "role": "baseline", "previous_steps": "", "app_name": "google_maps", "episode_id": "bench"}
+
+    start = time.perf_counter()
+    if mode == "json":
+        payload = dict(meta, image_base64=base64.b64encode(image_bytes).decode("utf-8"))
+        prepared = requests.Request("POST", "http://localhost/predict", json=payload).prepare()
+    else:
+        data, mime = encode_screenshot(image_bytes, image_format, quality, target_size)
+        files = {"image": (f"screenshot_{step}.{image_format}", data, mime)}
+        prepared = requests.Request("POST", "http://localhost/predict_binary", data=meta, files=files).prepare()
+    encode_ms = (time.perf_counter() - start) * 1000.0
+    return prepared.body, prepared.headers["Content-Type"], encode_ms
+
+def main():
+    parser = argparse.ArgumentParser(description="Screenshot upload benchmark")
+    parser.add_argument("--screenshots", type=str, default="dataset/AITA/**/screenshot_*.png", help="Glob of recorded screenshots")
+    parser.add_argument("--limit", type=int, default=20, help="Max number of screenshots")
+    parser.add_argument("--image_quality", type=int, default=90, help="JPEG/WebP quality")
+    parser.add_argument("--server", type=str, default="", help="Server /predict URL (payload-only benchmark if empty)")
+    args = parser.parse_args()
+
+    paths = sorted(glob.glob(args.screenshots, recursive=True))[:args.limit]
+    if not paths:
+        raise SystemExit(f"No screenshots matched {args.screenshots}")
+    images = [open(p, "rb").read() for p in paths]
+
+    # resized-* 모드는 서버 /config (없으면 qwen_vl_utils 기본값) 기준 smart_resize 해상도로 줄여서 전송
+    config = fetch_server_config(SimpleNamespace(server=args.server)) if args.server else None
+    resize_kwargs = {k: config[k] for k in ("factor", "min_pixels", "max_pixels")} if config else {}
+
+    results = {}
+    for name, mode, image_format, pre_resize in MODES:
+        sizes, encode_ms, latency_ms = [], [], []
+        for step, image_bytes in enumerate(images):
+            target_size = None
+            if pre_resize:
+                width, height = Image.open(io.BytesIO(image_bytes)).size
+                resized_height, resized_width = smart_resize(height, width, **resize_kwargs)
+                target_size = (resized_width, resized_height)
+            body, content_type, enc_ms = build_request(mode, image_format, image_bytes, args.image_quality, step, target_size)
+            sizes.append(len(body))
+            encode_ms.append(enc_ms)
+
+            if args.server:
+                client_args = SimpleNamespace(server=args.server)
+                url = args.server if mode == "json" else server_url(client_args, "/predict_binary")
+                start = time.perf_counter()
+                r = requests.post(url, data=body, headers={"Content-Type": content_type}, timeout=120)
+                r.raise_for_status()
+                latency_ms.append((time.perf_counter() - start) * 1000.0 + enc_ms)
+
+        results[name] = {
+            "avg_payload_kb": statistics.mean(sizes) / 1024,
+            "avg_encode_ms": statistics.mean(encode_ms),
+            "avg_step_latency_ms": statistics.mean(latency_ms) if latency_ms else None,
+            "p90_step_latency_ms": sorted(latency_ms)[int(0.9 * (len(latency_ms) - 1))] if latency_ms else None,
+        }
+
+    print(f"{len(images)} screenshots from {args.screenshots}")
+    print(f"{'mode':<14}{'payload KB':>12}{'encode ms':>12}{'step ms':>12}{'p90 ms':>12}")
+    for name, r in results.items():
+        step_ms = f"{r['avg_step_latency_ms']:.1f}" if r["avg_step_latency_ms"] is not None else "-"
+        p90_ms = f"{r['p90_step_latency_ms']:.1f}" if r["p90_step_latency_ms"] is not None else "-"
+        print(f"{name:<14}{r['avg_payload_kb']:>12.1f}{r['avg_encode_ms']:>12.1f}{step_ms:>12}{p90_ms:>12}")
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -1,52 +1,433 @@
-import base64, io, subprocess, tempfile, requests, json, time
+import asyncio, base64, gzip, io, math, random, subprocess, requests, json, time
 import argparse
 from pathlib import Path
 from PIL import Image
-import shlex
+import shlex, struct
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 
-def take_screenshot(args, step: int) -> bytes:
+from adb_executor import AdbShell, AdbError
+from fast_path import FastPath
+
+try:
+    import zstandard  # optional: --compress zstd
+except ImportError:
+    zstandard = None
+
+# --serial 기본값 (auto.py는 에뮬레이터마다 다른 serial을 args / EpisodeRunner로 넘김)
+ADB_SERIAL = "emulator-5554"
+
+# 아카이브용 스크린샷 저장은 백그라운드 스레드에서 (캡처 → 전송 경로에서 PNG 인코딩 제거)
+# pending: 에피소드마다 따로 가진 future 리스트 (auto.py는 한 프로세스에서 기기별 에피소드를 동시에 실행)
+_archive_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="archive")
+
+def archive_screenshot(screenshot, output_file, pending: list):
+    def save():
+        image = screenshot if isinstance(screenshot, Image.Image) else Image.open(io.BytesIO(screenshot))
+        image.convert("RGB").save(output_file)
+    pending.append(_archive_pool.submit(save))
+
+def flush_archive(pending: list):
+    # 에피소드 끝에서 그 에피소드의 저장이 모두 끝났는지 확인 (저장 실패는 여기서 예외로 드러남)
+    for future in pending:
+        future.result()
+    pending.clear()
+
+def capture_png(serial=None) -> bytes:
+    # screencap -p: 기기에서 PNG 인코딩, pipe로 바로 받음 (임시 파일 없음)
+    return subprocess.run(["adb", "-s", serial or ADB_SERIAL, "exec-out", "screencap", "-p"], stdout=subprocess.PIPE, check=True).stdout
+
+def capture_frame(serial=None) -> np.ndarray:
     """
-    ADB를 사용해 에뮬레이터 화면을 캡처하고 지정된 위치에 저장하며 PNG 바이트를 반환
+    screencap (-p 없이) 원본 framebuffer를 pipe로 받아 (height, width, 4) RGBA 배열로 (NumPy zero-copy)
+    """
+    data = subprocess.run(["adb", "-s", serial or ADB_SERIAL, "exec-out", "screencap"], stdout=subprocess.PIPE, check=True).stdout
+    width, height, pixel_format = struct.unpack_from("<3I", data)
+    size = width * height * 4
+    # header: width, height, format (+ Android 9부터 colorspace) → 12 또는 16 bytes
+    header = len(data) - size
+    if pixel_format not in (1, 2) or header not in (12, 16):
+        raise RuntimeError(f"Unsupported screencap output: format={pixel_format}, {len(data)} bytes for {width}x{height}")
+    return np.frombuffer(data, dtype=np.uint8, count=size, offset=header).reshape(height, width, 4)
+
+def capture_raw(serial=None) -> Image.Image:
+    # PNG 인코딩/디코딩 없이 framebuffer에서 바로 RGBA 이미지 생성
+    return Image.fromarray(capture_frame(serial))
+
+def take_screenshot(args, step: int, frame=None, pending=None):
+    """
+    ADB를 사용해 에뮬레이터 화면을 캡처하고 지정된 위치에 (비동기로) 저장
+    --capture raw: PIL 이미지 반환 (원본 framebuffer), png: screencap PNG 바이트 반환
+    frame: 화면 안정화 대기 중 마지막으로 찍은 프레임이 있으면 다시 캡처하지 않고 사용
+    pending: 에피소드의 아카이브 future 리스트 (없으면 저장이 끝날 때까지 대기)
     """
     image_path = args.image_path + '/'+ args.task_number
     output_file = Path(image_path) / f"screenshot_{step}.png"
     output_file.parent.mkdir(parents=True, exist_ok=True)
 
-    # adb로 임시 스크린샷 생성
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".png") as tmp_file:
-        subprocess.run(
-            ["adb", "-s", "emulator-5554", "exec-out", "screencap", "-p"],
-            stdout=tmp_file,
-            check=True
-        )
-        tmp_path = Path(tmp_file.name)
+    if frame is not None:
+        screenshot = Image.fromarray(frame)
+    elif getattr(args, "capture", "png") == "raw":
+        screenshot = capture_raw(args.serial)
+    else:
+        screenshot = capture_png(args.serial)
+    if pending is None:
+        saved = []
+        archive_screenshot(screenshot, output_file, saved)
+        flush_archive(saved)
+    else:
+        archive_screenshot(screenshot, output_file, pending)
+    return screenshot
+
+def frames_differ(a, b, pixel_threshold=16, changed_fraction=0.002, stride=8) -> bool:
+    # stride 간격으로 샘플링한 저해상도 프레임 (복사 없는 view) 에서 pixel_threshold 넘게 바뀐 픽셀 비율로 판단
+    # (상태바 시계 / 커서 깜빡임 정도는 changed_fraction 아래)
+    a = a[::stride, ::stride, :3].astype(np.int16)
+    b = b[::stride, ::stride, :3].astype(np.int16)
+    return (np.abs(a - b).max(axis=2) > pixel_threshold).mean() > changed_fraction
+
+def wait_for_settle(args, timeout=None):
+    """
+    고정 sleep 대신 화면이 안정될 때까지 대기: settle_interval마다 framebuffer를 찍어 settle_frames번 연속으로
+    변화가 없으면 종료 (최대 timeout초) → (걸린 시간 s, 마지막 프레임)
+    """
+    timeout = args.settle_timeout if timeout is None else timeout
+    start = time.perf_counter()
+    # action 직후에는 아직 화면 전환이 시작되지 않았을 수 있으므로 최소 대기
+    time.sleep(args.settle_min)
+    frame = capture_frame(args.serial)
+    stable = 0
+    while stable < args.settle_frames and time.perf_counter() - start < timeout:
+        time.sleep(args.settle_interval)
+        previous, frame = frame, capture_frame(args.serial)
+        stable = 0 if frames_differ(previous, frame) else stable + 1
+    return time.perf_counter() - start, frame
+
+def open_screenshot(screenshot) -> Image.Image:
+    return screenshot if isinstance(screenshot, Image.Image) else Image.open(io.BytesIO(screenshot))
+
+def server_url(args, route: str) -> str:
+    """
+    --server (기본값 .../predict) 에서 base URL을 뽑아 다른 route URL을 만듦
+    """
+    base = args.server.rstrip("/")
+    if base.endswith("/predict"):
+        base = base[:-len("/predict")]
+    return base + route
+
+def smart_resize(height: int, width: int, factor: int = 28, min_pixels: int = 56 * 56, max_pixels: int = 14 * 14 * 4 * 1280):
+    """
+    qwen_vl_utils.smart_resize와 동일한 계산 (서버 /config 값으로 목표 해상도 계산) → (height, width)
+    """
+    h_bar = max(factor, round(height / factor) * factor)
+    w_bar = max(factor, round(width / factor) * factor)
+    if h_bar * w_bar > max_pixels:
+        beta = math.sqrt((height * width) / max_pixels)
+        h_bar = max(factor, math.floor(height / beta / factor) * factor)
+        w_bar = max(factor, math.floor(width / beta / factor) * factor)
+    elif h_bar * w_bar < min_pixels:
+        beta = math.sqrt(min_pixels / (height * width))
+        h_bar = math.ceil(height * beta / factor) * factor
+        w_bar = math.ceil(width * beta / factor) * factor
+    return h_bar, w_bar
+
+_server_configs = {}
+
+# 같은 프로세스의 모든 요청이 connection pool을 공유 (keep-alive, auto.py에서 EpisodeRunner를 여러 task / 기기에 재사용)
+http = requests.Session()
+http.mount("http://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16))
+http.mount("https://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
+# 재시도할 일시적 오류 (서버 큐 가득 참 / 종료 중 / 게이트웨이)
+# 500은 제외: 파싱할 수 없는 모델 출력 (MalformedToolCall) 등으로, greedy decoding이라 다시 보내도 같은 결과
+RETRY_STATUS = (429, 502, 503, 504)
+
+def compress_body(body: bytes, encoding: str) -> bytes:
+    if encoding == "gzip":
+        return gzip.compress(body, compresslevel=6)
+    if encoding == "zstd":
+        if zstandard is None:
+            raise RuntimeError("--compress zstd needs the zstandard package")
+        return zstandard.ZstdCompressor(level=3).compress(body)
+    raise ValueError(f"Unknown compression {encoding!r}")
+
+def server_time_ms(r):
+    # Server-Timing: total;dur=123.4
+    for metric in r.headers.get("Server-Timing", "").split(","):
+        name, _, params = metric.strip().partition(";")
+        if name == "total" and params.startswith("dur="):
+            return float(params[len("dur="):])
+    return None
+
+def post(args, url, **kwargs):
+    """
+    http.post + --compress로 body 압축, (connect, read) timeout, 일시적 오류 (RETRY_STATUS / 연결 실패) 는
+    jitter를 준 exponential backoff로 재시도 → (response, timing)
+    read timeout은 재시도하지 않음: 서버가 이미 요청을 처리 중이라 다시 보내면 추론 중복 / 세션 step 중복
+    timing: upload_ms (헤더 수신까지 - 서버 처리 시간 = 업로드 + 네트워크), server_ms, attempts, request_kb
+    응답 body는 stream으로 받아서 read_response에서 download_ms 측정
+    """
+    prepared = http.prepare_request(requests.Request("POST", url, **kwargs))
+    encoding = getattr(args, "compress", "none")
+    if encoding != "none" and prepared.body:
+        body = prepared.body if isinstance(prepared.body, bytes) else prepared.body.encode("utf-8")
+        prepared.body = compress_body(body, encoding)
+        prepared.headers["Content-Encoding"] = encoding
+        prepared.headers["Content-Length"] = str(len(prepared.body))
+    timeout = (getattr(args, "connect_timeout", 5.0), getattr(args, "read_timeout", 60.0))
+    retries = getattr(args, "retries", 3)
+
+    for attempt in range(retries + 1):
+        start = time.perf_counter()
+        try:
+            r = http.send(prepared, timeout=timeout, stream=True)
+        except requests.ConnectionError as e:
+            # ConnectTimeout 포함 (ReadTimeout은 ConnectionError가 아니므로 그대로 raise)
+            if attempt == retries:
+                raise
+            delay = getattr(args, "retry_backoff", 0.5) * 2 ** attempt
+            print(f"Request failed ({e}); retrying")
+        else:
+            headers_ms = (time.perf_counter() - start) * 1000.0
+            if r.status_code not in RETRY_STATUS or attempt == retries:
+                server_ms = server_time_ms(r)
+                return r, {
+                    "upload_ms": round(headers_ms - (server_ms or 0.0), 1),
+                    "server_ms": server_ms,
+                    "attempts": attempt + 1,
+                    "request_kb": round(len(prepared.body or b"") / 1024, 1),
+                }
+            delay = float(r.headers.get("Retry-After") or getattr(args, "retry_backoff", 0.5) * 2 ** attempt)
+            print(f"Server returned {r.status_code}; retrying")
+            r.close()
+        time.sleep(delay * random.uniform(0.5, 1.5))
+
+def wait_until_ready(args, timeout=600):
+    """
+    서버 /ready가 200이 될 때까지 대기 (모델 로딩 / warmup 중이면 503). /ready가 없는 구버전 서버는 바로 진행
+    """
+    url = server_url(args, "/ready")
+    deadline = time.time() + timeout
+    while True:
+        try:
+            r = http.get(url, timeout=10)
+            if r.status_code != 503:
+                return
+            print(f"Waiting for server: {r.json().get('state')}")
+        except requests.RequestException as e:
+            print(f"Waiting for server ({e})")
+        if time.time() > deadline:
+            raise TimeoutError(f"Server at {url} not ready after {timeout}s")
+        time.sleep(2)
 
-    # 이미지 읽고 저장
-    with open(tmp_path, "rb") as f:
-        image_bytes = f.read()
-        image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
-        image.save(output_file)
+def fetch_server_config(args) -> dict:
+    """
+    서버의 resize 파라미터 (/config) 조회. 서버별로 한 번만 요청하고, 구버전 서버라 실패하면 None
+    """
+    url = server_url(args, "/config")
+    if url not in _server_configs:
+        try:
+            r = http.get(url, timeout=10)
+            r.raise_for_status()
+            _server_configs[url] = r.json()
+        except requests.RequestException as e:
+            print(f"Could not fetch server config ({e}); uploading full-resolution screenshots.")
+            _server_configs[url] = None
+    return _server_configs[url]
+
+def upload_size(args, width: int, height: int):
+    """
+    업로드할 이미지 해상도 (width, height). --pre_resize면 서버 smart_resize 목표 해상도, 아니면 원본
+    """
+    if not getattr(args, "pre_resize", False):
+        return width, height
+    config = fetch_server_config(args)
+    if not config:
+        return width, height
+    max_pixels = config["max_pixels"]
+    profile = config.get("token_profiles", {}).get(getattr(args, "token_profile", "") or config.get("app_profiles", {}).get(getattr(args, "app_name", "")) or config.get("default_token_profile"))
+    if profile and profile["max_pixels"]:
+        # 서버가 상태바 / 내비게이션 바를 잘라낸 뒤 max_pixels에 맞추므로 잘리는 만큼 여유를 둠
+        max_pixels = min(max_pixels, profile["max_pixels"] / (1.0 - config["crop_fraction"] if profile["crop"] else 1.0))
+    resized_height, resized_width = smart_resize(height, width, factor=config["factor"], min_pixels=config["min_pixels"], max_pixels=max_pixels)
+    return resized_width, resized_height
+
+def encode_screenshot(screenshot, image_format="png", quality=90, target_size=None):
+    """
+    업로드용 이미지 인코딩 (screenshot: PNG 바이트 또는 PIL 이미지) → (bytes, mime type) 반환
+    target_size=(width, height)가 주어지면 그 해상도로 줄여서 인코딩. PNG 바이트 + png + 원본 해상도면 그대로 사용
+    """
+    image_format = image_format.lower()
+    image = open_screenshot(screenshot)
+    resize = target_size is not None and tuple(target_size) != image.size
+    if image_format == "png" and not resize and not isinstance(screenshot, Image.Image):
+        return screenshot, "image/png"
+
+    image = image.convert("RGB")
+    if resize:
+        image = image.resize(tuple(target_size), Image.BICUBIC)
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG" if image_format in ("jpg", "jpeg") else image_format.upper(), quality=quality)
+    return buffer.getvalue(), f"image/{'jpeg' if image_format == 'jpg' else image_format}"
+
+def scale_coordinates(response: dict, from_size, to_size) -> dict:
+    """
+    서버가 반환한 좌표 (from_size 기준)를 디바이스 픽셀 (to_size 기준)로 변환
+    """
+    from_w, from_h = from_size
+    to_w, to_h = to_size
+    if (from_w, from_h) == (to_w, to_h):
+        return response
 
-    tmp_path.unlink()
-    return image_bytes
+    arguments = response["arguments"]
+    for key in ("coordinate", "coordinate2"):
+        coordinate = arguments.get(key)
+        if isinstance(coordinate, list) and len(coordinate) >= 2:
+            arguments[key] = [round(coordinate[0] * to_w / from_w), round(coordinate[1] * to_h / from_h)] + coordinate[2:]
+    response["screen_size"] = [to_w, to_h]
+    return response
+
+def read_stream(r) -> dict:
+    """
+    스트리밍 응답 (NDJSON) 읽기: 모델 출력을 받는 대로 출력하고, action 이벤트가 오면 바로 반환
+    """
+    try:
+        for line in r.iter_lines():
+            if not line:
+                continue
+            event = json.loads(line)
+            if event["event"] == "delta":
+                print(event["text"], end="", flush=True)
+            elif event["event"] == "action":
+                print()
+                return event["response"]
+            elif event["event"] == "error":
+                raise RuntimeError(f"Server error: {event['detail']}")
+    finally:
+        r.close()
+    raise RuntimeError("Stream ended without an action")
+
+def send_to_server(args, task, screenshot, step, role, previous_steps, app_name, episode_id="") -> dict:
+    """
+    서버로 task + 이미지 전송 → 응답 JSON 반환 (좌표는 디바이스 픽셀 기준)
+    --upload binary: multipart로 이미지 바이트 전송 (/predict_binary), json: 기존 base64 JSON (/predict)
+    --pre_resize: 서버 smart_resize 목표 해상도로 미리 줄여서 전송
+    --stream: 모델 출력을 스트리밍으로 받고, tool call이 파싱되는 즉시 반환
+    """
+    meta = {"task": task, "step": step, "role": role, "previous_steps": previous_steps, "app_name": app_name, "episode_id": episode_id}
+    stream = getattr(args, "stream", False)
+    if stream:
+        meta["stream"] = True
+    if getattr(args, "token_profile", ""):
+        meta["profile"] = args.token_profile
+
+    # 서버가 좌표를 디바이스 픽셀로 바꿔서 돌려주도록 원본 해상도 전달 (pre_resize로 줄여서 올려도)
+    device_size = open_screenshot(screenshot).size
+    meta["device_width"], meta["device_height"] = device_size
+    target_size = upload_size(args, *device_size)
+    # router.py 앞에 여러 replica가 있으면 같은 에피소드는 같은 replica로 (prefix cache 재사용)
+    headers = {"X-Episode-Id": str(episode_id)} if episode_id != "" else {}
+
+    if getattr(args, "upload", "json") == "binary":
+        data, mime = encode_screenshot(screenshot, args.image_format, args.image_quality, target_size)
+        files = {"image": (f"screenshot_{step}.{args.image_format}", data, mime)}
+        r, timing = post(args, server_url(args, "/predict_binary"), data=meta, files=files, headers=headers)
+    else:
+        data, _ = encode_screenshot(screenshot, "png", target_size=target_size)
+        b64 = base64.b64encode(data).decode("utf-8")
+        payload = dict(meta, image_base64=b64)
+        # for i, j in payload.items():
+        #     print(f"{i}: {type(j)}")
+        r, timing = post(args, args.server, json=payload, headers=headers)
+
+    return read_response(r, device_size, stream, timing)
+
+def read_response(r, device_size, stream=False, timing=None) -> dict:
+    r.raise_for_status()
+    start = time.perf_counter()
+    response = read_stream(r) if stream else r.json()
+    if "screen_size" in response:
+        response = scale_coordinates(response, response["screen_size"], device_size)
+    if timing is not None:
+        # 스트리밍이면 download_ms는 응답 헤더 이후 action이 나올 때까지 걸린 시간
+        timing["download_ms"] = round((time.perf_counter() - start) * 1000.0, 1)
+        response["timing"] = timing
+    return response
+
+def start_session(args, task, app_name, episode_id="", role="baseline") -> str:
+    """
+    서버에 에피소드 세션 생성 → session_id 반환 (history는 서버가 관리)
+    """
+    payload = {"task": task, "app_name": app_name, "role": role, "episode_id": episode_id, "profile": getattr(args, "token_profile", "")}
+    r, _ = post(args, server_url(args, "/session/start"), json=payload)
+    r.raise_for_status()
+    return r.json()["session_id"]
 
-def send_to_server(args, task, image_bytes, step, role, previous_steps, app_name) -> dict:
+def send_session_step(args, session_id, screenshot, step) -> dict:
     """
-    서버로 task + base64 이미지 전송 → 응답 JSON 반환
+    세션 step: 스크린샷만 multipart로 전송 → 응답 JSON 반환 (좌표는 디바이스 픽셀 기준)
     """
-    b64 = base64.b64encode(image_bytes).decode("utf-8")
-    payload = {"task": task, "image_base64": b64, "step": step, "role": role, "previous_steps": previous_steps, "app_name": app_name}
-    # for i, j in payload.items():
-    #     print(f"{i}: {type(j)}")
+    stream = getattr(args, "stream", False)
+    device_size = open_screenshot(screenshot).size
+    target_size = upload_size(args, *device_size)
+    data, mime = encode_screenshot(screenshot, args.image_format, args.image_quality, target_size)
+    files = {"image": (f"screenshot_{step}.{args.image_format}", data, mime)}
+    data = {"device_width": device_size[0], "device_height": device_size[1]}
+    if stream:
+        data["stream"] = "true"
+    r, timing = post(args, server_url(args, f"/session/{session_id}/step"), data=data, files=files)
+    return read_response(r, device_size, stream, timing)
 
-    r = requests.post(args.server, json=payload, timeout=60)
+def record_session_step(args, session_id, response: dict):
+    """
+    서버에 묻지 않고 실행한 action (--fast_path) 을 세션 history에 추가 → 서버 history = 기기에서 실제로 실행한 action
+    """
+    payload = {"name": response["name"], "arguments": response.get("model_arguments", response["arguments"])}
+    r, _ = post(args, server_url(args, f"/session/{session_id}/record"), json=payload)
     r.raise_for_status()
-    return r.json()
 
-def adb_shell(*args):
-    subprocess.run(["adb", "-s", "emulator-5554", "shell"] + list(args), check=True)
+def end_session(args, session_id):
+    try:
+        http.post(server_url(args, f"/session/{session_id}/end"), timeout=10).raise_for_status()
+    except requests.RequestException as e:
+        print(f"Failed to end session {session_id}: {e}")
+
+def history_entry(step: int, response: dict) -> str:
+    # 서버 세션 history와 같은 포맷 (screen_size 등 부가 필드 제외)
+    # 좌표는 모델이 본 좌표계 (model_arguments): 디바이스 픽셀로 보내면 작은 token profile에서 화면 밖 좌표가 됨
+    arguments = response.get("model_arguments", response["arguments"])
+    return f"\nStep {step+1}: {dict(name=response['name'], arguments=arguments)}; "
+
+# --persistent_adb: 명령마다 adb 프로세스를 띄우지 않고 기기별로 열어 둔 adb shell 하나로 전송
+_adb_shells = {}
+
+def get_adb(serial=None) -> AdbShell:
+    serial = serial or ADB_SERIAL
+    if serial not in _adb_shells:
+        _adb_shells[serial] = AdbShell(serial)
+    return _adb_shells[serial]
+
+def close_adb(serial=None):
+    # 기기 재부팅 / snapshot 로드 후 기존 shell은 끊겼을 수 있으므로 닫아 두고 다음 action에서 새로 연결
+    shell = _adb_shells.get(serial or ADB_SERIAL)
+    if shell is not None:
+        shell.close()
+
+def adb_shell(*args, serial=None, persistent=True):
+    """
+    adb_shell("input", "tap", x, y) 또는 여러 명령을 리스트로: adb_shell(["input", "text", t], ["input", "keyevent", "66"])
+    persistent: 여러 명령은 persistent shell에서 한 번의 round trip으로 실행 (False면 명령마다 adb 프로세스)
+    """
+    commands = [args] if all(isinstance(arg, str) for arg in args) else args
+    if not persistent:
+        for command in commands:
+            subprocess.run(["adb", "-s", serial or ADB_SERIAL, "shell"] + list(command), check=True)
+        return
+    output, status = get_adb(serial).run(*commands)
+    if status != 0:
+        raise AdbError(f"{commands} failed with status {status}: {output.strip()}")
 
-def qwen_action(response: dict) -> str:
+def qwen_action(response: dict, serial=None, persistent=True) -> str:
     
     response = response["arguments"]
     
@@ -67,7 +448,7 @@ def qwen_action(response: dict) -> str:
         }
         key_code = key_map.get(button.upper())
         if key_code:
-            adb_shell("input", "keyevent", key_code)
+            adb_shell("input", "keyevent", key_code, serial=serial, persistent=persistent)
         else:
             print(f"Unknown system button: {button}")
 
@@ -80,7 +461,7 @@ def qwen_action(response: dict) -> str:
             return "click"
         
         x, y = int(coordinate[0]), int(coordinate[1])
-        adb_shell("input", "tap", str(x), str(y))
+        adb_shell("input", "tap", str(x), str(y), serial=serial, persistent=persistent)
 
     elif action_type == "swipe":
         
@@ -97,7 +478,7 @@ def qwen_action(response: dict) -> str:
             return action_type
         
         x1, y1, x2, y2 = int(coordinate[0]), int(coordinate[1]), int(coordinate2[0]), int(coordinate2[1])
-        adb_shell("input", "swipe", str(x1), str(y1), str(x2), str(y2))
+        adb_shell("input", "swipe", str(x1), str(y1), str(x2), str(y2), serial=serial, persistent=persistent)
 
     elif action_type == "type":
         
@@ -106,7 +487,14 @@ def qwen_action(response: dict) -> str:
             print("type requires [text]")
             return action_type
         
-        adb_shell("input", "text", shlex.quote(text))
+        # 줄바꿈은 ENTER로: type + enter를 한 번의 round trip으로 전송
+        commands = []
+        for i, line in enumerate(text.split("\n")):
+            if i:
+                commands.append(["input", "keyevent", "66"])
+            if line:
+                commands.append(["input", "text", shlex.quote(line)])
+        adb_shell(*commands, serial=serial, persistent=persistent)
 
     elif action_type == "long_press":
         
@@ -116,7 +504,13 @@ def qwen_action(response: dict) -> str:
             print("long_click requires [time]")
             return action_type
 
-        adb_shell("input", "swipe", str(x), str(y), str(x), str(y), str(duration))
+        coordinate = response.get("coordinate")
+        if not coordinate or len(coordinate) < 2:
+            print("long_press requires [x, y]")
+            return action_type
+
+        x, y = int(coordinate[0]), int(coordinate[1])
+        adb_shell("input", "swipe", str(x), str(y), str(x), str(y), str(duration), serial=serial, persistent=persistent)
 
     elif action_type == "key":
         
@@ -125,7 +519,7 @@ def qwen_action(response: dict) -> str:
             print("key requires [text]")
             return action_type
         
-        adb_shell("input", "keyevent", str(key_num))
+        adb_shell("input", "keyevent", str(key_num), serial=serial, persistent=persistent)
 
     elif action_type == "open":
         
@@ -134,7 +528,7 @@ def qwen_action(response: dict) -> str:
             print("open requires [text]")
             return action_type
         
-        adb_shell("monkey", "-p", package_name, "-c", "android.intent.category.LAUNCHER", "1")
+        adb_shell("monkey", "-p", package_name, "-c", "android.intent.category.LAUNCHER", "1", serial=serial, persistent=persistent)
 
     elif action_type == "wait":
         
@@ -162,114 +556,231 @@ def qwen_action(response: dict) -> str:
 
     return action_type
 
-def run_adb_action(response: dict) -> str:
+def run_adb_action(response: dict, serial=None, persistent=True) -> str:
     """
     서버 응답에 따라 ADB 명령 실행
     """
     print(response)
     
+    start = time.perf_counter()
     if "qwen" in response["name"]:
-        action_type = qwen_action(response)
+        action_type = qwen_action(response, serial, persistent)
+    print(f"Action {action_type}: {(time.perf_counter() - start) * 1000.0:.1f} ms")
 
     return action_type
 
-def baseline(args):
-    
+def append_jsonl(path, entry: dict, pending: list):
+    # responses.jsonl에 step마다 한 줄씩 추가 (아카이브 스레드에서 순서대로 기록 → 에피소드 도중 죽어도 이전 step은 남음)
+    # action 직후에 기록하고, 다음 화면의 settle 시간은 나중에 {"step_id", "settle_ms"} 한 줄로 따로 추가
+    def write():
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    pending.append(_archive_pool.submit(write))
+
+def write_responses_json(jsonl_path, json_path, episode_length: int):
+    # 에피소드가 끝나면 JSONL을 한 줄씩 읽어 기존 responses.json 포맷으로 변환 (전체를 메모리에 올리지 않음)
+    # settle 기록은 바로 앞의 step 줄에 합침
+    with open(jsonl_path, encoding="utf-8") as src, open(json_path, "w", encoding="utf-8") as dst:
+        dst.write("[")
+        count, previous = 0, None
+        for line in src:
+            entry = json.loads(line)
+            if "result_action_type" not in entry:
+                if previous is not None and previous["step_id"] == entry["step_id"]:
+                    previous["settle_ms"] = entry["settle_ms"]
+                continue
+            if previous is not None:
+                dst.write(("," if count else "") + "\n  " + json.dumps(previous, ensure_ascii=False))
+                count += 1
+            entry["episode_length"] = episode_length
+            previous = entry
+        if previous is not None:
+            dst.write(("," if count else "") + "\n  " + json.dumps(previous, ensure_ascii=False))
+        dst.write("\n]\n")
+
+def step_entry(args, step: int, action_type: str, response: dict) -> dict:
+    response_ = response["arguments"]
+    if action_type == "click" or action_type == "long_press":
+        coordinate = response_.get("coordinate", [0, 0])
+        x, y = int(coordinate[0]), int(coordinate[1])
+        result_action_text = ""
+        result_touch_yx = [y / 2424, x / 1080]
+        result_lift_yx = [y / 2424, x / 1080]
+    elif action_type == "swipe":
+        coordinate = response_.get("coordinate", [0, 0])
+        coordinate2 = response_.get("coordinate2", [0, 0])
+        x1, y1 = int(coordinate[0]), int(coordinate[1])
+        x2, y2 = int(coordinate2[0]), int(coordinate2[1])
+        result_action_text = ""
+        result_touch_yx = [y1 / 2424, x1 / 1080]
+        result_lift_yx = [y2 / 2424, x2 / 1080]
+    elif action_type == "type":
+        result_action_text = response_.get("text")
+        result_touch_yx = [-1, -1]
+        result_lift_yx = [-1, -1]
+    else:
+        result_action_text = ""
+        result_touch_yx = [-1, -1]
+        result_lift_yx = [-1, -1]
+
+    entry = {
+        "episode_id": args.task_number,
+        "episode_length": step + 1,
+        "step_id": step,
+        "instruction": args.task,
+        "result_action_type": action_type,
+        "result_action_text": result_action_text,
+        "result_touch_yx": result_touch_yx,
+        "result_lift_yx": result_lift_yx,
+        "image_path": f"{args.image_path}/{args.task_number}/screenshot_{step}.png",
+    }
+    if "timing" in response:
+        entry["timing"] = response["timing"]
+    if "fast_path" in response:
+        entry["fast_path"] = response["fast_path"]
+    return entry
+
+def next_screenshot(args, step: int, pending: list):
+    """
+    action 이후 다음 step 스크린샷 준비: 화면이 안정될 때까지 대기 (또는 고정 3초) 후 캡처 → (screenshot, settle_ms)
+    """
+    settle_ms, frame = None, None
+    if args.settle:
+        settle_s, frame = wait_for_settle(args)
+        print(f"Screen settled in {settle_s:.2f}s")
+        settle_ms = round(settle_s * 1000.0, 1)
+        # raw 캡처면 마지막 프레임을 다음 step 스크린샷으로 재사용
+        frame = frame if args.capture == "raw" else None
+    else:
+        time.sleep(3)
+    return take_screenshot(args, step, frame, pending), settle_ms
+
+async def initial_frame(args):
+    # 부팅 / snapshot 로드 직후 화면이 안정될 때까지 대기 (auto.py의 고정 sleep 대체)
+    if not args.settle:
+        return None
+    settle_s, frame = await asyncio.to_thread(wait_for_settle, args, args.initial_settle_timeout)
+    print(f"Initial screen settled in {settle_s:.2f}s")
+    return frame if args.capture == "raw" else None
+
+async def run_episode(args, launched_at=None):
+    """
+    Async episode loop. Each step still goes capture → infer → act in order (the next action
+    depends on the screen the previous one produced), but the side work overlaps with it:
+    the server readiness check / session start run while the first screen settles, the next
+    screenshot is prepared while the current step is logged, and screenshot archiving and
+    the per-step JSONL log are written on the archive thread while the server infers.
+    """
+    launched_at = launched_at or getattr(args, "launched_at", None) or time.time()
+    output_path = Path(f"{args.image_path}/{args.task_number}")
+    output_path.mkdir(parents=True, exist_ok=True)
+    log_path = output_path / "responses.jsonl"
+    log_path.unlink(missing_ok=True)
+    # 이 에피소드의 스크린샷 저장 / JSONL 기록 future (flush_archive는 이것만 기다림)
+    pending = []
+
+    async def open_session():
+        await asyncio.to_thread(wait_until_ready, args)
+        # --session: history는 서버가 관리하고 매 step 스크린샷만 전송
+        if args.session:
+            return await asyncio.to_thread(start_session, args, args.task, args.app_name, episode_id=args.task_number)
+        return None
+
+    session_id, frame = await asyncio.gather(open_session(), initial_frame(args))
+    startup_s = time.time() - launched_at
+    print(f"Startup overhead: {startup_s:.2f}s")
+
+    # --fast_path: 같은 화면의 wait / system_button은 캐시된 action을 재실행, 반복 loop는 조기 종료 (서버 호출 생략)
+    fast_path = FastPath(args.loop_repeats, args.max_replays) if args.fast_path else None
     previous_steps = ""
-    output_path = f"{args.image_path}/{args.task_number}"
-    all_responses = []
-    
-    # previous_action = ""
+    prefetch = None
     for step in range(args.max_steps):
-        
-        print(f"\nStep {step}: Taking screenshot...")
-        image_bytes = take_screenshot(args, step)
-        
-        print("Sending to server...")
-        # print("previous action : ", [previous_action])
-        response = send_to_server(args, args.task, image_bytes, step, role="baseline", previous_steps=previous_steps, app_name=args.app_name)
-        response_ = response['arguments']
-        
-        print("Model Output:", json.dumps(response, indent=2, ensure_ascii=False))
-        
-        action_type = run_adb_action(response)
-        previous_steps += f"\nStep {step+1}: {response}; "
-        # previous_action = response
-        
-        if action_type == "click" or action_type == "long_press":
-            coordinate = response_.get("coordinate", [0, 0])
-            x, y = int(coordinate[0]), int(coordinate[1])
-            result_action_text = ""
-            result_touch_yx = [y / 2424, x / 1080]
-            result_lift_yx = [y / 2424, x / 1080]
-        elif action_type == "swipe":
-            coordinate = response_.get("coordinate", [0, 0])
-            coordinate2 = response_.get("coordinate2", [0, 0])
-            coordinate = response_.get("coordinate")
-            
-            x1, y1 = int(coordinate[0]), int(coordinate[1])
-            x2, y2 = int(coordinate2[0]), int(coordinate2[1])
-            result_action_text = ""
-            result_touch_yx = [y1 / 2424, x1 / 1080]
-            result_lift_yx = [y2 / 2424, x2 / 1080]
-        elif action_type == "type":
-            text = response_.get("text")
-            result_action_text = text
-            result_touch_yx = [-1, -1]
-            result_lift_yx = [-1, -1]
+        if step == 0:
+            print("\nStep 0: Taking screenshot...")
+            screenshot = await asyncio.to_thread(take_screenshot, args, 0, frame, pending)
         else:
-            result_action_text = ""
-            result_touch_yx = [-1, -1]
-            result_lift_yx = [-1, -1]    
-        
-        image_path = f"{args.image_path}/{args.task_number}/screenshot_{step}.png"
-        
-        
-        if action_type == "terminate" or action_type == "finished":
+            print(f"\nStep {step}: Waiting for screenshot...")
+            screenshot, settle_ms = await prefetch
+            if settle_ms is not None:
+                append_jsonl(log_path, {"step_id": step - 1, "settle_ms": settle_ms}, pending)
+
+        response = None
+        if fast_path:
+            fast_path.observe(open_screenshot(screenshot))
+            response = fast_path.lookup()
+        if response is not None:
+            print(f"Fast path ({response['fast_path']}): skipping the server")
+            if session_id:
+                await asyncio.to_thread(record_session_step, args, session_id, response)
+        elif session_id:
+            print("Sending to server...")
+            response = await asyncio.to_thread(send_session_step, args, session_id, screenshot, step)
+        else:
+            print("Sending to server...")
+            response = await asyncio.to_thread(send_to_server, args, args.task, screenshot, step, role="baseline", previous_steps=previous_steps, app_name=args.app_name, episode_id=args.task_number)
+        if fast_path:
+            fast_path.record(response)
+
+        print("Model Output:", json.dumps(response, indent=2, ensure_ascii=False))
+
+        action_type = await asyncio.to_thread(run_adb_action, response, args.serial, args.persistent_adb)
+        done = action_type == "terminate" or action_type == "finished"
+        # 다음 스크린샷 준비 (settle 대기 + 캡처) 를 바로 시작하고 그 동안 이번 step 정리
+        prefetch = asyncio.create_task(asyncio.to_thread(next_screenshot, args, step + 1, pending)) if not done and step + 1 < args.max_steps else None
+
+        previous_steps += history_entry(step, response)
+        if "timing" in response:
+            print("Request timing:", response["timing"])
+        # action이 끝난 step은 바로 기록 (다음 step의 settle / 캡처가 실패해도 남음)
+        append_jsonl(log_path, step_entry(args, step, action_type, response), pending)
+        if done:
             print("Task complete. Exiting.")
-            all_responses.append(
-                {
-                    "episode_id": args.task_number,
-                    "episode_length": step + 1,
-                    "step_id": step,
-                    "instruction": args.task,
-                    "result_action_type": action_type,
-                    "result_action_text": "",
-                    "result_touch_yx": [-1, -1],
-                    "result_lift_yx": [-1, -1],
-                    "image_path": image_path,
-                }
-            )
             break
-        
-        all_responses.append(
-            {
-                "episode_id": args.task_number,
-                "episode_length": step + 1,
-                "step_id": step,
-                "instruction": args.task,
-                "result_action_type": action_type,
-                "result_action_text": result_action_text,
-                "result_touch_yx": result_touch_yx,
-                "result_lift_yx": result_lift_yx,
-                "image_path": image_path,
-            }
-        )
-        time.sleep(3)
 
-    # 마지막 결과 스크린샷
+    if session_id:
+        await asyncio.to_thread(end_session, args, session_id)
+    if args.persistent_adb:
+        print("ADB action latency:", get_adb(args.serial).stats())
+    await asyncio.to_thread(flush_archive, pending)
+
     final_step = step + 1
-    # take_screenshot(args, final_step)
-    # print("Final screenshot saved.")
-    for response in all_responses:
-        response["episode_length"] = final_step
-    for response in all_responses:
-        print(response)
-    with open(f"{output_path}/responses.json", "w", encoding="utf-8") as f:
-        json.dump(all_responses, f, indent=2, ensure_ascii=False)
+    write_responses_json(log_path, output_path / "responses.json", final_step)
+    result = {"steps": final_step, "startup_s": round(startup_s, 3), "episode_s": round(time.time() - launched_at, 3)}
+    if fast_path:
+        result["fast_path"] = fast_path.stats()
+        print("Fast path:", result["fast_path"])
+    return result
 
-if __name__ == "__main__":
-    
+def baseline(args, launched_at=None):
+    """
+    Runs one episode; returns {"steps", "startup_s", "episode_s"} (+ "fast_path" counters with --fast_path).
+    launched_at: task를 시작한 시각 (time.time()) → 첫 step까지 걸린 startup overhead 측정용
+    """
+    return asyncio.run(run_episode(args, launched_at))
+
+class EpisodeRunner:
+    """
+    Runs baseline episodes in-process on one device (auto.py). Options are the CLI flags
+    (e.g. server=..., serial=...); HTTP connections (module-level `http` session), the adb
+    shell of the device and the imports are reused across tasks instead of paid per task.
+    """
+
+    def __init__(self, **options):
+        self.args = build_parser().parse_args(["--task_number", "", "--task", ""])
+        for key, value in options.items():
+            setattr(self.args, key, value)
+
+    def run(self, task_number, task, image_path, **options) -> dict:
+        args = argparse.Namespace(**vars(self.args))
+        args.task_number, args.task, args.image_path = str(task_number), task, str(image_path)
+        for key, value in options.items():
+            setattr(args, key, value)
+        return baseline(args, launched_at=time.time())
+
+    def close(self):
+        close_adb(self.args.serial)
+
+def build_parser():
     parser = argparse.ArgumentParser(description="VLM Mobile Agent")
     parser.add_argument("--server", type=str, default="http://143.248.158.188:8000/predict", help="Server URL") # loki1: 143.248.158.22 / loki2: 143.248.158.71
     parser.add_argument("--method", type=str, default="baseline", help="Method to use (pav, baseline)")
@@ -278,8 +789,36 @@ if __name__ == "__main__":
     parser.add_argument("--image_path", type=str, default=".", help="Path to save screenshots")
     parser.add_argument("--max_steps", type=int, default=10, help="Max number of steps before termination")
     parser.add_argument("--app_name", type=str, default="google_maps", help="App name for planner prompt")
+    parser.add_argument("--upload", type=str, default="binary", choices=["binary", "json"], help="Screenshot upload mode (binary: multipart /predict_binary, json: base64 /predict)")
+    parser.add_argument("--image_format", type=str, default="png", choices=["png", "jpeg", "webp"], help="Screenshot encoding for binary upload")
+    parser.add_argument("--image_quality", type=int, default=90, help="JPEG/WebP quality for binary upload")
+    parser.add_argument("--session", action="store_true", help="Use the server-side session API (history kept on the server, only screenshots uploaded)")
+    parser.add_argument("--stream", action="store_true", help="Stream model output and act as soon as the tool call is parsed")
+    parser.add_argument("--pre_resize", action=argparse.BooleanOptionalAction, default=True, help="Resize screenshots to the server's smart_resize target (from /config) before upload")
+    parser.add_argument("--token_profile", type=str, default="", help="Server image token budget profile (e.g. full, balanced, fast); empty = the server's per-app / default profile")
+    parser.add_argument("--compress", type=str, default="none", choices=["none", "gzip", "zstd"], help="Compress request bodies (mostly helps --upload json; zstd needs the zstandard package)")
+    parser.add_argument("--connect_timeout", type=float, default=5.0, help="HTTP connect timeout (s)")
+    parser.add_argument("--read_timeout", type=float, default=60.0, help="HTTP read timeout (s)")
+    parser.add_argument("--retries", type=int, default=3, help="Retries for connection errors and 429/502/503/504 responses (jittered exponential backoff; read timeouts are not retried)")
+    parser.add_argument("--retry_backoff", type=float, default=0.5, help="Base backoff (s) between retries")
+    parser.add_argument("--capture", type=str, default="raw", choices=["raw", "png"], help="Screenshot capture (raw: framebuffer via pipe, no PNG encode/decode; png: screencap -p)")
+    parser.add_argument("--settle", action=argparse.BooleanOptionalAction, default=True, help="Wait until the screen stops changing after each action instead of a fixed 3 s sleep")
+    parser.add_argument("--settle_timeout", type=float, default=3.0, help="Max seconds to wait for the screen to settle after an action")
+    parser.add_argument("--initial_settle_timeout", type=float, default=10.0, help="Max seconds to wait for the screen to settle before the first step")
+    parser.add_argument("--settle_min", type=float, default=0.3, help="Minimum wait after an action before polling frames")
+    parser.add_argument("--settle_interval", type=float, default=0.1, help="Seconds between polled frames")
+    parser.add_argument("--settle_frames", type=int, default=2, help="Consecutive unchanged frames required to consider the screen settled")
+    parser.add_argument("--fast_path", action=argparse.BooleanOptionalAction, default=False, help="Replay cached wait/system_button actions on repeated screens and terminate action loops without asking the server")
+    parser.add_argument("--loop_repeats", type=int, default=3, help="Repeats of the same (screen, action) cycle before --fast_path terminates the episode")
+    parser.add_argument("--max_replays", type=int, default=2, help="Max local replays of a cached action for one screen before asking the server again")
+    parser.add_argument("--serial", type=str, default=ADB_SERIAL, help="adb serial of the device to control")
+    parser.add_argument("--persistent_adb", action=argparse.BooleanOptionalAction, default=True, help="Send actions through one long-lived adb shell instead of one adb process per command")
+    parser.add_argument("--launched_at", type=float, default=None, help="time.time() when the launcher started this episode (for startup overhead)")
+    return parser
 
-    args = parser.parse_args()
+if __name__ == "__main__":
+    
+    args = build_parser().parse_args()
     
     if args.method == "baseline":
         baseline(args)
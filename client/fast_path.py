@@ -0,0 +1,118 @@
+import copy, hashlib, json
+
+import numpy as np
+from PIL import Image
+
+
+def frame_hash(image: Image.Image, size=(27, 60), status_bar=0.04) -> str:
+    # 상태바 (시계 / 알림 아이콘) 는 잘라내고, 축소 + 16단계 양자화로 작은 렌더링 차이는 무시
+    width, height = image.size
+    small = image.crop((0, int(height * status_bar), width, height)).convert("L").resize(size, Image.BILINEAR)
+    return hashlib.blake2b((np.asarray(small) >> 4).tobytes(), digest_size=8).hexdigest()
+
+
+def action_key(response: dict) -> str:
+    return json.dumps(response["arguments"], sort_keys=True, ensure_ascii=False)
+
+
+class FastPath:
+    """
+    Client-side shortcuts that skip the server round trip for an episode step.
+
+    - Cached actions: when the model answered a screen with a cacheable action (wait,
+      system_button), the frame that followed is remembered. If the same screen comes back,
+      the action is replayed locally (at most `max_replays` times). The frame after a replay
+      is validated against the one seen last time; on a mismatch the entry is dropped and
+      the next visit goes to the server again.
+    - Loops: if the same (screen, action) steps repeat `loop_repeats` times in a row, with a
+      period of 1 or 2 steps (tapping something that does nothing, A → B → A → B), the
+      episode is terminated early instead of asking the server again. Repeated waits are
+      not treated as a loop.
+
+    Call `observe(screen)` with each new screenshot, then `lookup()` for a local response
+    (None → ask the server) and `record(response)` with the response that was executed.
+    """
+
+    CACHEABLE_ACTIONS = ("wait", "system_button")
+
+    def __init__(self, loop_repeats=3, max_replays=2):
+        self.loop_repeats = max(2, int(loop_repeats))
+        self.max_replays = max(0, int(max_replays))
+        self._cache = {}  # frame hash → {"response", "next_hash", "replays"}
+        self._trace = []  # (frame hash, action type, action key) per executed step
+        self._current = None
+        self._previous = None
+        self._replayed = False
+
+        self.server_calls = 0
+        self.saved_calls = 0
+        self.cache_hits = 0
+        self.validation_failures = 0
+        self.unchanged_screens = 0
+        self.loop_terminations = 0
+
+    def observe(self, screen: Image.Image):
+        self._previous, self._current = self._current, frame_hash(screen)
+        if self._previous is None:
+            return
+        if self._current == self._previous:
+            self.unchanged_screens += 1
+        entry = self._cache.get(self._previous)
+        if entry is None or self._trace[-1][0] != self._previous:
+            return
+        if entry["next_hash"] is None:
+            # 서버가 답한 cacheable action의 결과 화면을 기억
+            entry["next_hash"] = self._current
+        elif self._replayed and entry["next_hash"] != self._current:
+            # 재실행한 action의 결과가 지난번과 다름 → 캐시 무효화
+            self.validation_failures += 1
+            del self._cache[self._previous]
+
+    def lookup(self):
+        if self._looping():
+            self.loop_terminations += 1
+            self.saved_calls += 1
+            return {"name": "qwen", "arguments": {"action": "terminate", "status": "failure"}, "fast_path": "loop"}
+        entry = self._cache.get(self._current)
+        if entry is None or entry["next_hash"] is None or entry["replays"] >= self.max_replays:
+            return None
+        entry["replays"] += 1
+        self.cache_hits += 1
+        self.saved_calls += 1
+        return dict(copy.deepcopy(entry["response"]), fast_path="cache")
+
+    def record(self, response: dict):
+        self._replayed = "fast_path" in response
+        if not self._replayed:
+            self.server_calls += 1
+            if response["arguments"].get("action") in self.CACHEABLE_ACTIONS:
+                self._cache[self._current] = {
+                    "response": {key: copy.deepcopy(response[key]) for key in ("name", "arguments", "model_arguments") if key in response},
+                    "next_hash": None,
+                    "replays": 0,
+                }
+        self._trace.append((self._current, response["arguments"].get("action"), action_key(response)))
+
+    def _looping(self) -> bool:
+        # 다음 step이 지금까지의 주기 (1 또는 2 step) 를 그대로 반복하게 되는지: 화면이 주기의 시작과 같아야 함
+        for period in (1, 2):
+            window = self._trace[-period * self.loop_repeats:]
+            if len(window) < period * self.loop_repeats:
+                continue
+            block = window[:period]
+            # 같은 화면에서 wait만 반복하는 건 (로딩 중) loop가 아님 → max_replays로만 제한
+            if all(action == "wait" for _, action, _ in block):
+                continue
+            if window == block * self.loop_repeats and self._current == block[0][0]:
+                return True
+        return False
+
+    def stats(self) -> dict:
+        return {
+            "server_calls": self.server_calls,
+            "saved_calls": self.saved_calls,
+            "cache_hits": self.cache_hits,
+            "validation_failures": self.validation_failures,
+            "unchanged_screens": self.unchanged_screens,
+            "loop_terminations": self.loop_terminations,
+        }
@@ -81,6 +81,24 @@ The action to perform. The available actions are:
         "type": "object",
     }
 
+    # constrained decoding (tool_call_grammar.py) 에서만 쓰는 제약: 프롬프트에 들어가는 parameters는 그대로 둠
+    argument_constraints = {
+        "coordinate": {"items": {"type": "integer"}, "minItems": 2, "maxItems": 2},
+        "coordinate2": {"items": {"type": "integer"}, "minItems": 2, "maxItems": 2},
+    }
+    # action별 인자 (call()과 동일)
+    action_arguments = {
+        "key": ["text"],
+        "click": ["coordinate"],
+        "long_press": ["coordinate", "time"],
+        "swipe": ["coordinate", "coordinate2"],
+        "type": ["text"],
+        "system_button": ["button"],
+        "open": ["text"],
+        "wait": ["time"],
+        "terminate": ["status"],
+    }
+
     def __init__(self, cfg=None):
         self.display_width_px = cfg["display_width_px"]
         self.display_height_px = cfg["display_height_px"]
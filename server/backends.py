@@ -0,0 +1,360 @@
+import json, threading, time, uuid
+
+import torch
+from transformers import AutoProcessor, GenerationConfig, LogitsProcessorList, StoppingCriteriaList
+
+from tool_call_stopping import ToolCallConstraint, ToolCallLogitsProcessor, ToolCallStoppingCriteria
+from prefix_cache import PrefixCache, split_prefix, split_history
+
+
+def quantization_kwargs(quantization, max_gpu_memory=None):
+    """
+    QWEN_QUANTIZATION / QWEN_MAX_GPU_MEMORY → from_pretrained kwargs (hf backend).
+    "none" keeps bf16 weights; "int8" / "int4" quantize the language model weights with
+    bitsandbytes (optional dependency) while the vision tower and lm_head stay bf16.
+    max_gpu_memory (e.g. "12GiB") caps the weights per GPU; the rest is offloaded to CPU RAM.
+    """
+    kwargs = {"torch_dtype": torch.bfloat16, "device_map": "auto"}
+    if max_gpu_memory:
+        # CPU 쪽은 제한 없이 두고 GPU 한도를 넘는 layer만 CPU로 offload
+        kwargs["max_memory"] = {i: max_gpu_memory for i in range(torch.cuda.device_count())}
+        kwargs["max_memory"]["cpu"] = "1024GiB"
+    if quantization in (None, "", "none", "bf16"):
+        return kwargs
+
+    from transformers import BitsAndBytesConfig  # int8 / int4 need the bitsandbytes package
+    skip_modules = ["visual", "lm_head"]
+    if quantization == "int8":
+        config = BitsAndBytesConfig(load_in_8bit=True, llm_int8_skip_modules=skip_modules, llm_int8_enable_fp32_cpu_offload=bool(max_gpu_memory))
+    elif quantization == "int4":
+        config = BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_compute_dtype=torch.bfloat16,
+            bnb_4bit_use_double_quant=True,
+            llm_int8_skip_modules=skip_modules,
+            llm_int8_enable_fp32_cpu_offload=bool(max_gpu_memory),
+        )
+    else:
+        raise ValueError(f"Unknown quantization {quantization!r} (expected none, int8 or int4)")
+    return dict(kwargs, quantization_config=config)
+
+
+def load_processor(model_path):
+    processor = AutoProcessor.from_pretrained(model_path)
+    # 배치 generate를 위해 left padding 사용
+    processor.tokenizer.padding_side = "left"
+    return processor
+
+
+class Backend:
+    """
+    Inference backend interface used by qwen_server.
+
+    `preprocess(text, screenshot)` runs on the CPU pool and returns whatever this backend
+    needs per request (stored as item["inputs"]). `generate(items, max_new_tokens, on_done,
+    on_step)` runs a batch and returns the generated token ids of each row; `on_done(row, ids)`
+    may be called earlier for rows that closed their tool call, `on_step(row, ids)` while a
+    row is still decoding (streaming). The scheduler runs up to `num_workers` batches at once.
+    """
+
+    name = "base"
+    num_workers = 1
+
+    def __init__(self, processor):
+        self.processor = processor
+
+    def preprocess(self, text, screenshot):
+        # 토크나이즈 + 이미지 전처리까지 끝내고 GPU 워커에는 텐서만 넘김
+        return dict(self.processor(text=[text], images=[screenshot], padding=False, return_tensors="pt"))
+
+    def generate(self, items, max_new_tokens, on_done, on_step=None):
+        raise NotImplementedError
+
+    def close_session(self, session):
+        pass
+
+    def prefix_cache_stats(self) -> dict:
+        return {"enabled": False}
+
+    def memory_stats(self) -> dict:
+        return {}
+
+
+class HFBackend(Backend):
+    """
+    transformers Qwen2_5_VLForConditionalGeneration on one device, with the prefix KV cache
+    and `</tool_call>` stopping. One batch at a time (single GPU worker).
+    """
+
+    name = "hf"
+
+    # 토큰 단위 텐서 (left padding 대상). 나머지 (pixel_values, image_grid_thw 등)는 이어 붙임
+    TOKEN_KEYS = ("input_ids", "attention_mask", "mm_token_type_ids", "token_type_ids")
+
+    def __init__(self, model_path, processor, attn_implementation="flash_attention_2", prefix_cache_entries=0, quantization="none", max_gpu_memory=None, grammar=None, max_thought_tokens=256):
+        super().__init__(processor)
+        from transformers import Qwen2_5_VLForConditionalGeneration
+        self.quantization = quantization
+        self.model = Qwen2_5_VLForConditionalGeneration.from_pretrained(model_path, attn_implementation=attn_implementation, **quantization_kwargs(quantization, max_gpu_memory))
+        self.prefix_cache = PrefixCache(self.model, processor.tokenizer, processor.image_processor.merge_size, max_entries=prefix_cache_entries) if prefix_cache_entries else None
+        self.constraint = None
+        if grammar is not None:
+            eos = getattr(getattr(self.model, "generation_config", None), "eos_token_id", None)
+            eos = eos if isinstance(eos, (list, tuple)) else [eos] if eos is not None else []
+            self.constraint = ToolCallConstraint(processor.tokenizer, grammar, max_thought_tokens, eos_token_ids=eos)
+
+    def collate(self, items):
+        length = max(item["inputs"]["input_ids"].shape[1] for item in items)
+        batch = {}
+        for key in items[0]["inputs"]:
+            tensors = [item["inputs"][key] for item in items]
+            if key in self.TOKEN_KEYS:
+                pad_value = self.processor.tokenizer.pad_token_id if key == "input_ids" else 0
+                padded = tensors[0].new_full((len(items), length), pad_value)
+                for row, tensor in enumerate(tensors):
+                    padded[row, length - tensor.shape[1]:] = tensor[0]
+                batch[key] = padded
+            else:
+                batch[key] = torch.cat(tensors, dim=0)
+        return {key: value.to(self.model.device) for key, value in batch.items()}
+
+    def generate_with_prefix(self, items, inputs, max_new_tokens, make_stopping, make_logits_processor):
+        # 행마다 캐시된 prefix 사용: 세션이면 system + task + history, 아니면 system prompt + 스키마
+        # 토큰 경계가 prefix 단독 토크나이즈와 달라 맞는 prefix가 없으면 None → 일반 generate
+        entries, suffix_ids = [], []
+        for item in items:
+            ids = item["inputs"]["input_ids"][0].tolist()
+            prefix_text, _ = split_prefix(item["text"])
+            if prefix_text is None:
+                return None
+            candidates = [self.prefix_cache.get(item["prefix_key"], prefix_text)]
+            if item.get("session") is not None and split_history(item["text"]):
+                candidates.insert(0, self.prefix_cache.get(("session", item["session"].session_id), split_history(item["text"]), base=candidates[0]))
+
+            entry = next((c for c in candidates if ids[:len(c["ids"])] == c["ids"]), None)
+            if entry is None:
+                return None
+            entries.append(entry)
+            suffix_ids.append(ids[len(entry["ids"]):])
+
+        prompt_length = max(len(entry["ids"]) for entry in entries) + max(len(ids) for ids in suffix_ids)
+        return self.prefix_cache.generate(entries, suffix_ids, inputs["pixel_values"], inputs["image_grid_thw"], max_new_tokens, make_stopping(prompt_length), make_logits_processor(prompt_length))
+
+    def generate(self, items, max_new_tokens, on_done, on_step=None):
+        inputs = self.collate(items)
+
+        def make_stopping(prompt_length):
+            return ToolCallStoppingCriteria(self.processor.tokenizer, prompt_length, on_done=on_done, on_step=on_step)
+
+        def make_logits_processor(prompt_length):
+            return ToolCallLogitsProcessor(self.constraint, prompt_length) if self.constraint is not None else None
+
+        result = self.generate_with_prefix(items, inputs, max_new_tokens, make_stopping, make_logits_processor) if self.prefix_cache is not None else None
+        if result is None:
+            prompt_length = inputs["input_ids"].shape[1]
+            logits_processor = make_logits_processor(prompt_length)
+            extra = {"logits_processor": LogitsProcessorList([logits_processor])} if logits_processor is not None else {}
+            output_ids = self.model.generate(**inputs, max_new_tokens=max_new_tokens, stopping_criteria=StoppingCriteriaList([make_stopping(prompt_length)]), **extra)
+            result = output_ids, prompt_length
+
+        output_ids, prompt_length = result
+        return [ids[prompt_length:] for ids in output_ids]
+
+    def close_session(self, session):
+        if self.prefix_cache is not None:
+            self.prefix_cache.drop(("session", session.session_id))
+
+    def prefix_cache_stats(self) -> dict:
+        return self.prefix_cache.stats() if self.prefix_cache is not None else {"enabled": False}
+
+    def memory_stats(self) -> dict:
+        device_map = getattr(self.model, "hf_device_map", None) or {}
+        stats = {
+            "quantization": self.quantization,
+            "weights_gb": round(self.model.get_memory_footprint() / 2**30, 3),
+            "offloaded_modules": sum(1 for device in device_map.values() if device in ("cpu", "disk")),
+        }
+        if torch.cuda.is_available():
+            stats["gpu_allocated_gb"] = round(sum(torch.cuda.memory_allocated(i) for i in range(torch.cuda.device_count())) / 2**30, 3)
+            stats["gpu_peak_gb"] = round(sum(torch.cuda.max_memory_allocated(i) for i in range(torch.cuda.device_count())) / 2**30, 3)
+        return stats
+
+
+class VLLMBackend(Backend):
+    """
+    vLLM engine (paged attention KV cache + continuous batching + automatic prefix caching).
+
+    One engine thread steps the engine; `generate` only adds requests and waits, so the
+    scheduler can hand over new requests while earlier ones are still decoding.
+    """
+
+    name = "vllm"
+
+    # QWEN_QUANTIZATION → vLLM quantization: int4는 bitsandbytes (in-flight), int8은 vLLM에 weight-only int8이 없어서 fp8 (W8)
+    QUANTIZATION = {"none": None, "bf16": None, "int8": "fp8", "int4": "bitsandbytes"}
+
+    def __init__(self, model_path, processor, max_num_seqs=32, gpu_memory_utilization=0.9, quantization="none", cpu_offload_gb=0.0, grammar=None, max_thought_tokens=256):
+        super().__init__(processor)
+        from vllm import EngineArgs, LLMEngine, SamplingParams  # optional dependency (QWEN_BACKEND=vllm)
+
+        if quantization not in self.QUANTIZATION:
+            raise ValueError(f"Unknown quantization {quantization!r} (expected none, int8 or int4)")
+        self.quantization = quantization
+        self.engine = LLMEngine.from_engine_args(EngineArgs(
+            model=model_path,
+            dtype="bfloat16",
+            quantization=self.QUANTIZATION[quantization],
+            cpu_offload_gb=cpu_offload_gb,
+            max_num_seqs=max_num_seqs,
+            gpu_memory_utilization=gpu_memory_utilization,
+            enable_prefix_caching=True,
+            limit_mm_per_prompt={"image": 1},
+        ))
+        self.SamplingParams = SamplingParams
+        # HF generate와 같은 greedy + repetition_penalty
+        generation_config = GenerationConfig.from_pretrained(model_path)
+        self.repetition_penalty = getattr(generation_config, "repetition_penalty", None) or 1.0
+        self.num_workers = max_num_seqs
+        # per-request logits_processors (token_ids, logits) 는 vLLM V0 엔진 API (V1은 VLLM_USE_V1=0 필요)
+        self.logits_processors = []
+        if grammar is not None:
+            eos = generation_config.eos_token_id
+            eos = eos if isinstance(eos, (list, tuple)) else [eos] if eos is not None else []
+            constraint = ToolCallConstraint(processor.tokenizer, grammar, max_thought_tokens, eos_token_ids=eos)
+            self.logits_processors = [constraint.apply]
+
+        self._cond = threading.Condition()
+        self._requests = {}
+        self._thread = threading.Thread(target=self._loop, name="vllm-engine", daemon=True)
+        self._thread.start()
+
+    def memory_stats(self) -> dict:
+        # vLLM은 gpu_memory_utilization만큼 미리 잡아 두므로 프로세스 단위 GPU 사용량만 보고
+        stats = {"quantization": self.quantization}
+        if torch.cuda.is_available():
+            stats["gpu_reserved_gb"] = round(sum(torch.cuda.memory_reserved(i) for i in range(torch.cuda.device_count())) / 2**30, 3)
+        return stats
+
+    def preprocess(self, text, screenshot):
+        # 이미지 전처리는 vLLM이 직접 하므로 prompt와 PIL 이미지만 넘김
+        return {"prompt": text, "multi_modal_data": {"image": screenshot}}
+
+    def generate(self, items, max_new_tokens, on_done, on_step=None):
+        params = self.SamplingParams(
+            temperature=0.0,
+            max_tokens=max_new_tokens,
+            repetition_penalty=self.repetition_penalty,
+            stop=["</tool_call>"],
+            include_stop_str_in_output=True,
+            logits_processors=self.logits_processors,
+        )
+        batch = {"outputs": [[] for _ in items], "remaining": len(items), "done": threading.Event(), "on_done": on_done, "on_step": on_step}
+        with self._cond:
+            for row, item in enumerate(items):
+                request_id = uuid.uuid4().hex
+                self._requests[request_id] = (batch, row)
+                self.engine.add_request(request_id, item["inputs"], params)
+            self._cond.notify()
+        batch["done"].wait()
+        return batch["outputs"]
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while not self.engine.has_unfinished_requests():
+                    self._cond.wait()
+                outputs = self.engine.step()
+
+            for output in outputs:
+                batch, row = self._requests[output.request_id]
+                ids = list(output.outputs[0].token_ids)
+                batch["outputs"][row] = ids
+                if not output.finished:
+                    if batch["on_step"] is not None:
+                        batch["on_step"](row, ids)
+                    continue
+                del self._requests[output.request_id]
+                batch["on_done"](row, ids)
+                batch["remaining"] -= 1
+                if batch["remaining"] == 0:
+                    batch["done"].set()
+
+
+# Stub 응답: step마다 순서대로 돌아가며 사용 (좌표는 모델 입력 해상도 비율)
+STUB_ACTIONS = [
+    {"action": "click", "coordinate": (0.5, 0.5)},
+    {"action": "swipe", "coordinate": (0.5, 0.75), "coordinate2": (0.5, 0.25)},
+    {"action": "type", "text": "hello"},
+    {"action": "system_button", "button": "Back"},
+    {"action": "long_press", "coordinate": (0.25, 0.5), "time": 2},
+    {"action": "terminate", "status": "success"},
+]
+
+
+class StubBackend(Backend):
+    """
+    Deterministic CPU stand-in for load tests: no model, every request gets a canned
+    `mobile_use` call (picked by step) after `latency_ms`. Preprocessing, batching,
+    streaming and parsing run exactly as with a real model.
+    """
+
+    name = "stub"
+
+    def __init__(self, processor, latency_ms=0.0):
+        super().__init__(processor)
+        self.latency_ms = latency_ms
+
+    def output_text(self, item) -> str:
+        width, height = item["screen_size"]
+        arguments = dict(STUB_ACTIONS[item["step"] % len(STUB_ACTIONS)])
+        for key in ("coordinate", "coordinate2"):
+            if key in arguments:
+                arguments[key] = [round(arguments[key][0] * width), round(arguments[key][1] * height)]
+        call = json.dumps({"name": "mobile_use", "arguments": arguments})
+        return f"Thought: stub action for step {item['step']}.\n<tool_call>\n{call}\n</tool_call>"
+
+    def generate(self, items, max_new_tokens, on_done, on_step=None):
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000.0)
+        outputs = []
+        for row, item in enumerate(items):
+            ids = self.processor.tokenizer.encode(self.output_text(item), add_special_tokens=False)[:max_new_tokens]
+            if on_step is not None:
+                for n in range(1, len(ids)):
+                    on_step(row, ids[:n])
+            on_done(row, ids)
+            outputs.append(ids)
+        return outputs
+
+
+def load_backend(name, model_path, **kwargs):
+    """
+    QWEN_BACKEND → backend instance: "hf" (default), "vllm", or "stub" (no model weights,
+    only the processor is loaded).
+    """
+    processor = load_processor(model_path)
+    if name == "hf":
+        return HFBackend(
+            model_path,
+            processor,
+            attn_implementation=kwargs.get("attn_implementation", "flash_attention_2"),
+            prefix_cache_entries=kwargs.get("prefix_cache_entries", 0),
+            quantization=kwargs.get("quantization", "none"),
+            max_gpu_memory=kwargs.get("max_gpu_memory"),
+            grammar=kwargs.get("grammar"),
+            max_thought_tokens=kwargs.get("max_thought_tokens", 256),
+        )
+    if name == "vllm":
+        return VLLMBackend(
+            model_path,
+            processor,
+            max_num_seqs=kwargs.get("max_num_seqs", 32),
+            quantization=kwargs.get("quantization", "none"),
+            cpu_offload_gb=kwargs.get("cpu_offload_gb", 0.0),
+            grammar=kwargs.get("grammar"),
+            max_thought_tokens=kwargs.get("max_thought_tokens", 256),
+        )
+    if name == "stub":
+        return StubBackend(processor, latency_ms=kwargs.get("stub_latency_ms", 0.0))
+    raise ValueError(f"Unknown backend {name!r} (expected hf, vllm or stub)")
@@ -0,0 +1,169 @@
+import threading, time
+from collections import deque
+from concurrent.futures import Future
+
+
+class QueueFull(Exception):
+    pass
+
+
+class SchedulerClosed(Exception):
+    pass
+
+
+class BatchScheduler:
+    """
+    Collects concurrent requests for up to `max_wait_ms` (or until `max_batch_size`
+    requests are queued) and runs them through `run_batch` on a worker thread. A request
+    that is alone in the queue is dispatched at once; the window only applies when
+    others are already waiting with it.
+
+    `run_batch(items, resolve)` must return one result per item, in order. A result
+    that is an Exception instance is raised to that caller only. `resolve(index, result)`
+    may be called during the batch to answer a caller early; its entry in the returned
+    list is then ignored.
+
+    At most `max_queue_size` requests may wait (0 = unbounded); beyond that `submit`
+    raises QueueFull so the caller can shed load. `shutdown()` stops accepting new
+    requests, finishes the queued ones and joins the workers.
+
+    `num_workers` > 1 lets several batches run at once, for backends that batch
+    continuously on their own (vLLM engine).
+    """
+
+    def __init__(self, run_batch, max_batch_size=8, max_wait_ms=20, max_queue_size=0, num_workers=1):
+        self.run_batch = run_batch
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait_s = max(0.0, max_wait_ms / 1000.0)
+        self.max_queue_size = max(0, int(max_queue_size))
+
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._closed = False
+
+        # metrics
+        self._lock = threading.Lock()
+        self.num_batches = 0
+        self.num_requests = 0
+        self.num_rejected = 0
+        self.batch_size_counts = {}
+        self.queue_wait_ms_total = 0.0
+        self.queue_wait_ms_max = 0.0
+        self.batch_run_ms_total = 0.0
+        self.last_batch = {}
+
+        self._workers = [
+            threading.Thread(target=self._loop, name=f"batch-scheduler-{i}", daemon=True)
+            for i in range(max(1, int(num_workers)))
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, item) -> Future:
+        future = Future()
+        with self._cond:
+            if self._closed:
+                raise SchedulerClosed("Scheduler is shutting down")
+            if self.max_queue_size and len(self._queue) >= self.max_queue_size:
+                self.num_rejected += 1
+                raise QueueFull(f"{len(self._queue)} requests already queued")
+            self._queue.append((item, future, time.perf_counter()))
+            self._cond.notify()
+        return future
+
+    def queue_depth(self) -> int:
+        with self._cond:
+            return len(self._queue)
+
+    def is_full(self) -> bool:
+        with self._cond:
+            return bool(self.max_queue_size) and len(self._queue) >= self.max_queue_size
+
+    def shutdown(self, timeout=None):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        deadline = time.perf_counter() + timeout if timeout is not None else None
+        for worker in self._workers:
+            worker.join(max(0.0, deadline - time.perf_counter()) if deadline is not None else None)
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._queue:
+                if self._closed:
+                    return None
+                self._cond.wait()
+
+            # 혼자 들어온 요청은 바로 처리 (batch 1에서 max_wait만큼 latency가 늘지 않도록)
+            # 이미 여러 개가 쌓여 있으면 첫 요청 시점부터 max_wait 동안 추가 요청을 모음 (종료 중이면 바로 처리)
+            deadline = self._queue[0][2] + self.max_wait_s
+            while 1 < len(self._queue) < self.max_batch_size and not self._closed:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            n = min(len(self._queue), self.max_batch_size)
+            return [self._queue.popleft() for _ in range(n)]
+
+    def _loop(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            start = time.perf_counter()
+            waits_ms = [(start - enqueued) * 1000.0 for _, _, enqueued in batch]
+
+            def resolve(index, result, batch=batch):
+                future = batch[index][1]
+                if future.done():
+                    return
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+            try:
+                results = self.run_batch([item for item, _, _ in batch], resolve)
+                if len(results) != len(batch):
+                    raise RuntimeError(f"run_batch returned {len(results)} results for {len(batch)} items")
+            except Exception as e:
+                results = [e] * len(batch)
+
+            for index, result in enumerate(results):
+                resolve(index, result)
+
+            self._record(len(batch), waits_ms, (time.perf_counter() - start) * 1000.0)
+
+    def _record(self, batch_size, waits_ms, run_ms):
+        with self._lock:
+            self.num_batches += 1
+            self.num_requests += batch_size
+            self.batch_size_counts[batch_size] = self.batch_size_counts.get(batch_size, 0) + 1
+            self.queue_wait_ms_total += sum(waits_ms)
+            self.queue_wait_ms_max = max(self.queue_wait_ms_max, max(waits_ms))
+            self.batch_run_ms_total += run_ms
+            self.last_batch = {
+                "size": batch_size,
+                "queue_wait_ms": [round(w, 2) for w in waits_ms],
+                "run_ms": round(run_ms, 2),
+            }
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "max_batch_size": self.max_batch_size,
+                "max_wait_ms": self.max_wait_s * 1000.0,
+                "max_queue_size": self.max_queue_size,
+                "num_workers": len(self._workers),
+                "queue_depth": self.queue_depth(),
+                "num_rejected": self.num_rejected,
+                "num_batches": self.num_batches,
+                "num_requests": self.num_requests,
+                "avg_batch_size": self.num_requests / self.num_batches if self.num_batches else 0.0,
+                "batch_size_counts": dict(sorted(self.batch_size_counts.items())),
+                "avg_queue_wait_ms": self.queue_wait_ms_total / self.num_requests if self.num_requests else 0.0,
+                "max_queue_wait_ms": self.queue_wait_ms_max,
+                "avg_batch_run_ms": self.batch_run_ms_total / self.num_batches if self.num_batches else 0.0,
+                "last_batch": dict(self.last_batch),
+            }
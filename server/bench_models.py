@@ -0,0 +1,170 @@
+import argparse, json, math, os, statistics, subprocess, sys, tempfile, time
+from pathlib import Path
+
+# 모델 크기 / 양자화 설정별 메모리, 속도, 기준 (bf16) 대비 action 일치율 비교 (GPU 필요)
+# python server/bench_models.py --configs 3B:none 3B:int8 3B:int4 7B:int4 [--backend hf] [--limit 40]
+#   config = <QWEN_MODEL_SIZE>:<QWEN_QUANTIZATION>, 첫 번째가 기준. config마다 별도 프로세스에서 로드 (GPU 메모리 측정이 섞이지 않도록)
+#   입력: dataset/AITA의 녹화된 스크린샷 + 이전 step들의 녹화된 action을 history로 사용 (모델 좌표계, 모든 config에 같은 prompt)
+#   memory: 가중치 footprint / GPU peak, tokens/s: 배치 1 generate 기준 (생성 토큰 수 / generate 시간)
+#   agreement: 기준과 action type이 같고 좌표 (모델 해상도 대각선의 --tolerance 이내) / text / button이 같은 비율
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+
+def load_samples(dataset, limit):
+    # 에피소드 JSON (AITA 포맷) 마다 step별 (스크린샷, instruction, 이전 step action들)
+    samples = []
+    for path in sorted(Path(dataset).rglob("*.json")):
+        try:
+            steps = json.loads(path.read_text(encoding="utf-8"))
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            continue
+        if not isinstance(steps, list):
+            continue
+        # *_instruction_list.json 같은 다른 JSON (문자열 리스트) 은 건너뜀
+        steps = [step for step in steps if isinstance(step, dict) and "result_action_type" in step]
+        for i, step in enumerate(steps):
+            image_path = path.parent / os.path.basename(step.get("image_path", ""))
+            if not image_path.is_file():
+                continue
+            samples.append({
+                "key": f"{step['episode_id']}/{step.get('step_id', i)}",
+                "image_path": str(image_path),
+                "instruction": step["instruction"],
+                "history": steps[:i],
+                "recorded": step,
+            })
+            if limit and len(samples) >= limit:
+                return samples
+    return samples
+
+
+def recorded_arguments(step, screen_size, to_model=None):
+    # AITA 녹화 action → mobile_use arguments (좌표는 screen_size 픽셀 기준, to_model이 있으면 그 좌표계로 변환)
+    width, height = screen_size
+
+    def point(y, x):
+        xy = [round(x * width), round(y * height)]
+        return to_model(*xy) if to_model else xy
+
+    action = step["result_action_type"]
+    if action in ("click", "long_press"):
+        return {"action": action, "coordinate": point(*step["result_touch_yx"])}
+    if action == "swipe":
+        return {"action": action, "coordinate": point(*step["result_touch_yx"]), "coordinate2": point(*step["result_lift_yx"])}
+    if action == "type":
+        return {"action": action, "text": step["result_action_text"]}
+    return {"action": action}
+
+
+def recorded_history(server, info, steps, image_size):
+    # client.py의 previous_steps / 서버 세션 history와 같은 포맷, 좌표는 이 요청에서 모델이 볼 좌표계 (profile의 crop / 해상도)
+    _, _, box, model_size = server.model_frame(info, image_size)
+    geometry = server.ScreenGeometry(image_size, image_size, box, model_size)
+    return "".join(f"\nStep {i+1}: {dict(name='qwen', arguments=recorded_arguments(step, image_size, geometry.to_model))}; " for i, step in enumerate(steps))
+
+
+def run_config(samples, output):
+    # --worker: QWEN_* 환경 변수는 부모 프로세스가 설정 → qwen_server의 로더 / prompt / 파싱을 그대로 사용
+    import torch
+    from PIL import Image
+    import qwen_server as server
+
+    server.load()
+    results = []
+    generate_s, generated_tokens = 0.0, 0
+    for sample in samples:
+        image_bytes = Path(sample["image_path"]).read_bytes()
+        with Image.open(sample["image_path"]) as image:
+            image_size = image.size
+        info = server.StepInfo(task=sample["instruction"], step=len(sample["history"]), role="bench", previous_steps="", app_name="", episode_id="bench")
+        info.previous_steps = recorded_history(server, info, sample["history"], image_size)
+        item = server.prepare(info, image_bytes, archive=False)
+
+        start = time.perf_counter()
+        ids = server.backend.generate([item], server.MAX_NEW_TOKENS, on_done=lambda row, ids: None)[0]
+        elapsed = time.perf_counter() - start
+        generate_s += elapsed
+        generated_tokens += len(ids)
+
+        text = server.processor.tokenizer.decode(ids, skip_special_tokens=True, clean_up_tokenization_spaces=True)
+        result = {"key": sample["key"], "screen_size": list(item["screen_size"]), "tokens": len(ids), "ms": round(elapsed * 1000.0, 1)}
+        try:
+            result["arguments"] = server.parse_action(text, item["screen_size"])["arguments"]
+        except Exception as e:
+            result["error"] = repr(e)
+        results.append(result)
+
+    summary = {
+        "load_s": server.startup.get("load_s"),
+        "memory": server.backend.memory_stats(),
+        "tokens_per_s": round(generated_tokens / generate_s, 2) if generate_s else 0.0,
+        "avg_ms": round(statistics.mean(r["ms"] for r in results), 1) if results else 0.0,
+        "parse_errors": sum(1 for r in results if "error" in r),
+    }
+    if torch.cuda.is_available():
+        summary["gpu_peak_gb"] = round(sum(torch.cuda.max_memory_allocated(i) for i in range(torch.cuda.device_count())) / 2**30, 3)
+    Path(output).write_text(json.dumps({"summary": summary, "results": results}, ensure_ascii=False), encoding="utf-8")
+
+
+def actions_agree(a, b, screen_size, tolerance):
+    if a is None or b is None or a.get("action") != b.get("action"):
+        return False
+    limit = tolerance * math.hypot(*screen_size)
+    for key in ("coordinate", "coordinate2"):
+        if (key in a) != (key in b):
+            return False
+        if key in a and math.dist(a[key][:2], b[key][:2]) > limit:
+            return False
+    for key in ("text", "button", "status"):
+        if str(a.get(key, "")).strip().lower() != str(b.get(key, "")).strip().lower():
+            return False
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Model size / quantization benchmark")
+    parser.add_argument("--configs", nargs="+", default=["3B:none", "3B:int8", "3B:int4"], help="<model size>:<quantization> (none, int8, int4); the first one is the baseline")
+    parser.add_argument("--backend", type=str, default="hf", help="QWEN_BACKEND for every config")
+    parser.add_argument("--dataset", type=str, default=str(REPO_ROOT / "dataset" / "AITA"), help="Directory with recorded AITA episodes")
+    parser.add_argument("--limit", type=int, default=40, help="Max screenshots (0 = all)")
+    parser.add_argument("--tolerance", type=float, default=0.05, help="Max coordinate distance for agreement, as a fraction of the screen diagonal")
+    parser.add_argument("--output", type=str, default="bench_models.json", help="Where to write per-config summaries")
+    parser.add_argument("--worker", type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--worker_output", type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    samples = load_samples(args.dataset, args.limit)
+    if args.worker:
+        run_config(samples, args.worker_output)
+        return
+    print(f"{len(samples)} screenshots from {args.dataset}")
+
+    runs = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for config in args.configs:
+            size, _, quantization = config.partition(":")
+            env = dict(os.environ, QWEN_BACKEND=args.backend, QWEN_MODEL_SIZE=size, QWEN_QUANTIZATION=quantization or "none", QWEN_ARCHIVE_SCREENSHOTS="0")
+            env.pop("QWEN_MODEL_PATH", None)
+            output = Path(tmp_dir) / f"{len(runs)}.json"
+            print(f"[{config}] loading...")
+            subprocess.run(
+                [sys.executable, __file__, "--dataset", args.dataset, "--limit", str(args.limit), "--worker", config, "--worker_output", str(output)],
+                env=env, cwd=Path(__file__).parent, check=True,
+            )
+            runs[config] = json.loads(output.read_text(encoding="utf-8"))
+
+    baseline = {r["key"]: r for r in runs[args.configs[0]]["results"]}
+    summaries = {}
+    for config, run in runs.items():
+        summary = dict(run["summary"])
+        agree = [actions_agree(r.get("arguments"), baseline[r["key"]].get("arguments"), r["screen_size"], args.tolerance) for r in run["results"]]
+        summary["agreement"] = round(sum(agree) / len(agree), 3) if agree else 0.0
+        summaries[config] = summary
+        print(f"{config:>10}: {json.dumps(summary)}")
+
+    Path(args.output).write_text(json.dumps({"baseline": args.configs[0], "tolerance": args.tolerance, "num_samples": len(samples), "configs": summaries}, indent=2), encoding="utf-8")
+
+
+if __name__ == "__main__":
+    main()
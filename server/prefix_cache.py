@@ -0,0 +1,260 @@
+import hashlib, inspect, json, threading
+from collections import OrderedDict
+
+import torch
+from transformers import DynamicCache, RepetitionPenaltyLogitsProcessor
+
+PREFIX_END = "<|im_start|>user\n"
+
+
+def split_prefix(text: str):
+    """
+    Splits a rendered chat prompt into the constant part (system prompt + function
+    schema, up to and including the user turn header) and the per-request rest.
+    Returns (None, text) when the prompt has no user turn.
+    """
+    idx = text.find(PREFIX_END)
+    if idx < 0:
+        return None, text
+    end = idx + len(PREFIX_END)
+    return text[:end], text[end:]
+
+
+def split_history(text: str):
+    """
+    Text prompt up to the first image (system prefix + task + history), without trailing
+    whitespace so the cut falls on a token boundary. None if the prompt has no image.
+    """
+    idx = text.find("<|vision_start|>")
+    if idx < 0:
+        return None
+    return text[:idx].rstrip()
+
+
+def schema_digest(tool_cls) -> str:
+    return hashlib.sha1(json.dumps(tool_cls.parameters, sort_keys=True).encode("utf-8")).hexdigest()[:12]
+
+
+def _cache_layers(cache):
+    # DynamicCache 내부 구조가 transformers 버전마다 달라서 (key, value) 텐서 리스트로 통일
+    if hasattr(cache, "layers"):
+        return [(layer.keys, layer.values) for layer in cache.layers]
+    if hasattr(cache, "key_cache"):
+        return list(zip(cache.key_cache, cache.value_cache))
+    return [(k, v) for k, v in cache]
+
+
+class PrefixCache:
+    """
+    LRU cache of prefilled KV states for text-only prompt prefixes.
+
+    Two kinds of entries are stored: the constant system prompt + MobileUse schema,
+    keyed on (display width, display height, schema digest), and per-session prefixes
+    (system prompt + task + action history) that are extended in place each step so
+    only the newest history line is prefilled.
+
+    `generate(...)` prefills only each row's remaining suffix (image tokens and the
+    rest of the user turn) on top of a copy of that row's cached prefix and then decodes
+    greedily. Rows are laid out as [prefix | padding | suffix]; 3D (M-RoPE) position ids
+    are computed here so padding never shifts positions.
+    """
+
+    def __init__(self, model, tokenizer, merge_size, max_entries=4):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.merge_size = merge_size
+        self.max_entries = max_entries
+        self.image_token_id = tokenizer.convert_tokens_to_ids("<|image_pad|>")
+
+        eos = model.generation_config.eos_token_id
+        self.eos_token_ids = set(eos if isinstance(eos, (list, tuple)) else [eos] if eos is not None else [])
+        self.pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else next(iter(self.eos_token_ids), 0)
+        penalty = getattr(model.generation_config, "repetition_penalty", None)
+        self.repetition_penalty = RepetitionPenaltyLogitsProcessor(penalty) if penalty and penalty != 1.0 else None
+        self.logits_to_keep = "logits_to_keep" in inspect.signature(model.forward).parameters
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.prefilled_tokens = 0
+        self.reused_tokens = 0
+
+    @torch.no_grad()
+    def get(self, key, prefix_text: str, base=None):
+        """
+        Entry for `prefix_text`. If the entry stored under `key` (or `base`) covers the start
+        of `prefix_text`, only the new tokens are prefilled on top of it.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry["text"] == prefix_text:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                self.reused_tokens += len(entry["ids"])
+                return entry
+            self.misses += 1
+
+        ids = self.tokenizer.encode(prefix_text, add_special_tokens=False)
+        parent = None
+        for candidate in (entry, base):
+            if candidate is not None and prefix_text.startswith(candidate["text"]) and ids[:len(candidate["ids"])] == candidate["ids"]:
+                parent = candidate
+                break
+
+        entry = {"text": prefix_text, "ids": ids, "kv": self._prefill(ids, parent)}
+        with self._lock:
+            self.reused_tokens += len(parent["ids"]) if parent is not None else 0
+            self.prefilled_tokens += len(ids) - (len(parent["ids"]) if parent is not None else 0)
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def drop(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "prefilled_tokens": self.prefilled_tokens,
+                "reused_tokens": self.reused_tokens,
+            }
+
+    def _prefill(self, ids, parent=None):
+        start = len(parent["ids"]) if parent is not None else 0
+        if parent is not None and start == len(ids):
+            return parent["kv"]
+
+        device = self.model.device
+        cache = self._build_cache([parent], start) if parent is not None else DynamicCache()
+        extra = {"logits_to_keep": 1} if self.logits_to_keep else {}
+        out = self.model(
+            input_ids=torch.tensor([ids[start:]], device=device),
+            position_ids=torch.arange(start, len(ids), device=device).view(1, 1, -1).expand(3, 1, -1),
+            past_key_values=cache,
+            use_cache=True,
+            **extra,
+        )
+        return [(k.detach(), v.detach()) for k, v in _cache_layers(out.past_key_values)]
+
+    def _build_cache(self, entries, length):
+        # 행마다 prefix 길이가 달라도 되도록 [row, :, :len(prefix)] 에 복사하고 나머지는 0 (attention mask로 가림)
+        cache = DynamicCache()
+        for layer in range(len(entries[0]["kv"])):
+            k0, v0 = entries[0]["kv"][layer]
+            keys = k0.new_zeros((len(entries), k0.shape[1], length, k0.shape[3]))
+            values = v0.new_zeros((len(entries), v0.shape[1], length, v0.shape[3]))
+            for row, entry in enumerate(entries):
+                k, v = entry["kv"][layer]
+                keys[row, :, :k.shape[2]] = k[0]
+                values[row, :, :v.shape[2]] = v[0]
+            cache.update(keys, values, layer)
+        return cache
+
+    def _positions(self, row_ids, image_grid_thw, image_index):
+        """
+        M-RoPE (t, h, w) positions for one unpadded row; returns (positions[3, n], next image index)
+        """
+        positions = []
+        pos = 0
+        i = 0
+        while i < len(row_ids):
+            if row_ids[i] != self.image_token_id:
+                positions.append((pos, pos, pos))
+                pos += 1
+                i += 1
+                continue
+            t, h, w = (int(x) for x in image_grid_thw[image_index])
+            gh, gw = h // self.merge_size, w // self.merge_size
+            for ti in range(t):
+                for hi in range(gh):
+                    for wi in range(gw):
+                        # 이미지는 temporal 간격이 0 (Qwen2.5-VL get_rope_index와 동일)
+                        positions.append((pos, pos + hi, pos + wi))
+            i += t * gh * gw
+            pos += max(gh, gw)
+            image_index += 1
+        return torch.tensor(positions, dtype=torch.long).T, image_index
+
+    @torch.no_grad()
+    def generate(self, entries, suffix_ids, pixel_values, image_grid_thw, max_new_tokens, stopping_criteria=None, logits_processor=None):
+        """
+        entries[i] is the cached prefix of row i, suffix_ids[i] the rest of its prompt.
+        Returns (output_ids, prompt_length); output_ids[:, prompt_length:] are the generated tokens.
+        """
+        device = self.model.device
+        batch_size = len(suffix_ids)
+        prefix_length = max(len(entry["ids"]) for entry in entries)
+        suffix_length = max(len(ids) for ids in suffix_ids)
+        prompt_length = prefix_length + suffix_length
+
+        input_ids = torch.full((batch_size, prompt_length), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((batch_size, prompt_length), dtype=torch.long)
+        position_ids = torch.zeros((3, batch_size, prompt_length), dtype=torch.long)
+        next_position = torch.zeros(batch_size, dtype=torch.long)
+
+        image_index = 0
+        for row, (entry, ids) in enumerate(zip(entries, suffix_ids)):
+            prefix_ids = entry["ids"]
+            start = prompt_length - len(ids)
+            input_ids[row, :len(prefix_ids)] = torch.tensor(prefix_ids)
+            input_ids[row, start:] = torch.tensor(ids)
+            attention_mask[row, :len(prefix_ids)] = 1
+            attention_mask[row, start:] = 1
+            positions, image_index = self._positions(prefix_ids + list(ids), image_grid_thw, image_index)
+            position_ids[:, row, :len(prefix_ids)] = positions[:, :len(prefix_ids)]
+            position_ids[:, row, start:] = positions[:, len(prefix_ids):]
+            next_position[row] = positions.max() + 1
+
+        input_ids, attention_mask = input_ids.to(device), attention_mask.to(device)
+        position_ids, next_position = position_ids.to(device), next_position.to(device)
+
+        cache = self._build_cache(entries, prefix_length)
+        extra = {"logits_to_keep": 1} if self.logits_to_keep else {}
+        out = self.model(
+            input_ids=input_ids[:, prefix_length:],
+            attention_mask=attention_mask,
+            position_ids=position_ids[:, :, prefix_length:],
+            past_key_values=cache,
+            pixel_values=pixel_values,
+            image_grid_thw=image_grid_thw,
+            use_cache=True,
+            **extra,
+        )
+
+        sequences = input_ids
+        finished = torch.zeros(batch_size, dtype=torch.bool, device=device)
+        for _ in range(max_new_tokens):
+            scores = out.logits[:, -1, :].float()
+            if self.repetition_penalty is not None:
+                scores = self.repetition_penalty(sequences, scores)
+            if logits_processor is not None:
+                scores = logits_processor(sequences, scores)
+            next_tokens = scores.argmax(dim=-1)
+            next_tokens = torch.where(finished, torch.full_like(next_tokens, self.pad_token_id), next_tokens)
+
+            sequences = torch.cat([sequences, next_tokens[:, None]], dim=-1)
+            attention_mask = torch.cat([attention_mask, (~finished).long()[:, None]], dim=-1)
+            for eos in self.eos_token_ids:
+                finished |= next_tokens == eos
+            if stopping_criteria is not None:
+                finished |= stopping_criteria(sequences, scores).to(device)
+            if finished.all():
+                break
+
+            out = self.model(
+                input_ids=next_tokens[:, None],
+                attention_mask=attention_mask,
+                position_ids=next_position.view(1, -1, 1).expand(3, -1, 1),
+                past_key_values=cache,
+                use_cache=True,
+            )
+            next_position = next_position + 1
+
+        return sequences, prompt_length
@@ -1,7 +1,15 @@
-import base64, io, json, os
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+import time
+IMPORT_START = time.perf_counter()
+
+import asyncio, base64, binascii, io, json, os, queue
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from typing import Optional
+from fastapi import FastAPI, HTTPException, File, Form, UploadFile
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from PIL import Image
+from pydantic import BaseModel
 
 from qwen_agent.llm.fncall_prompts.nous_fncall_prompt import (
     NousFnCallPrompt,
@@ -12,49 +20,181 @@ from qwen_agent.llm.fncall_prompts.nous_fncall_prompt import (
 from qwen_vl_utils import smart_resize
 from agent_function_call import MobileUse
 
-import torch
-from transformers import Qwen2_5_VLForConditionalGeneration, AutoProcessor
+from backends import load_backend
+from batching import BatchScheduler, QueueFull, SchedulerClosed
+from screenshot_store import decode_screenshot, ScreenshotArchiver
+from tool_call_stopping import tool_call_token_budget
+from tool_call_grammar import MalformedToolCall, ToolCallGrammar
+from prefix_cache import schema_digest
+from request_compression import DecompressRoute
+from sessions import SessionStore
+from token_budget import ScreenGeometry, crop_box, load_profiles
+from metrics import BATCH_BUCKETS, TOKEN_BUCKETS, Registry, gpu_memory, stage_timer
+
+# QWEN_BACKEND: hf (transformers, 기본값) / vllm (paged attention + continuous batching) / stub (모델 없이 CPU에서 고정 응답)
+BACKEND = os.environ.get("QWEN_BACKEND", "hf")
+# QWEN_MODEL_SIZE: 3B / 7B / 32B / 72B → Qwen/Qwen2.5-VL-{size}-Instruct (QWEN_MODEL_PATH가 있으면 그 경로 사용)
+MODEL_SIZE = os.environ.get("QWEN_MODEL_SIZE", "3B")
+MODEL_PATH = os.environ.get("QWEN_MODEL_PATH", f"Qwen/Qwen2.5-VL-{MODEL_SIZE}-Instruct")
+# 가중치 양자화: none (bf16) / int8 / int4 → replica당 GPU 메모리를 줄여서 한 서버에 더 많이 띄움 (bench_models.py로 정확도 비교)
+QUANTIZATION = os.environ.get("QWEN_QUANTIZATION", "none")
+
+# 동시에 들어온 요청을 모아서 한 번에 generate (QWEN_MAX_BATCH_SIZE=1 이면 기존과 동일하게 요청별 실행)
+MAX_BATCH_SIZE = int(os.environ.get("QWEN_MAX_BATCH_SIZE", 8))
+MAX_WAIT_MS = float(os.environ.get("QWEN_MAX_WAIT_MS", 20))
+# GPU 큐가 이만큼 차 있으면 429로 거절 (backpressure)
+MAX_QUEUE_SIZE = int(os.environ.get("QWEN_MAX_QUEUE_SIZE", 64))
+# base64 디코딩 / PIL / 토크나이즈 / 이미지 전처리는 CPU 풀에서 처리해서 generate와 겹치게 함
+CPU_WORKERS = int(os.environ.get("QWEN_CPU_WORKERS", min(8, os.cpu_count() or 1)))
+SHUTDOWN_TIMEOUT_S = float(os.environ.get("QWEN_SHUTDOWN_TIMEOUT_S", 30))
+
+# system prompt + MobileUse 스키마 (해상도별로 고정) 의 KV cache를 재사용해서 요청마다 prefix를 다시 prefill하지 않음 (hf backend)
+PREFIX_CACHE = os.environ.get("QWEN_PREFIX_CACHE", "1") == "1"
+SCHEMA_DIGEST = schema_digest(MobileUse)
+SESSION_CACHE_ENTRIES = int(os.environ.get("QWEN_SESSION_CACHE_ENTRIES", 16))
+
+BACKEND_KWARGS = dict(
+    attn_implementation=os.environ.get("QWEN_ATTN_IMPLEMENTATION", "flash_attention_2"),
+    prefix_cache_entries=4 + SESSION_CACHE_ENTRIES if PREFIX_CACHE else 0,
+    max_num_seqs=int(os.environ.get("QWEN_VLLM_MAX_NUM_SEQS", 32)),
+    stub_latency_ms=float(os.environ.get("QWEN_STUB_LATENCY_MS", 0)),
+    quantization=QUANTIZATION,
+    # GPU에 다 안 올라가면 나머지 layer를 CPU RAM으로 offload (hf: GPU당 한도 e.g. "12GiB", vllm: offload할 GB)
+    max_gpu_memory=os.environ.get("QWEN_MAX_GPU_MEMORY") or None,
+    cpu_offload_gb=float(os.environ.get("QWEN_VLLM_CPU_OFFLOAD_GB", 0)),
+)
+
+# 이미지 토큰 budget: 요청의 profile → 앱별 profile (QWEN_APP_PROFILES) → QWEN_TOKEN_PROFILE 순서로 선택
+# max_pixels를 낮추면 vision token 수 (= prefill 시간) 가 줄어듦, crop이면 상태바 / 내비게이션 바를 잘라내고 모델에 넘김
+TOKEN_PROFILES, APP_PROFILES = load_profiles(os.environ.get("QWEN_TOKEN_PROFILES", ""), os.environ.get("QWEN_APP_PROFILES", ""))
+DEFAULT_TOKEN_PROFILE = os.environ.get("QWEN_TOKEN_PROFILE", "full")
+STATUS_BAR_FRACTION = float(os.environ.get("QWEN_STATUS_BAR_FRACTION", 0.03))
+NAV_BAR_FRACTION = float(os.environ.get("QWEN_NAV_BAR_FRACTION", 0.05))
+
+# </tool_call>이 나오면 바로 멈추므로 max_new_tokens는 안전장치: thought + MobileUse 스키마 기준 tool call 최대 길이
+MAX_THOUGHT_TOKENS = int(os.environ.get("QWEN_MAX_THOUGHT_TOKENS", 256))
+MAX_NEW_TOKENS_ENV = int(os.environ.get("QWEN_MAX_NEW_TOKENS", 0))
+# 스트리밍 요청은 이 토큰 수마다 delta 전송
+STREAM_EVERY_TOKENS = 4
+
+# MobileUse 스키마로 tool call 디코딩을 제약 (hf / vllm backend) → 형식이 어긋난 생성으로 요청이 실패하지 않음
+# 제약 없이 생성된 출력 (stub, QWEN_CONSTRAINED_DECODING=0) 은 parse_action의 tolerant fallback이 처리
+CONSTRAINED_DECODING = os.environ.get("QWEN_CONSTRAINED_DECODING", "1") == "1"
+TOOL_GRAMMAR = ToolCallGrammar(MobileUse)
+BACKEND_KWARGS.update(grammar=TOOL_GRAMMAR if CONSTRAINED_DECODING else None, max_thought_tokens=MAX_THOUGHT_TOKENS)
+
+# 모델은 import 시점이 아니라 startup (lifespan) 에서 백그라운드로 로드 → /health는 바로 응답, /ready는 로드 + warmup 후 200
+# warmup: 이 해상도의 합성 스크린샷으로 generate 한 번 (CUDA 초기화 / 커널 선택 비용을 첫 실제 요청 전에 지불)
+WARMUP = os.environ.get("QWEN_WARMUP", "1") == "1"
+WARMUP_SIZE = tuple(int(x) for x in os.environ.get("QWEN_WARMUP_SIZE", "1080x2400").split("x"))
 
-model_path = "Qwen/Qwen2.5-VL-3B-Instruct"
-#model_path = "Qwen/Qwen2.5-VL-7B-Instruct"
-model = Qwen2_5_VLForConditionalGeneration.from_pretrained(model_path, torch_dtype=torch.bfloat16, attn_implementation="flash_attention_2",device_map="auto")
-processor = AutoProcessor.from_pretrained(model_path)
+backend = None
+processor = None
+MAX_NEW_TOKENS = None
+scheduler = None
 
-os.makedirs("./qwen_data", exist_ok=True)
+# /metrics (Prometheus text format): 요청 수 / 큐 길이 / 단계별 시간 / 토큰 수 / GPU 메모리 → 부하 상황에서 step latency가 어디서 나오는지 확인
+# QWEN_REQUEST_LOG=1: 추론 요청마다 단계별 시간을 담은 JSON 한 줄 출력 ({"event": "inference", ...})
+REQUEST_LOG = os.environ.get("QWEN_REQUEST_LOG", "1") == "1"
+registry = Registry()
+http_requests = registry.counter("qwen_http_requests_total", "HTTP requests by route and status code", ("route", "status"))
+http_seconds = registry.histogram("qwen_http_request_seconds", "HTTP handling time by route (until response headers)", ("route",))
+rejected_requests = registry.counter("qwen_rejected_requests_total", "Inference requests rejected before queueing", ("reason",))
+inference_results = registry.counter("qwen_inference_results_total", "Finished inference requests by result", ("result",))
+stage_seconds = registry.histogram("qwen_stage_seconds", "Per-request time in each inference stage", ("stage",))
+prompt_tokens = registry.histogram("qwen_prompt_tokens", "Prompt tokens per request (text + image)", buckets=TOKEN_BUCKETS)
+generated_tokens = registry.histogram("qwen_generated_tokens", "Generated tokens per request", buckets=TOKEN_BUCKETS)
+batch_sizes = registry.histogram("qwen_batch_size", "Requests per generate batch", buckets=BATCH_BUCKETS)
+malformed_outputs = registry.counter("qwen_malformed_outputs_total", "Model outputs that needed the tolerant parser (repaired) or could not be parsed", ("kind",))
+queue_depth = registry.gauge("qwen_queue_depth", "Requests waiting for the GPU worker")
+ready_gauge = registry.gauge("qwen_ready", "1 once the model is loaded and warmed up")
+active_sessions = registry.gauge("qwen_active_sessions", "Open /session episodes")
+gpu_memory_bytes = registry.gauge("qwen_gpu_memory_bytes", "CUDA memory by device (allocated, reserved, peak allocated)", ("device", "kind"))
+startup = {"state": "loading", "backend": BACKEND, "model_path": MODEL_PATH, "quantization": QUANTIZATION, "constrained_decoding": CONSTRAINED_DECODING}
 
-app = FastAPI()
+# /session API: 에피소드 history를 서버가 들고 있어서 클라이언트는 매 step 스크린샷만 전송
+SESSION_TTL_S = float(os.environ.get("QWEN_SESSION_TTL_S", 1800))
 
-class Query(BaseModel):
+def close_session(session):
+    if backend is not None:
+        backend.close_session(session)
+
+sessions = SessionStore(ttl_s=SESSION_TTL_S, on_close=close_session)
+
+# 받은 스크린샷을 ./qwen_data/{episode_id}/ 에 비동기로 저장 (QWEN_ARCHIVE_SCREENSHOTS=0 이면 디스크를 전혀 쓰지 않음)
+ARCHIVE_SCREENSHOTS = os.environ.get("QWEN_ARCHIVE_SCREENSHOTS", "1") == "1"
+archiver = ScreenshotArchiver("./qwen_data") if ARCHIVE_SCREENSHOTS else None
+
+cpu_pool = ThreadPoolExecutor(max_workers=CPU_WORKERS, thread_name_prefix="preprocess")
+
+@registry.collector
+def collect_gauges():
+    queue_depth.set(scheduler.queue_depth() if scheduler is not None else 0)
+    ready_gauge.set(1 if scheduler is not None else 0)
+    active_sessions.set(len(sessions))
+    for (device, kind), value in gpu_memory().items():
+        gpu_memory_bytes.set(value, device=device, kind=kind)
+
+@asynccontextmanager
+async def lifespan(app):
+    # 모델 로드 + warmup은 백그라운드 스레드에서: startup을 막지 않으므로 로딩 중에도 /health가 응답
+    asyncio.get_running_loop().run_in_executor(None, load)
+    yield
+    # graceful shutdown: 새 요청은 503, 이미 큐에 들어온 요청은 끝까지 처리한 뒤 종료
+    if scheduler is not None:
+        await asyncio.get_running_loop().run_in_executor(None, scheduler.shutdown, SHUTDOWN_TIMEOUT_S)
+    cpu_pool.shutdown(wait=True)
+    if archiver is not None:
+        archiver.flush()
+
+app = FastAPI(lifespan=lifespan)
+# Content-Encoding: gzip / zstd 요청 body 지원 (클라이언트 --compress)
+app.router.route_class = DecompressRoute
+
+@app.exception_handler(MalformedToolCall)
+async def malformed_tool_call(request, exc):
+    # tolerant parser로도 action을 못 만든 출력 (constrained decoding이 꺼져 있을 때만 가능)
+    return JSONResponse({"detail": str(exc), "kind": exc.kind}, status_code=500)
+
+@app.middleware("http")
+async def server_timing(request, call_next):
+    # 클라이언트가 step 시간을 업로드 / 서버 / 다운로드로 나눌 수 있도록 서버 처리 시간을 헤더로 전달
+    start = time.perf_counter()
+    response = await call_next(request)
+    elapsed = time.perf_counter() - start
+    response.headers["Server-Timing"] = f"total;dur={elapsed * 1000.0:.1f}"
+    # session id 등 path 값이 label로 폭증하지 않도록 route 템플릿 (/session/{session_id}/step) 기준
+    route = getattr(request.scope.get("route"), "path", "unmatched")
+    http_requests.inc(route=route, status=response.status_code)
+    http_seconds.observe(elapsed, route=route)
+    return response
+
+class StepInfo(BaseModel):
     task: str
-    image_base64: str
     step: int
     role: str
     previous_steps: str
     app_name: str
+    episode_id: str = ""
+    stream: bool = False
+    # 이미지 토큰 budget (비어 있으면 앱 / 서버 기본 profile), max_pixels / crop은 profile 값을 덮어씀
+    profile: str = ""
+    max_pixels: int = 0
+    crop: Optional[bool] = None
+    # 스크린샷을 찍은 디바이스 해상도 (0 = 업로드한 이미지 크기): 반환 좌표가 이 픽셀 기준
+    device_width: int = 0
+    device_height: int = 0
 
-@app.post("/predict")
-def predict(query: Query):
-    # 1) 입력 이미지 디코딩
-    image_bytes = base64.b64decode(query.image_base64)
-    
-    screenshot_path = f"./qwen_data/screenshot_{query.step}.png"
-        
-    with open(screenshot_path, "wb") as f:
-        f.write(image_bytes)
-        
-    screenshot = Image.open(screenshot_path)
+class Query(StepInfo):
+    image_base64: str
 
-    # The operation history can be orgnized by Step x: [action]; Step x+1: [action]...
-    user_query = f'''The user query: {query.task}
-Task progress (You have done the following operation on the current device): {query.previous_steps}
-'''
+# 해상도가 같으면 system prompt / 스키마 / chat template 결과가 같으므로 렌더링된 템플릿을 캐시하고
+# 요청마다 user query만 치환
+PROMPT_CACHE_SIZE = int(os.environ.get("QWEN_PROMPT_CACHE_SIZE", 32))
+USER_QUERY_PLACEHOLDER = "<<USER_QUERY>>"
 
-    # The resolution of the device will be written into the system prompt. 
-    resized_height, resized_width  = smart_resize(screenshot.height,
-        screenshot.width,
-        factor=processor.image_processor.patch_size * processor.image_processor.merge_size,
-        min_pixels=processor.image_processor.min_pixels,
-        max_pixels=processor.image_processor.max_pixels,)
+@lru_cache(maxsize=PROMPT_CACHE_SIZE)
+def prompt_template(resized_width: int, resized_height: int) -> str:
     mobile_use = MobileUse(
         cfg={"display_width_px": resized_width, "display_height_px": resized_height}
     )
@@ -65,8 +205,9 @@ Task progress (You have done the following operation on the current device): {qu
     raw_messages = [
             Message(role="system", content=[ContentItem(text="You are a helpful assistant.")]),
             Message(role="user", content=[
-                ContentItem(text=user_query),
-                ContentItem(image=f"file://{screenshot_path}")
+                ContentItem(text=USER_QUERY_PLACEHOLDER),
+                # 실제 이미지는 processor(images=...)로 전달되므로 여기서는 placeholder만 사용
+                ContentItem(image="memory://screenshot")
             ]),
         ]
 
@@ -80,24 +221,478 @@ Task progress (You have done the following operation on the current device): {qu
     
     text = processor.apply_chat_template(message, tokenize=False, add_generation_prompt=True)
     # print(text)
-    inputs = processor(text=[text], images=[screenshot], padding=True, return_tensors="pt").to('cuda')
+    return text
+
+def image_budget(query: StepInfo):
+    # → (profile 이름, max_pixels, crop 여부)
+    name = query.profile or APP_PROFILES.get(query.app_name) or DEFAULT_TOKEN_PROFILE
+    if name not in TOKEN_PROFILES:
+        raise HTTPException(status_code=400, detail=f"Unknown token profile {name!r} (expected one of {sorted(TOKEN_PROFILES)})")
+    profile = TOKEN_PROFILES[name]
+    # processor 기본 max_pixels가 상한: 더 크게 주면 processor가 다시 줄여서 prompt / 좌표 변환의 해상도와 달라짐
+    max_pixels = min(query.max_pixels or profile["max_pixels"] or processor.image_processor.max_pixels, processor.image_processor.max_pixels)
+    crop = profile["crop"] if query.crop is None else query.crop
+    return name, max_pixels, crop
+
+def model_frame(query: StepInfo, image_size):
+    # → (profile 이름, max_pixels, crop box, 모델 해상도 (width, height)): 모델 좌표계, 벤치마크도 history를 이 좌표계로 만듦
+    profile, max_pixels, crop = image_budget(query)
+    box = crop_box(image_size, STATUS_BAR_FRACTION, NAV_BAR_FRACTION) if crop else (0, 0, *image_size)
+    height, width = smart_resize(box[3] - box[1],
+        box[2] - box[0],
+        factor=processor.image_processor.patch_size * processor.image_processor.merge_size,
+        min_pixels=processor.image_processor.min_pixels,
+        max_pixels=max_pixels,)
+    return profile, max_pixels, box, (width, height)
+
+def prepare(query: StepInfo, image_bytes: bytes, archive=True, timings=None):
+    # 단계별 시간 (초): /metrics histogram과 요청 로그용
+    timings = {} if timings is None else timings
 
+    # 1) 입력 이미지 디코딩 (디스크를 거치지 않고 메모리에서 바로 사용)
+    with stage_timer(timings, "image_decode"):
+        try:
+            screenshot = decode_screenshot(image_bytes)
+        except (OSError, Image.DecompressionBombError) as e:
+            # 이미지가 아니거나 잘린 업로드: 서버 오류가 아닌 잘못된 요청
+            raise HTTPException(status_code=400, detail=f"Invalid image: {e}")
+
+    if archive and archiver is not None:
+        try:
+            archiver.submit(query.episode_id, query.step, image_bytes, ext=(screenshot.format or "png").lower())
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    # The operation history can be orgnized by Step x: [action]; Step x+1: [action]...
+    user_query = f'''The user query: {query.task}
+Task progress (You have done the following operation on the current device): {query.previous_steps}
+'''
+
+    with stage_timer(timings, "resize"):
+        # The resolution of the device will be written into the system prompt. 
+        profile, max_pixels, box, (resized_width, resized_height) = model_frame(query, screenshot.size)
+        image = screenshot.crop(box) if box != (0, 0, *screenshot.size) else screenshot
+        if max_pixels != processor.image_processor.max_pixels:
+            # processor 기본 max_pixels보다 작은 budget: 목표 해상도로 직접 줄여서 넘김 (processor는 그대로 통과)
+            image = image.resize((resized_width, resized_height), Image.BICUBIC)
+    with stage_timer(timings, "template"):
+        text = prompt_template(resized_width, resized_height).replace(USER_QUERY_PLACEHOLDER, user_query, 1)
+    # processor 한 번의 호출: 이미지 patch 변환 + 토크나이즈
+    with stage_timer(timings, "preprocess"):
+        inputs = backend.preprocess(text, image)
+    device_size = (query.device_width, query.device_height) if query.device_width and query.device_height else screenshot.size
+    return {
+        "text": text,
+        "inputs": inputs,
+        "screen_size": (resized_width, resized_height),
+        "geometry": ScreenGeometry(device_size, screenshot.size, box, (resized_width, resized_height)),
+        "profile": profile,
+        "prefix_key": (resized_width, resized_height, SCHEMA_DIGEST),
+        "step": query.step,
+        "episode_id": query.episode_id,
+        "role": query.role,
+        "timings": timings,
+        "session": None,
+        "stream": None,
+    }
 
-    output_ids = model.generate(**inputs, max_new_tokens=2048)
-    generated_ids = [output_ids[len(input_ids):] for input_ids, output_ids in zip(inputs.input_ids, output_ids)]
-    output_text = processor.batch_decode(generated_ids, skip_special_tokens=True, clean_up_tokenization_spaces=True)[0]
-    print(output_text)
+def prepare_base64(query: Query):
+    timings = {}
+    with stage_timer(timings, "base64_decode"):
+        try:
+            image_bytes = base64.b64decode(query.image_base64)
+        except binascii.Error as e:
+            raise HTTPException(status_code=400, detail=f"Invalid image_base64: {e}")
+    return prepare(query, image_bytes, timings=timings)
 
+def parse_action(output_text: str, screen_size) -> dict:
     # Qwen will perform action thought function call
-    action = json.loads(output_text.split('<tool_call>\n')[1].split('\n</tool_call>')[0])
+    # 정상 형식이 아니면 tolerant fallback (태그 누락, 작은따옴표, 잘린 JSON 등), 그래도 안 되면 MalformedToolCall
+    try:
+        action, status = TOOL_GRAMMAR.parse(output_text)
+    except MalformedToolCall as e:
+        malformed_outputs.inc(kind=e.kind)
+        raise
+    if status != "ok":
+        malformed_outputs.inc(kind=status)
 
     # ex) {"name": "qwen", "arguments": {"action": "click", "coordinate": [935, 406]}}
     
+    # screen_size: 모델이 본 해상도 (= 모델 좌표의 기준). run_batch에서 ScreenGeometry로 디바이스 픽셀로 변환
     response = {
         "name" : "qwen",
-        "arguments": action["arguments"]
+        "arguments": action["arguments"],
+        "screen_size": list(screen_size),
     }
     
     return response
 
+def publish(item, result):
+    # 스트리밍 요청이면 파싱된 action (또는 에러)을 바로 내보냄
+    if item["stream"] is None:
+        return
+    if isinstance(result, Exception):
+        item["stream"].put({"event": "error", "detail": repr(result)})
+    else:
+        item["stream"].put({"event": "action", "response": result})
+
+def record_request(item, result, output_text, num_generated, batch_size):
+    timings = item["timings"]
+    for stage, seconds in timings.items():
+        stage_seconds.observe(seconds, stage=stage)
+    input_ids = item["inputs"].get("input_ids")
+    num_prompt = int(input_ids.shape[1]) if input_ids is not None else None
+    if num_prompt is not None:
+        prompt_tokens.observe(num_prompt)
+    generated_tokens.observe(num_generated)
+    inference_results.inc(result="error" if isinstance(result, Exception) else "ok")
+    if not REQUEST_LOG:
+        return
+    log = {
+        "event": "inference",
+        "episode_id": item.get("episode_id"),
+        "step": item["step"],
+        "role": item.get("role"),
+        "profile": item.get("profile"),
+        "batch_size": batch_size,
+        "prompt_tokens": num_prompt,
+        "generated_tokens": num_generated,
+        "stages_ms": {stage: round(seconds * 1000.0, 2) for stage, seconds in timings.items()},
+    }
+    if isinstance(result, Exception):
+        log["error"] = repr(result)
+    else:
+        log["action"] = result["arguments"].get("action")
+    log["output"] = output_text
+    print(json.dumps(log, ensure_ascii=False), flush=True)
+
+def run_batch(items, resolve):
+    results = [None] * len(items)
+    finished = [False] * len(items)
+    streamed = [""] * len(items)
+    start = time.perf_counter()
+    first_token = []
+    batch_sizes.observe(len(items))
+    for item in items:
+        if "enqueued_at" in item:
+            item["timings"]["queue"] = start - item["enqueued_at"]
+
+    def decode(generated_ids):
+        return processor.tokenizer.decode(generated_ids, skip_special_tokens=True, clean_up_tokenization_spaces=True)
+
+    def finish(row, generated_ids):
+        # </tool_call>이 나온 시퀀스는 배치의 나머지가 끝나기를 기다리지 않고 바로 응답
+        finished[row] = True
+        done = time.perf_counter()
+        timings = items[row]["timings"]
+        # prefill = 배치 시작 → 첫 토큰 (배치 단위), decode = 첫 토큰 → 이 행의 tool call이 닫힐 때까지
+        timings["prefill"] = (first_token[0] if first_token else done) - start
+        timings["decode"] = done - (first_token[0] if first_token else done)
+        with stage_timer(timings, "parse"):
+            output_text = decode(generated_ids)
+            try:
+                results[row] = parse_action(output_text, items[row]["screen_size"])
+                # history는 (세션 / 클라이언트 모두) 모델이 본 좌표 그대로, 응답 좌표는 디바이스 픽셀로 변환
+                if items[row].get("session") is not None:
+                    items[row]["session"].record(items[row]["step"], results[row])
+                results[row] = items[row]["geometry"].map_response(results[row])
+            except Exception as e:
+                results[row] = e
+        record_request(items[row], results[row], output_text, len(generated_ids), len(items))
+        # resolve 먼저: 세션의 다음 step을 받을 수 있게 된 뒤에 스트리밍 클라이언트에 action을 보냄
+        resolve(row, results[row])
+        publish(items[row], results[row])
+
+    def stream_delta(row, generated_ids):
+        if items[row]["stream"] is None or len(generated_ids) % STREAM_EVERY_TOKENS:
+            return
+        text = decode(generated_ids)
+        if text.startswith(streamed[row]) and len(text) > len(streamed[row]):
+            items[row]["stream"].put({"event": "delta", "text": text[len(streamed[row]):]})
+            streamed[row] = text
+
+    streaming = any(item["stream"] is not None for item in items)
+
+    def on_step(row, generated_ids):
+        if not first_token:
+            first_token.append(time.perf_counter())
+        if streaming:
+            stream_delta(row, generated_ids)
+
+    outputs = backend.generate(items, MAX_NEW_TOKENS, on_done=finish, on_step=on_step)
+
+    # </tool_call> 없이 끝난 시퀀스 (EOS / max_new_tokens)
+    for row, ids in enumerate(outputs):
+        if not finished[row]:
+            finish(row, ids)
+    return results
+
+def warmup():
+    """
+    Runs one generate on a synthetic screenshot; returns (total ms, first token ms).
+    """
+    buf = io.BytesIO()
+    Image.new("RGB", WARMUP_SIZE, "white").save(buf, "PNG")
+    info = StepInfo(task="Open the settings app.", step=0, role="warmup", previous_steps="", app_name="", episode_id="warmup")
+    start = time.perf_counter()
+    item = prepare(info, buf.getvalue(), archive=False)
+    first_token = []
+
+    def on_step(row, generated_ids):
+        if not first_token:
+            first_token.append(time.perf_counter())
+
+    backend.generate([item], MAX_NEW_TOKENS, on_done=on_step, on_step=on_step)
+    end = time.perf_counter()
+    return (end - start) * 1000.0, ((first_token[0] if first_token else end) - start) * 1000.0
+
+def load():
+    global backend, processor, MAX_NEW_TOKENS, scheduler
+    try:
+        start = time.perf_counter()
+        backend = load_backend(BACKEND, MODEL_PATH, **BACKEND_KWARGS)
+        processor = backend.processor
+        MAX_NEW_TOKENS = MAX_NEW_TOKENS_ENV or MAX_THOUGHT_TOKENS + tool_call_token_budget(processor.tokenizer, MobileUse)
+        startup["load_s"] = round(time.perf_counter() - start, 3)
+        startup["memory"] = backend.memory_stats()
+
+        if WARMUP:
+            startup["state"] = "warming_up"
+            warmup_ms, first_token_ms = warmup()
+            startup["warmup_ms"] = round(warmup_ms, 1)
+            startup["first_token_ms"] = round(first_token_ms, 1)
+
+        scheduler = BatchScheduler(run_batch, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS, max_queue_size=MAX_QUEUE_SIZE, num_workers=backend.num_workers)
+        startup["state"] = "ready"
+    except Exception as e:
+        startup["state"] = "failed"
+        startup["error"] = repr(e)
+        raise
+    finally:
+        startup["ready_s"] = round(time.perf_counter() - IMPORT_START, 3)
+        print(f"[startup] {json.dumps(startup)}", flush=True)
+
+def stream_events(item, future):
+    # NDJSON: {"event": "delta", "text": ...}* → {"event": "action", "response": {...}} | {"event": "error", ...}
+    while True:
+        try:
+            event = item["stream"].get(timeout=0.1)
+        except queue.Empty:
+            if future.done() and future.exception() is not None:
+                yield json.dumps({"event": "error", "detail": repr(future.exception())}) + "\n"
+                return
+            continue
+        yield json.dumps(event, ensure_ascii=False) + "\n"
+        if event["event"] in ("action", "error"):
+            return
+
+async def run_cpu(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(cpu_pool, fn, *args)
+
+def check_ready():
+    if scheduler is None:
+        raise HTTPException(status_code=503, detail=f"Model is not ready ({startup['state']})", headers={"Retry-After": "5"})
+
+def check_capacity():
+    # 전처리 전에 먼저 확인해서 어차피 거절될 요청의 디코딩 비용을 아낌
+    if scheduler is None:
+        rejected_requests.inc(reason="not_ready")
+    check_ready()
+    if scheduler.is_full():
+        rejected_requests.inc(reason="queue_full")
+        raise HTTPException(status_code=429, detail="Inference queue is full", headers={"Retry-After": "1"})
+
+async def submit(item, stream: bool, on_done=None):
+    # on_done: 추론이 끝나면 (성공 / 실패 모두) 호출, 큐에 넣지 못했으면 바로 호출
+    if stream:
+        item["stream"] = queue.Queue()
+    item["enqueued_at"] = time.perf_counter()
+    try:
+        future = scheduler.submit(item)
+    except QueueFull as e:
+        rejected_requests.inc(reason="queue_full")
+        if on_done is not None:
+            on_done()
+        raise HTTPException(status_code=429, detail=f"Inference queue is full ({e})", headers={"Retry-After": "1"})
+    except SchedulerClosed as e:
+        rejected_requests.inc(reason="shutting_down")
+        if on_done is not None:
+            on_done()
+        raise HTTPException(status_code=503, detail=str(e))
+    if on_done is not None:
+        future.add_done_callback(lambda _: on_done())
+
+    if not stream:
+        return await asyncio.wrap_future(future)
+    return StreamingResponse(stream_events(item, future), media_type="application/x-ndjson")
+
+@app.post("/predict")
+async def predict(query: Query):
+    check_capacity()
+    item = await run_cpu(prepare_base64, query)
+    return await submit(item, query.stream)
+
+@app.post("/predict_binary")
+async def predict_binary(
+    image: UploadFile = File(...),
+    task: str = Form(...),
+    step: int = Form(...),
+    role: str = Form("baseline"),
+    previous_steps: str = Form(""),
+    app_name: str = Form(""),
+    episode_id: str = Form(""),
+    stream: bool = Form(False),
+    profile: str = Form(""),
+    max_pixels: int = Form(0),
+    crop: Optional[bool] = Form(None),
+    device_width: int = Form(0),
+    device_height: int = Form(0),
+):
+    # base64 JSON 대신 multipart로 스크린샷 바이트(PNG/JPEG/WebP)를 그대로 받음
+    check_capacity()
+    info = StepInfo(
+        task=task,
+        step=step,
+        role=role,
+        previous_steps=previous_steps,
+        app_name=app_name,
+        episode_id=episode_id,
+        profile=profile,
+        max_pixels=max_pixels,
+        crop=crop,
+        device_width=device_width,
+        device_height=device_height,
+    )
+    item = await run_cpu(prepare, info, await image.read())
+    return await submit(item, stream)
+
+class SessionStart(BaseModel):
+    task: str
+    app_name: str = ""
+    role: str = "baseline"
+    episode_id: str = ""
+    profile: str = ""
+
+class SessionRecord(BaseModel):
+    name: str = "qwen"
+    arguments: dict
+
+def get_session(session_id: str):
+    session = sessions.get(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail=f"Unknown session {session_id}")
+    return session
+
+@app.post("/session/start")
+async def session_start(request: SessionStart):
+    session = sessions.start(request.task, request.app_name, request.role, request.episode_id, request.profile)
+    return {"session_id": session.session_id}
+
+@app.post("/session/{session_id}/step")
+async def session_step(
+    session_id: str,
+    image: UploadFile = File(...),
+    stream: bool = Form(False),
+    device_width: int = Form(0),
+    device_height: int = Form(0),
+):
+    # history는 서버가 관리하므로 스크린샷만 받음
+    session = get_session(session_id)
+    if not session.begin():
+        raise HTTPException(status_code=409, detail=f"Session {session_id} already has a step in flight")
+    try:
+        check_capacity()
+        info = StepInfo(
+            task=session.task,
+            step=session.step,
+            role=session.role,
+            previous_steps=session.previous_steps(),
+            app_name=session.app_name,
+            episode_id=session.episode_id,
+            profile=session.profile,
+            device_width=device_width,
+            device_height=device_height,
+        )
+        item = await run_cpu(prepare, info, await image.read())
+    except BaseException:
+        session.finish()
+        raise
+    item["session"] = session
+    # 큐에 들어간 뒤에는 추론이 끝날 때 (history 기록 후) 다음 step을 받음
+    return await submit(item, stream, on_done=session.finish)
+
+@app.post("/session/{session_id}/record")
+async def session_record(session_id: str, request: SessionRecord):
+    # 서버를 거치지 않고 클라이언트가 실행한 action (--fast_path 재실행 / loop 종료) 을 history에 추가 (좌표는 모델 좌표계)
+    session = get_session(session_id)
+    if not session.begin():
+        raise HTTPException(status_code=409, detail=f"Session {session_id} already has a step in flight")
+    try:
+        session.record(session.step, {"name": request.name, "arguments": request.arguments})
+    finally:
+        session.finish()
+    return {"session_id": session_id, "steps": session.step}
+
+@app.post("/session/{session_id}/end")
+async def session_end(session_id: str):
+    session = sessions.end(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail=f"Unknown session {session_id}")
+    return {"session_id": session_id, "steps": session.step, "history": session.history}
+
+@app.get("/health")
+def health():
+    # 프로세스가 살아 있는지만 확인 (모델 로딩 중에도 200)
+    return {"status": "ok", "state": startup["state"]}
+
+@app.get("/ready")
+def ready():
+    # 모델 로드 + warmup이 끝나서 요청을 받을 수 있으면 200, 아니면 503
+    if scheduler is None:
+        return JSONResponse(startup, status_code=503)
+    return startup
+
+@app.get("/config")
+def config():
+    # 클라이언트가 업로드 전에 smart_resize 목표 해상도로 미리 줄일 수 있도록 resize 파라미터 공개
+    check_ready()
+    image_processor = processor.image_processor
+    return {
+        "patch_size": image_processor.patch_size,
+        "merge_size": image_processor.merge_size,
+        "factor": image_processor.patch_size * image_processor.merge_size,
+        "min_pixels": image_processor.min_pixels,
+        "max_pixels": image_processor.max_pixels,
+        "model_path": MODEL_PATH,
+        "quantization": QUANTIZATION,
+        # 클라이언트 --token_profile pre_resize용 (max_pixels None = 위의 max_pixels)
+        "token_profiles": TOKEN_PROFILES,
+        "app_profiles": APP_PROFILES,
+        "default_token_profile": DEFAULT_TOKEN_PROFILE,
+        "crop_fraction": STATUS_BAR_FRACTION + NAV_BAR_FRACTION,
+        "memory": backend.memory_stats(),
+    }
+
+@app.get("/metrics")
+def metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/batch_stats")
+def batch_stats():
+    # 배치 크기 / 큐 대기 시간 통계 (throughput vs latency 튜닝용)
+    check_ready()
+    return scheduler.stats()
+
+@app.get("/prompt_cache_stats")
+def prompt_cache_stats():
+    info = prompt_template.cache_info()
+    return {"hits": info.hits, "misses": info.misses, "entries": info.currsize, "max_entries": info.maxsize}
+
+@app.get("/prefix_cache_stats")
+def prefix_cache_stats():
+    check_ready()
+    return backend.prefix_cache_stats()
+
+startup["import_s"] = round(time.perf_counter() - IMPORT_START, 3)
+
 # uvicorn qwen_server:app --host 0.0.0.0 --port 8000
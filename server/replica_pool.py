@@ -0,0 +1,162 @@
+import itertools, threading, time
+
+
+class Replica:
+    """
+    One qwen_server instance behind the router. `ready` follows its /ready endpoint,
+    `draining` is set by the operator; `outstanding` counts requests in flight through
+    the router.
+    """
+
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+        self.ready = False
+        self.draining = False
+        self.state = "unknown"
+        self.failures = 0
+        self.outstanding = 0
+        self.requests = 0
+        self.last_check = None
+
+    def routable(self) -> bool:
+        return self.ready and not self.draining
+
+
+class ReplicaPool:
+    """
+    Least-outstanding-requests routing with per-episode affinity.
+
+    `acquire(key)` picks a replica and counts the request as outstanding until
+    `release(replica)`. Keys come in two kinds:
+
+    - ("session", session_id): the session lives on that replica, so it always goes
+      back there while the replica is up, even when it is draining (None if it is down).
+    - ("episode", episode_id): stateless requests of one episode stick to the same
+      replica only to keep its prefix cache warm; they move when it is draining or down.
+
+    A draining replica gets no new keys and is `drained` once it has no outstanding
+    requests and no sessions left. Keys idle for more than `ttl_s` are forgotten.
+    """
+
+    def __init__(self, urls, ttl_s=1800, unhealthy_after=2):
+        self.replicas = [Replica(url) for url in urls]
+        self.ttl_s = ttl_s
+        self.unhealthy_after = unhealthy_after
+        self._affinity = {}  # key → (replica, last used)
+        self._order = itertools.count()
+        self._lock = threading.Lock()
+
+    def acquire(self, key=None, exclude=()):
+        with self._lock:
+            self._expire()
+            replica = self._pick(key, exclude)
+            if replica is None:
+                return None
+            replica.outstanding += 1
+            replica.requests += 1
+            if key is not None:
+                self._affinity[key] = (replica, time.time())
+            return replica
+
+    def release(self, replica):
+        with self._lock:
+            replica.outstanding -= 1
+
+    def bind(self, key, replica):
+        # /session/start 응답으로 session id를 알게 된 뒤 그 replica에 고정
+        with self._lock:
+            self._affinity[key] = (replica, time.time())
+
+    def bound(self, key) -> bool:
+        with self._lock:
+            self._expire()
+            return key in self._affinity
+
+    def forget(self, key):
+        with self._lock:
+            self._affinity.pop(key, None)
+
+    def _pick(self, key, exclude):
+        bound = self._affinity.get(key) if key is not None else None
+        if bound is not None:
+            replica = bound[0]
+            if key[0] == "session":
+                return replica if replica.ready else None
+            if replica.routable() and replica not in exclude:
+                return replica
+        if key is not None and key[0] == "session":
+            return None
+        candidates = [r for r in self.replicas if r.routable() and r not in exclude]
+        if not candidates:
+            return None
+        # 진행 중인 요청 수가 같으면 고정된 에피소드가 적은 replica, 그래도 같으면 돌아가면서
+        turn = next(self._order)
+        keys = self._keys_per_replica()
+        return min(candidates, key=lambda r: (r.outstanding, keys.get(r, 0), (self.replicas.index(r) - turn) % len(self.replicas)))
+
+    def _keys_per_replica(self):
+        counts = {}
+        for replica, _ in self._affinity.values():
+            counts[replica] = counts.get(replica, 0) + 1
+        return counts
+
+    def _expire(self):
+        now = time.time()
+        for key in [k for k, (_, last_used) in self._affinity.items() if now - last_used > self.ttl_s]:
+            del self._affinity[key]
+
+    def mark(self, replica, ready, state):
+        """
+        Result of a health check (ready: bool, or None if the replica did not answer).
+        A replica that stops answering is taken out after `unhealthy_after` failures.
+        """
+        with self._lock:
+            replica.last_check = time.time()
+            if ready is None:
+                replica.failures += 1
+                replica.state = state
+                if replica.failures >= self.unhealthy_after:
+                    replica.ready = False
+                return
+            replica.failures = 0
+            replica.ready = ready
+            replica.state = state
+            if not ready:
+                # 재시작된 replica에는 세션이 남아 있지 않음
+                for key in [k for k, (r, _) in self._affinity.items() if r is replica and k[0] == "session"]:
+                    del self._affinity[key]
+
+    def set_draining(self, replica, draining):
+        with self._lock:
+            replica.draining = draining
+            if draining:
+                # 에피소드 affinity는 캐시용일 뿐이므로 바로 다른 replica로 옮김 (세션은 끝날 때까지 유지)
+                for key in [k for k, (r, _) in self._affinity.items() if r is replica and k[0] == "episode"]:
+                    del self._affinity[key]
+
+    def ready(self) -> bool:
+        return any(r.routable() for r in self.replicas)
+
+    def stats(self) -> list:
+        with self._lock:
+            self._expire()
+            sessions = {}
+            for key, (replica, _) in self._affinity.items():
+                if key[0] == "session":
+                    sessions[replica] = sessions.get(replica, 0) + 1
+            return [
+                {
+                    "index": i,
+                    "url": r.url,
+                    "ready": r.ready,
+                    "state": r.state,
+                    "draining": r.draining,
+                    "drained": r.draining and r.outstanding == 0 and not sessions.get(r),
+                    "outstanding": r.outstanding,
+                    "sessions": sessions.get(r, 0),
+                    "requests": r.requests,
+                    "failures": r.failures,
+                    "last_check": r.last_check,
+                }
+                for i, r in enumerate(self.replicas)
+            ]
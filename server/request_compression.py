@@ -0,0 +1,56 @@
+import gzip
+
+from fastapi import HTTPException, Request
+from fastapi.routing import APIRoute
+
+try:
+    import zstandard  # optional: Content-Encoding: zstd
+except ImportError:
+    zstandard = None
+
+
+def decompress(body: bytes, encoding: str) -> bytes:
+    if encoding == "gzip":
+        return gzip.decompress(body)
+    if encoding == "zstd":
+        if zstandard is None:
+            raise HTTPException(status_code=415, detail="zstd request bodies need the zstandard package on the server")
+        return zstandard.ZstdDecompressor().decompressobj().decompress(body)
+    raise HTTPException(status_code=415, detail=f"Unsupported Content-Encoding {encoding!r}")
+
+
+class DecompressedRequest(Request):
+    """
+    Request whose body (JSON or multipart form) is transparently decompressed when the
+    client sent it with `Content-Encoding: gzip` or `zstd`.
+    """
+
+    @property
+    def encoding(self):
+        encoding = self.headers.get("content-encoding", "identity").strip().lower()
+        return None if encoding == "identity" else encoding
+
+    async def body(self) -> bytes:
+        if not hasattr(self, "_body"):
+            raw = b"".join([chunk async for chunk in super().stream()])
+            self._body = decompress(raw, self.encoding) if self.encoding else raw
+        return self._body
+
+    async def stream(self):
+        # multipart form 파싱은 stream()을 읽으므로 여기서도 압축 해제된 body를 돌려줌
+        if self.encoding is None:
+            async for chunk in super().stream():
+                yield chunk
+            return
+        yield await self.body()
+        yield b""
+
+
+class DecompressRoute(APIRoute):
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def decompressing_handler(request: Request):
+            return await handler(DecompressedRequest(request.scope, request.receive))
+
+        return decompressing_handler
@@ -0,0 +1,294 @@
+import argparse, asyncio, os, signal, subprocess, sys, time
+from contextlib import asynccontextmanager
+from pathlib import Path
+
+import httpx
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+
+from metrics import Registry
+from replica_pool import ReplicaPool
+
+# 여러 qwen_server replica (GPU / 서버마다 하나) 앞에 두는 load balancer: 클라이언트는 --server로 router 주소만 사용
+# QWEN_ROUTER_REPLICAS="http://gpu0:8000,http://gpu1:8000" uvicorn router:app --port 8000
+# python server/router.py --local 2 --port 8000 → stub backend replica 2개를 8001, 8002에 띄우고 router 실행 (로컬 테스트)
+#   - least outstanding requests: router를 거쳐 진행 중인 요청이 가장 적은 replica로
+#   - affinity: /session은 세션을 만든 replica로 (history가 거기 있음), X-Episode-Id 헤더가 있으면 같은 에피소드는 같은 replica로 (prefix cache)
+#   - health check: 각 replica의 /ready를 주기적으로 확인, 로딩 중 / 응답 없는 replica는 제외
+#   - drain: POST /router/replicas/{index}/drain → 새 에피소드를 보내지 않고, 진행 중인 요청 / 세션이 끝나면 drained
+REPLICAS = [url for url in os.environ.get("QWEN_ROUTER_REPLICAS", "").split(",") if url.strip()]
+HEALTH_INTERVAL_S = float(os.environ.get("QWEN_ROUTER_HEALTH_INTERVAL_S", 2))
+HEALTH_TIMEOUT_S = float(os.environ.get("QWEN_ROUTER_HEALTH_TIMEOUT_S", 2))
+# 연결 실패 / health check 실패가 이만큼 연속되면 제외
+UNHEALTHY_AFTER = int(os.environ.get("QWEN_ROUTER_UNHEALTHY_AFTER", 2))
+CONNECT_TIMEOUT_S = float(os.environ.get("QWEN_ROUTER_CONNECT_TIMEOUT_S", 5))
+READ_TIMEOUT_S = float(os.environ.get("QWEN_ROUTER_READ_TIMEOUT_S", 300))
+# qwen_server의 QWEN_SESSION_TTL_S와 같게: 이보다 오래 안 쓴 세션 / 에피소드 affinity는 잊음
+AFFINITY_TTL_S = float(os.environ.get("QWEN_ROUTER_AFFINITY_TTL_S", 1800))
+
+# 요청을 보내기 전에 실패했거나 (연결 실패) replica가 받지 않은 요청 (큐 가득 참 / 준비 안 됨) 은 다른 replica로 한 번 더
+RETRY_STATUS = (429, 503)
+HOP_HEADERS = {"host", "content-length", "connection", "keep-alive", "transfer-encoding", "te", "trailer", "upgrade", "proxy-authenticate", "proxy-authorization"}
+EPISODE_HEADER = "X-Episode-Id"
+
+pool = ReplicaPool(REPLICAS, ttl_s=AFFINITY_TTL_S, unhealthy_after=UNHEALTHY_AFTER)
+client = None
+
+registry = Registry()
+routed_requests = registry.counter("qwen_router_requests_total", "Requests answered by a replica, by replica and status code", ("replica", "status"))
+unrouted_requests = registry.counter("qwen_router_unrouted_total", "Requests the router could not place on a replica", ("reason",))
+retried_requests = registry.counter("qwen_router_retries_total", "Requests moved to another replica", ("reason",))
+router_seconds = registry.histogram("qwen_router_request_seconds", "Time until response headers, by route", ("route",))
+outstanding_gauge = registry.gauge("qwen_router_outstanding", "Requests in flight per replica", ("replica",))
+ready_gauge = registry.gauge("qwen_router_replica_ready", "1 if the replica is ready and not draining", ("replica",))
+sessions_gauge = registry.gauge("qwen_router_sessions", "Open sessions pinned to each replica", ("replica",))
+
+@registry.collector
+def collect_gauges():
+    for replica in pool.stats():
+        outstanding_gauge.set(replica["outstanding"], replica=replica["url"])
+        ready_gauge.set(1 if replica["ready"] and not replica["draining"] else 0, replica=replica["url"])
+        sessions_gauge.set(replica["sessions"], replica=replica["url"])
+
+async def check_replica(replica):
+    try:
+        r = await client.get(f"{replica.url}/ready", timeout=HEALTH_TIMEOUT_S)
+    except httpx.HTTPError:
+        pool.mark(replica, None, "unreachable")
+        return
+    try:
+        state = r.json().get("state", "unknown")
+    except ValueError:
+        state = "unknown"
+    pool.mark(replica, r.status_code == 200, state)
+
+async def health_loop():
+    while True:
+        await asyncio.sleep(HEALTH_INTERVAL_S)
+        await asyncio.gather(*(check_replica(replica) for replica in pool.replicas))
+
+@asynccontextmanager
+async def lifespan(app):
+    global client
+    if not pool.replicas:
+        raise RuntimeError("No replicas: set QWEN_ROUTER_REPLICAS or use python router.py --replicas / --local")
+    client = httpx.AsyncClient(timeout=httpx.Timeout(READ_TIMEOUT_S, connect=CONNECT_TIMEOUT_S), limits=httpx.Limits(max_connections=None, max_keepalive_connections=64))
+    await asyncio.gather(*(check_replica(replica) for replica in pool.replicas))
+    task = asyncio.create_task(health_loop())
+    yield
+    # uvicorn이 진행 중인 요청을 끝낸 뒤 여기로 옴
+    task.cancel()
+    await client.aclose()
+
+app = FastAPI(lifespan=lifespan)
+
+async def send(request: Request, key=None):
+    """
+    Forwards the request to a replica chosen by the pool → (replica, streamed httpx response).
+    The replica stays counted as outstanding until the response is closed (see `respond`).
+    """
+    body = await request.body()
+    headers = {name: value for name, value in request.headers.items() if name.lower() not in HOP_HEADERS}
+    pinned = key is not None and key[0] == "session"
+    if pinned and not pool.bound(key):
+        # router가 모르는 세션 = 없거나 만료된 세션 (replica와 같은 응답)
+        raise HTTPException(status_code=404, detail=f"Unknown session {key[1]}")
+    replica = pool.acquire(key)
+    if replica is None:
+        unrouted_requests.inc(reason="session_replica_down" if pinned else "no_ready_replica")
+        detail = "The replica holding this session is not available" if pinned else "No ready replica"
+        raise HTTPException(status_code=503, detail=detail, headers={"Retry-After": "2"})
+
+    tried = []
+    while True:
+        try:
+            r = await client.send(client.build_request(request.method, replica.url + request.url.path, params=request.query_params, content=body, headers=headers), stream=True)
+        except (httpx.ConnectError, httpx.ConnectTimeout):
+            # 요청이 replica에 닿지 않았으므로 다른 replica로 보내도 중복 실행이 아님
+            pool.release(replica)
+            pool.mark(replica, None, "unreachable")
+            r = None
+        except httpx.HTTPError as e:
+            pool.release(replica)
+            raise HTTPException(status_code=502, detail=f"Replica {replica.url} failed: {e!r}")
+
+        if r is not None and (r.status_code not in RETRY_STATUS or pinned):
+            return replica, r
+        tried.append(replica)
+        retry = None if pinned else pool.acquire(key, exclude=tried)
+        if retry is None:
+            if r is None:
+                unrouted_requests.inc(reason="unreachable")
+                raise HTTPException(status_code=502 if not pinned else 503, detail=f"Replica {replica.url} is unreachable", headers={"Retry-After": "2"})
+            return replica, r
+        if r is not None:
+            await r.aclose()
+            pool.release(replica)
+        retried_requests.inc(reason="unreachable" if r is None else str(r.status_code))
+        replica = retry
+
+def response_headers(r, replica):
+    headers = {name: value for name, value in r.headers.items() if name.lower() not in HOP_HEADERS}
+    headers["X-Qwen-Replica"] = replica.url
+    return headers
+
+def respond(replica, r):
+    # NDJSON 스트리밍 응답도 그대로 전달, 다 보낸 뒤에 outstanding 감소
+    routed_requests.inc(replica=replica.url, status=r.status_code)
+
+    async def body():
+        try:
+            async for chunk in r.aiter_raw():
+                yield chunk
+        finally:
+            await r.aclose()
+            pool.release(replica)
+
+    return StreamingResponse(body(), status_code=r.status_code, headers=response_headers(r, replica))
+
+async def read(replica, r):
+    routed_requests.inc(replica=replica.url, status=r.status_code)
+    try:
+        content = await r.aread()
+    finally:
+        await r.aclose()
+        pool.release(replica)
+    return Response(content, status_code=r.status_code, headers=response_headers(r, replica))
+
+@app.middleware("http")
+async def timing(request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    route = getattr(request.scope.get("route"), "path", "unmatched")
+    router_seconds.observe(time.perf_counter() - start, route=route)
+    return response
+
+def episode_key(request: Request):
+    episode_id = request.headers.get(EPISODE_HEADER)
+    return ("episode", episode_id) if episode_id else None
+
+@app.post("/predict")
+async def predict(request: Request):
+    return respond(*await send(request, episode_key(request)))
+
+@app.post("/predict_binary")
+async def predict_binary(request: Request):
+    return respond(*await send(request, episode_key(request)))
+
+@app.post("/session/start")
+async def session_start(request: Request):
+    replica, r = await send(request, episode_key(request))
+    response = await read(replica, r)
+    if r.status_code == 200:
+        pool.bind(("session", r.json()["session_id"]), replica)
+    return response
+
+@app.post("/session/{session_id}/step")
+async def session_step(session_id: str, request: Request):
+    return respond(*await send(request, ("session", session_id)))
+
+@app.post("/session/{session_id}/record")
+async def session_record(session_id: str, request: Request):
+    return await read(*await send(request, ("session", session_id)))
+
+@app.post("/session/{session_id}/end")
+async def session_end(session_id: str, request: Request):
+    response = await read(*await send(request, ("session", session_id)))
+    pool.forget(("session", session_id))
+    return response
+
+@app.get("/health")
+def health():
+    return {"status": "ok", "replicas": len(pool.replicas)}
+
+@app.get("/ready")
+def ready():
+    # replica가 하나라도 받을 수 있으면 200 (클라이언트 wait_until_ready용)
+    body = {"state": "ready" if pool.ready() else "loading", "replicas": pool.stats()}
+    if not pool.ready():
+        return JSONResponse(body, status_code=503)
+    return body
+
+@app.get("/metrics")
+def metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/router/replicas")
+def replicas():
+    return pool.stats()
+
+def get_replica(index: int):
+    if not 0 <= index < len(pool.replicas):
+        raise HTTPException(status_code=404, detail=f"Unknown replica {index}")
+    return pool.replicas[index]
+
+@app.post("/router/replicas/{index}/drain")
+def drain(index: int):
+    # 새 에피소드 / 세션은 다른 replica로, 이미 열린 세션은 끝날 때까지 유지 → "drained": true가 되면 내려도 됨
+    pool.set_draining(get_replica(index), True)
+    return pool.stats()[index]
+
+@app.post("/router/replicas/{index}/undrain")
+def undrain(index: int):
+    pool.set_draining(get_replica(index), False)
+    return pool.stats()[index]
+
+@app.get("/{path:path}")
+async def passthrough(request: Request):
+    # /config, /batch_stats 등 나머지 GET은 준비된 replica 아무 곳으로 (replica들은 같은 모델 / 설정이라고 가정)
+    return await read(*await send(request))
+
+def start_local_replicas(count, port, gpus):
+    """
+    Starts `count` qwen_server replicas on 127.0.0.1:port+1.. (QWEN_BACKEND defaults to
+    stub), each pinned to one of `gpus` if given → (urls, processes).
+    """
+    urls, processes = [], []
+    for i in range(count):
+        replica_port = port + 1 + i
+        env = dict(os.environ)
+        env.setdefault("QWEN_BACKEND", "stub")
+        if gpus:
+            env["CUDA_VISIBLE_DEVICES"] = gpus[i % len(gpus)]
+        processes.append(subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "qwen_server:app", "--host", "127.0.0.1", "--port", str(replica_port)],
+            cwd=Path(__file__).parent, env=env,
+        ))
+        urls.append(f"http://127.0.0.1:{replica_port}")
+    return urls, processes
+
+def main():
+    parser = argparse.ArgumentParser(description="Load balancer in front of qwen_server replicas")
+    parser.add_argument("--replicas", nargs="*", default=None, help="Replica base URLs (default: QWEN_ROUTER_REPLICAS)")
+    parser.add_argument("--local", type=int, default=0, help="Start this many qwen_server replicas on this machine (QWEN_BACKEND defaults to stub)")
+    parser.add_argument("--gpus", nargs="*", default=[], help="With --local: CUDA_VISIBLE_DEVICES for each replica, round robin (e.g. --gpus 0 1)")
+    parser.add_argument("--host", type=str, default="0.0.0.0", help="Router host")
+    parser.add_argument("--port", type=int, default=8000, help="Router port (local replicas use the following ports)")
+    args = parser.parse_args()
+
+    import uvicorn
+
+    processes = []
+    urls = args.replicas or []
+    if args.local:
+        local_urls, processes = start_local_replicas(args.local, args.port, args.gpus)
+        urls = urls + local_urls
+    if urls:
+        os.environ["QWEN_ROUTER_REPLICAS"] = ",".join(urls)
+    # uvicorn은 종료 후 SIGTERM을 다시 보내므로, 기본 handler면 finally 없이 종료되어 로컬 replica가 남음
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        uvicorn.run("router:app", host=args.host, port=args.port)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            # 모델 로딩 중에는 SIGTERM으로 끝나지 않을 수 있음
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+if __name__ == "__main__":
+    main()
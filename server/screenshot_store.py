@@ -0,0 +1,58 @@
+import io, os, queue, re, threading
+from PIL import Image
+
+
+def decode_screenshot(image_bytes: bytes) -> Image.Image:
+    """
+    업로드된 이미지 바이트를 디스크를 거치지 않고 바로 PIL 이미지로 디코딩
+    """
+    screenshot = Image.open(io.BytesIO(image_bytes))
+    # lazy loading을 막고 요청 스레드에서 디코딩을 끝냄 (GPU 워커에서 디코딩하지 않도록)
+    screenshot.load()
+    return screenshot
+
+
+class ScreenshotArchiver:
+    """
+    Writes uploaded screenshots to `{root}/{episode_id}/screenshot_{step}.{ext}` on a
+    background thread so archival stays off the request path. Episodes get their own
+    directory, so concurrent episodes at the same step no longer overwrite each other.
+    """
+
+    def __init__(self, root="./qwen_data", max_pending=256):
+        self.root = root
+        self._queue = queue.Queue(maxsize=max_pending)
+        self.num_written = 0
+        self.num_dropped = 0
+        self._worker = threading.Thread(target=self._loop, name="screenshot-archiver", daemon=True)
+        self._worker.start()
+
+    def path_for(self, episode_id: str, step: int, ext: str = "png") -> str:
+        # episode_id는 클라이언트 입력: 디렉터리 이름으로 안전한 문자만 남기고 root 밖을 가리키는 . / ..은 거부
+        episode_dir = re.sub(r"[^\w.-]", "_", episode_id) or "default"
+        if episode_dir in (".", ".."):
+            raise ValueError(f"Invalid episode_id {episode_id!r}")
+        return os.path.join(self.root, episode_dir, f"screenshot_{step}.{ext}")
+
+    def submit(self, episode_id: str, step: int, image_bytes: bytes, ext: str = "png"):
+        try:
+            self._queue.put_nowait((self.path_for(episode_id, step, ext), image_bytes))
+        except queue.Full:
+            # 디스크가 밀리면 요청을 막지 않고 아카이브만 건너뜀
+            self.num_dropped += 1
+
+    def flush(self):
+        self._queue.join()
+
+    def _loop(self):
+        while True:
+            path, image_bytes = self._queue.get()
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, "wb") as f:
+                    f.write(image_bytes)
+                self.num_written += 1
+            except OSError as e:
+                print(f"Failed to archive screenshot {path}: {e}")
+            finally:
+                self._queue.task_done()
@@ -0,0 +1,97 @@
+import threading, time, uuid
+
+
+class Session:
+    """
+    Server-side state of one episode: the task and the action history that used to be
+    resent by the client as `previous_steps` on every step.
+    """
+
+    def __init__(self, task, app_name, role="baseline", episode_id="", profile=""):
+        self.session_id = uuid.uuid4().hex
+        self.task = task
+        self.app_name = app_name
+        self.role = role
+        self.profile = profile
+        self.episode_id = episode_id or self.session_id
+        self.history = []
+        self.last_used = time.time()
+        self.lock = threading.Lock()
+        self.in_flight = False
+
+    @property
+    def step(self) -> int:
+        return len(self.history)
+
+    def previous_steps(self) -> str:
+        # client.py의 previous_steps와 같은 포맷: "\nStep 1: {...}; \nStep 2: {...}; "
+        return "".join(f"\nStep {i + 1}: {response}; " for i, response in enumerate(self.history))
+
+    def begin(self) -> bool:
+        # step은 한 번에 하나만: 동시에 들어온 step은 같은 history 길이를 보고 같은 칸에 기록되므로 거부
+        with self.lock:
+            if self.in_flight:
+                return False
+            self.in_flight = True
+            return True
+
+    def finish(self):
+        with self.lock:
+            self.in_flight = False
+
+    def record(self, step: int, response: dict):
+        with self.lock:
+            entry = {"name": response["name"], "arguments": response["arguments"]}
+            if step < len(self.history):
+                self.history[step] = entry
+            else:
+                self.history.append(entry)
+            self.last_used = time.time()
+
+
+class SessionStore:
+    """
+    Thread-safe session registry. Sessions idle for more than `ttl_s` are dropped;
+    `on_close(session)` runs for ended and expired sessions (e.g. to free cached KV).
+    """
+
+    def __init__(self, ttl_s=1800, on_close=None):
+        self.ttl_s = ttl_s
+        self.on_close = on_close
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def start(self, task, app_name, role="baseline", episode_id="", profile="") -> Session:
+        self._expire()
+        session = Session(task, app_name, role, episode_id, profile)
+        with self._lock:
+            self._sessions[session.session_id] = session
+        return session
+
+    def get(self, session_id):
+        with self._lock:
+            session = self._sessions.get(session_id)
+        if session is not None:
+            session.last_used = time.time()
+        return session
+
+    def end(self, session_id):
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+        if session is not None and self.on_close is not None:
+            self.on_close(session)
+        return session
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
+
+    def _expire(self):
+        now = time.time()
+        with self._lock:
+            expired = [s for s in self._sessions.values() if now - s.last_used > self.ttl_s]
+            for session in expired:
+                del self._sessions[session.session_id]
+        for session in expired:
+            if self.on_close is not None:
+                self.on_close(session)
@@ -0,0 +1,128 @@
+import argparse, json, math, os, statistics, time
+from pathlib import Path
+
+from PIL import Image
+
+from bench_models import REPO_ROOT, actions_agree, load_samples, recorded_arguments, recorded_history
+
+# 이미지 토큰 budget (profile / max_pixels / crop) 별 정확도 vs latency sweep (모델은 한 번만 로드)
+# QWEN_BACKEND=hf python server/sweep_token_budget.py [--profiles full balanced fast] [--max_pixels 200704 602112] [--limit 40]
+#   입력: dataset/AITA의 녹화된 스크린샷, history는 클라이언트처럼 녹화된 action (설정마다 모델이 보는 좌표계)
+#   accuracy: 응답 action (디바이스 픽셀로 변환된 좌표) 이 녹화된 action과 같은 비율 (좌표는 화면 대각선의 --tolerance 이내)
+#   agreement: 첫 번째 설정 (보통 full) 과 같은 action을 낸 비율
+#   image_tokens: 모델 해상도 / (28x28), prompt_tokens: 이미지 포함 전체 입력 토큰 (hf backend), latency: 전처리 + generate
+
+
+def matches_recorded(arguments, recorded, device_size, tolerance):
+    expected = recorded_arguments(recorded, device_size)
+    if arguments is None or arguments.get("action") != expected["action"]:
+        return False
+    if "coordinate" in expected:
+        coordinate = arguments.get("coordinate")
+        if not coordinate or math.dist(coordinate[:2], expected["coordinate"]) > tolerance * math.hypot(*device_size):
+            return False
+    if expected["action"] == "type":
+        return str(arguments.get("text", "")).strip().lower() == str(expected["text"]).strip().lower()
+    return True
+
+
+def run_setting(server, samples, setting, tolerance):
+    factor = server.processor.image_processor.patch_size * server.processor.image_processor.merge_size
+    results = []
+    for sample in samples:
+        image_bytes = Path(sample["image_path"]).read_bytes()
+        with Image.open(sample["image_path"]) as image:
+            device_size = image.size
+        info = server.StepInfo(
+            task=sample["instruction"],
+            step=len(sample["history"]),
+            role="sweep",
+            previous_steps="",
+            app_name="",
+            episode_id="sweep",
+            **setting,
+        )
+        info.previous_steps = recorded_history(server, info, sample["history"], device_size)
+        start = time.perf_counter()
+        item = server.prepare(info, image_bytes, archive=False)
+        preprocess_ms = (time.perf_counter() - start) * 1000.0
+
+        start = time.perf_counter()
+        ids = server.backend.generate([item], server.MAX_NEW_TOKENS, on_done=lambda row, ids: None)[0]
+        generate_ms = (time.perf_counter() - start) * 1000.0
+
+        text = server.processor.tokenizer.decode(ids, skip_special_tokens=True, clean_up_tokenization_spaces=True)
+        try:
+            arguments = item["geometry"].map_response(server.parse_action(text, item["screen_size"]))["arguments"]
+        except Exception:
+            arguments = None
+        width, height = item["screen_size"]
+        input_ids = item["inputs"].get("input_ids")
+        results.append({
+            "key": sample["key"],
+            "arguments": arguments,
+            "correct": matches_recorded(arguments, sample["recorded"], device_size, tolerance),
+            "device_size": list(device_size),
+            "image_tokens": width * height // (factor * factor),
+            "prompt_tokens": int(input_ids.shape[1]) if input_ids is not None else None,
+            "preprocess_ms": preprocess_ms,
+            "generate_ms": generate_ms,
+        })
+    return results
+
+
+def summarize(results, reference, tolerance):
+    totals = sorted(r["preprocess_ms"] + r["generate_ms"] for r in results)
+    agree = [actions_agree(r["arguments"], reference[r["key"]]["arguments"], r["device_size"], tolerance) for r in results]
+    prompt_tokens = [r["prompt_tokens"] for r in results if r["prompt_tokens"] is not None]
+    return {
+        "accuracy": round(sum(r["correct"] for r in results) / len(results), 3),
+        "agreement": round(sum(agree) / len(agree), 3),
+        "parse_errors": sum(1 for r in results if r["arguments"] is None),
+        "image_tokens": round(statistics.mean(r["image_tokens"] for r in results), 1),
+        "prompt_tokens": round(statistics.mean(prompt_tokens), 1) if prompt_tokens else None,
+        "preprocess_ms": round(statistics.mean(r["preprocess_ms"] for r in results), 1),
+        "generate_ms": round(statistics.mean(r["generate_ms"] for r in results), 1),
+        "p90_ms": round(totals[int(0.9 * (len(totals) - 1))], 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Image token budget accuracy / latency sweep")
+    parser.add_argument("--profiles", nargs="*", default=None, help="Token profiles to run (default: all server profiles)")
+    parser.add_argument("--max_pixels", nargs="*", type=int, default=[], help="Extra max_pixels values, each run with and without cropping")
+    parser.add_argument("--dataset", type=str, default=str(REPO_ROOT / "dataset" / "AITA"), help="Directory with recorded AITA episodes")
+    parser.add_argument("--limit", type=int, default=40, help="Max screenshots (0 = all)")
+    parser.add_argument("--tolerance", type=float, default=0.05, help="Max coordinate distance for a match, as a fraction of the screen diagonal")
+    parser.add_argument("--output", type=str, default="sweep_token_budget.json", help="Where to write per-setting summaries")
+    args = parser.parse_args()
+
+    os.environ.setdefault("QWEN_ARCHIVE_SCREENSHOTS", "0")
+    import qwen_server as server
+
+    server.load()
+    samples = load_samples(args.dataset, args.limit)
+    print(f"{len(samples)} screenshots from {args.dataset}")
+
+    settings = {name: {"profile": name} for name in (args.profiles or server.TOKEN_PROFILES)}
+    limit = server.processor.image_processor.max_pixels
+    for max_pixels in args.max_pixels:
+        if max_pixels > limit:
+            # 서버가 processor 상한으로 자르므로 실제로 돈 값으로 기록
+            print(f"--max_pixels {max_pixels} is above the processor limit {limit}; using {limit}")
+            max_pixels = limit
+        settings[f"px{max_pixels}"] = {"profile": "full", "max_pixels": max_pixels, "crop": False}
+        settings[f"px{max_pixels}+crop"] = {"profile": "full", "max_pixels": max_pixels, "crop": True}
+
+    runs, summaries = {}, {}
+    for name, setting in settings.items():
+        runs[name] = run_setting(server, samples, setting, args.tolerance)
+        reference = {r["key"]: r for r in next(iter(runs.values()))}
+        summaries[name] = dict(setting, **summarize(runs[name], reference, args.tolerance))
+        print(f"{name:>16}: {json.dumps(summaries[name])}")
+
+    Path(args.output).write_text(json.dumps({"num_samples": len(samples), "tolerance": args.tolerance, "settings": summaries}, indent=2), encoding="utf-8")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+import json
+
+# 이미지 토큰 budget 프로필: vision token 1개 = 28x28 픽셀 (patch 14 x merge 2)
+# max_pixels None = processor 기본값 (1080x2400 스크린샷 → 약 3300 토큰), crop = 상태바 / 내비게이션 바 제거
+DEFAULT_PROFILES = {
+    "full": {"max_pixels": None, "crop": False},
+    "balanced": {"max_pixels": 1280 * 28 * 28, "crop": False},
+    "fast": {"max_pixels": 512 * 28 * 28, "crop": True},
+}
+
+
+def load_profiles(profiles_json="", app_profiles_json=""):
+    """
+    QWEN_TOKEN_PROFILES (JSON, merged over DEFAULT_PROFILES) and QWEN_APP_PROFILES
+    (JSON {app_name: profile}) → (profiles, app_profiles).
+    """
+    profiles = {name: dict(profile) for name, profile in DEFAULT_PROFILES.items()}
+    for name, profile in (json.loads(profiles_json) if profiles_json else {}).items():
+        profiles[name] = dict(profiles.get(name, {"max_pixels": None, "crop": False}), **profile)
+    app_profiles = json.loads(app_profiles_json) if app_profiles_json else {}
+    for app_name, name in app_profiles.items():
+        if name not in profiles:
+            raise ValueError(f"QWEN_APP_PROFILES maps {app_name!r} to unknown profile {name!r}")
+    return profiles, app_profiles
+
+
+def crop_box(size, status_bar=0.03, nav_bar=0.05):
+    # (left, top, right, bottom): 화면 비율로 자르므로 클라이언트가 미리 줄인 이미지에도 같은 영역
+    width, height = size
+    return 0, round(height * status_bar), width, height - round(height * nav_bar)
+
+
+class ScreenGeometry:
+    """
+    Maps model coordinates back to device pixels for one request. The uploaded image may
+    have been downscaled by the client (pre_resize) and cropped by the server before
+    resizing to the model resolution, so a model (x, y) goes model → cropped image →
+    uploaded image → device.
+    """
+
+    def __init__(self, device_size, image_size, box, model_size):
+        self.device_size = tuple(device_size)
+        self.image_size = tuple(image_size)
+        self.box = tuple(box)
+        self.model_size = tuple(model_size)
+
+    def to_device(self, x, y):
+        left, top, right, bottom = self.box
+        image_x = left + x * (right - left) / self.model_size[0]
+        image_y = top + y * (bottom - top) / self.model_size[1]
+        return [
+            round(image_x * self.device_size[0] / self.image_size[0]),
+            round(image_y * self.device_size[1] / self.image_size[1]),
+        ]
+
+    def to_model(self, x, y):
+        # to_device의 역변환: 디바이스 픽셀 → 모델 좌표
+        left, top, right, bottom = self.box
+        image_x = x * self.image_size[0] / self.device_size[0]
+        image_y = y * self.image_size[1] / self.device_size[1]
+        return [
+            round((image_x - left) * self.model_size[0] / (right - left)),
+            round((image_y - top) * self.model_size[1] / (bottom - top)),
+        ]
+
+    def map_response(self, response: dict) -> dict:
+        arguments = dict(response["arguments"])
+        for key in ("coordinate", "coordinate2"):
+            coordinate = arguments.get(key)
+            if isinstance(coordinate, list) and len(coordinate) >= 2:
+                arguments[key] = self.to_device(coordinate[0], coordinate[1]) + coordinate[2:]
+        # 좌표가 이미 디바이스 픽셀이므로 클라이언트의 scale_coordinates는 그대로 통과
+        # model_arguments: 모델이 본 좌표 그대로 → 클라이언트가 다음 step의 history (previous_steps) 로 사용
+        return dict(response, arguments=arguments, model_arguments=response["arguments"], screen_size=list(self.device_size))
@@ -0,0 +1,357 @@
+import ast, json, re
+
+# match() 결과: 바이트열이 tool call 영역 (<tool_call> 뒤 → </tool_call> 앞) 의 prefix로 가능한지
+INVALID, PARTIAL, COMPLETE = 0, 1, 2
+
+WHITESPACE = b" "
+MAX_NUMBER_DIGITS = 6
+
+
+class MalformedToolCall(ValueError):
+    """
+    Model output that even the tolerant parser could not turn into a valid call.
+    `kind` is the /metrics label: missing (no JSON object), invalid_json, invalid_arguments.
+    """
+
+    def __init__(self, kind, detail):
+        super().__init__(f"{kind}: {detail}")
+        self.kind = kind
+
+
+class _Incomplete(Exception):
+    pass
+
+
+class _Invalid(Exception):
+    pass
+
+
+class _Matcher:
+    # 바이트 단위 recursive descent: 입력 끝에 도달하면 _Incomplete (= 아직 유효한 prefix), 어긋나면 _Invalid
+    def __init__(self, data: bytes):
+        self.data = data
+        self.pos = 0
+
+    def peek(self) -> int:
+        if self.pos >= len(self.data):
+            raise _Incomplete()
+        return self.data[self.pos]
+
+    def expect(self, literal: bytes):
+        for byte in literal:
+            if self.peek() != byte:
+                raise _Invalid()
+            self.pos += 1
+
+    def ws(self):
+        # 공백은 한 칸까지만 허용 (공백 반복으로 토큰을 낭비하지 않도록)
+        if self.pos < len(self.data) and self.data[self.pos] in WHITESPACE:
+            self.pos += 1
+
+    def value(self, schema):
+        kind = schema.get("type")
+        if kind == "object":
+            return self.object(schema)
+        if kind == "array":
+            return self.array(schema)
+        if kind == "string":
+            return self.string(schema.get("enum"))
+        if kind in ("number", "integer"):
+            return self.number(kind == "integer")
+        # 타입이 없는 값 (items 미지정 배열 등): 문자열 또는 숫자
+        return self.string(None) if self.peek() == ord('"') else self.number(False)
+
+    def string(self, enum):
+        self.expect(b'"')
+        start = self.pos
+        while True:
+            byte = self.peek()
+            if byte == ord('"'):
+                text = self.data[start:self.pos].decode("utf-8", errors="replace")
+                if enum is not None and text not in enum:
+                    raise _Invalid()
+                self.pos += 1
+                return text
+            if enum is not None:
+                # enum 값에는 escape가 없으므로 지금까지의 내용이 어떤 값의 prefix인지만 확인
+                prefix = self.data[start:self.pos + 1].decode("utf-8", errors="replace")
+                if not any(value.startswith(prefix) for value in enum):
+                    raise _Invalid()
+                self.pos += 1
+            elif byte == ord("\\"):
+                self.pos += 1
+                escape = self.peek()
+                if escape not in b'"\\/bfnrtu':
+                    raise _Invalid()
+                self.pos += 1
+                if escape == ord("u"):
+                    for _ in range(4):
+                        if self.peek() not in b"0123456789abcdefABCDEF":
+                            raise _Invalid()
+                        self.pos += 1
+            elif byte < 0x20:
+                raise _Invalid()
+            else:
+                self.pos += 1
+
+    def digits(self, limit):
+        count = 0
+        while self.pos < len(self.data) and self.data[self.pos] in b"0123456789":
+            count += 1
+            if count > limit:
+                raise _Invalid()
+            self.pos += 1
+        if self.pos >= len(self.data):
+            raise _Incomplete()
+        return count
+
+    def number(self, integer):
+        start = self.pos
+        if self.peek() == ord("-"):
+            self.pos += 1
+        if self.peek() not in b"0123456789":
+            raise _Invalid()
+        if self.peek() == ord("0"):
+            self.pos += 1
+            self.peek()
+        else:
+            self.digits(MAX_NUMBER_DIGITS)
+        if not integer and self.peek() == ord("."):
+            self.pos += 1
+            if self.digits(MAX_NUMBER_DIGITS) == 0:
+                raise _Invalid()
+        return float(self.data[start:self.pos])
+
+    def array(self, schema):
+        items = schema.get("items", {})
+        min_items, max_items = schema.get("minItems", 0), schema.get("maxItems")
+        values = []
+        self.expect(b"[")
+        self.ws()
+        if self.peek() == ord("]"):
+            if min_items:
+                raise _Invalid()
+            self.pos += 1
+            return values
+        while True:
+            values.append(self.value(items))
+            self.ws()
+            byte = self.peek()
+            if byte == ord(",") and (max_items is None or len(values) < max_items):
+                self.pos += 1
+                self.ws()
+            elif byte == ord("]") and len(values) >= min_items:
+                self.pos += 1
+                return values
+            else:
+                raise _Invalid()
+
+    def object(self, schema):
+        properties = schema.get("properties", {})
+        required = set(schema.get("required", ()))
+        # action_arguments: action 값이 정해지면 허용 / 필수 인자가 그 action의 인자로 좁혀짐
+        action_arguments = schema.get("action_arguments")
+        allowed = set(properties)
+        seen = {}
+        self.expect(b"{")
+        self.ws()
+        if self.peek() == ord("}"):
+            if required:
+                raise _Invalid()
+            self.pos += 1
+            return seen
+        while True:
+            # action이 첫 번째 키여야 함: 다른 인자가 먼저 나오면 어떤 action도 받을 수 없는 조합이 될 수 있음
+            key = self.string(["action"] if action_arguments is not None and not seen else sorted(allowed - set(seen)))
+            self.ws()
+            self.expect(b":")
+            self.ws()
+            if key == "action" and action_arguments is not None:
+                seen[key] = self.string(properties[key]["enum"])
+                allowed = {"action", *action_arguments.get(seen[key], ())}
+                required = required | allowed
+            else:
+                seen[key] = self.value(properties[key])
+            self.ws()
+            byte = self.peek()
+            if byte == ord(",") and allowed - set(seen):
+                self.pos += 1
+                self.ws()
+            elif byte == ord("}") and required <= set(seen):
+                self.pos += 1
+                return seen
+            else:
+                raise _Invalid()
+
+
+def _balanced(text: str) -> str:
+    """
+    The first JSON-ish object in `text` (from its first "{"), cut at the matching brace.
+    A truncated object gets its open string / brackets closed and trailing commas removed.
+    """
+    start = text.find("{")
+    if start < 0:
+        return ""
+    stack, quote, escape = [], None, False
+    for i in range(start, len(text)):
+        char = text[i]
+        if quote is not None:
+            if escape:
+                escape = False
+            elif char == "\\":
+                escape = True
+            elif char == quote:
+                quote = None
+        elif char in "\"'":
+            quote = char
+        elif char in "{[":
+            stack.append("}" if char == "{" else "]")
+        elif char in "}]":
+            if not stack or stack.pop() != char:
+                return text[start:i]
+            if not stack:
+                return text[start:i + 1]
+    body = text[start:].rstrip()
+    if quote is not None:
+        body += quote
+    body = re.sub(r"[\s,:]+$", "", body)
+    return body + "".join(reversed(stack))
+
+
+def _loads(text: str):
+    # JSON → 쉼표 정리한 JSON → Python literal (작은따옴표, True / None) 순서로 시도
+    for candidate in (text, re.sub(r",\s*([}\]])", r"\1", text)):
+        try:
+            return json.loads(candidate)
+        except json.JSONDecodeError:
+            pass
+    try:
+        return ast.literal_eval(text)
+    except (ValueError, SyntaxError, MemoryError, RecursionError):
+        return None
+
+
+class ToolCallGrammar:
+    """
+    Decoding grammar and parser for one tool's `<tool_call>` block, derived from the tool's
+    `parameters` JSON schema (plus the optional `argument_constraints` / `action_arguments`
+    class attributes, which narrow the schema for decoding without changing the prompt).
+
+    `match(data)` tells whether the bytes after `<tool_call>` are a valid prefix of
+    `\\n{"name": ..., "arguments": {...}}\\n` (used by the constrained-decoding logits
+    processor). `parse(output_text)` returns (call, status): the strict format first,
+    then a tolerant fallback for format drift (missing tags, single quotes, trailing commas,
+    truncation, stringified arguments); raises MalformedToolCall if nothing valid is left.
+    """
+
+    def __init__(self, tool_cls):
+        self.name = tool_cls.name
+        parameters = dict(tool_cls.parameters)
+        properties = {name: dict(spec) for name, spec in parameters["properties"].items()}
+        for name, constraint in getattr(tool_cls, "argument_constraints", {}).items():
+            properties[name].update(constraint)
+        parameters["properties"] = properties
+        self.action_arguments = getattr(tool_cls, "action_arguments", None)
+        if self.action_arguments is not None:
+            parameters["action_arguments"] = self.action_arguments
+        self.parameters = parameters
+        self.schema = {
+            "type": "object",
+            "properties": {"name": {"type": "string", "enum": [self.name]}, "arguments": parameters},
+            "required": ["name", "arguments"],
+        }
+
+    def match(self, data: bytes) -> int:
+        matcher = _Matcher(data)
+        try:
+            matcher.expect(b"\n")
+            matcher.value(self.schema)
+            matcher.expect(b"\n")
+        except _Incomplete:
+            return PARTIAL
+        except _Invalid:
+            return INVALID
+        return COMPLETE if matcher.pos == len(data) else INVALID
+
+    def parse(self, output_text: str):
+        try:
+            call = json.loads(output_text.split("<tool_call>\n")[1].split("\n</tool_call>")[0])
+            arguments, status = self.validate(call["arguments"])
+            return {"name": call["name"], "arguments": arguments}, status
+        except (IndexError, KeyError, TypeError, json.JSONDecodeError, MalformedToolCall):
+            pass
+
+        # tolerant fallback: <tool_call> 뒤 (없으면 전체 출력) 의 첫 번째 객체
+        _, tag, rest = output_text.partition("<tool_call>")
+        body = (rest if tag else output_text).split("</tool_call>")[0]
+        text = _balanced(body)
+        if not text:
+            raise MalformedToolCall("missing", "no JSON object in the output")
+        call = _loads(text)
+        if not isinstance(call, dict):
+            raise MalformedToolCall("invalid_json", text[:200])
+        arguments = call.get("arguments", call if "action" in call else None)
+        if isinstance(arguments, str):
+            arguments = _loads(arguments)
+        arguments, _ = self.validate(arguments)
+        return {"name": call.get("name", self.name), "arguments": arguments}, "repaired"
+
+    def validate(self, arguments):
+        """
+        Checks arguments against the schema, coercing near misses (numbers as strings,
+        "[x, y]" strings, enum case, floats for integers) and dropping arguments the action
+        does not take. Returns (arguments, status): "ok" or "repaired" (something was coerced
+        or dropped). An action missing one of its arguments (e.g. click without coordinate,
+        or with a null one) raises MalformedToolCall: the client cannot execute it.
+        """
+        if not isinstance(arguments, dict):
+            raise MalformedToolCall("invalid_arguments", f"arguments is not an object: {arguments!r}"[:200])
+        properties = self.parameters["properties"]
+        if arguments.get("action") is None:
+            raise MalformedToolCall("invalid_arguments", "missing action")
+        action = self._coerce("action", properties["action"], arguments["action"])
+        if self.action_arguments is not None and action in self.action_arguments:
+            expected = {"action", *self.action_arguments[action]}
+        else:
+            expected = set(self.parameters.get("required", ()))
+
+        result, changed = {}, False
+        for name, value in arguments.items():
+            # null은 값이 없는 것으로 취급 (str(None) == "None"을 입력하지 않도록): 필수 인자면 아래에서 missing으로 거부
+            if value is None or name not in properties or (self.action_arguments is not None and name not in expected):
+                changed = True
+                continue
+            coerced = self._coerce(name, properties[name], value)
+            changed = changed or coerced != value or type(coerced) is not type(value)
+            result[name] = coerced
+        missing = expected - set(result)
+        if missing:
+            raise MalformedToolCall("invalid_arguments", f"action={action!r} is missing {sorted(missing)}")
+        return result, "repaired" if changed else "ok"
+
+    def _coerce(self, name, spec, value):
+        kind = spec.get("type")
+        if "enum" in spec:
+            for option in spec["enum"]:
+                if str(value).strip().lower() == option.lower():
+                    return option
+            raise MalformedToolCall("invalid_arguments", f"{name}={value!r} not in {spec['enum']}")
+        if kind == "string":
+            return value if isinstance(value, str) else str(value)
+        if kind in ("number", "integer"):
+            try:
+                number = float(value)
+            except (TypeError, ValueError):
+                raise MalformedToolCall("invalid_arguments", f"{name}={value!r} is not a number")
+            return round(number) if kind == "integer" or number.is_integer() else number
+        if kind == "array":
+            if isinstance(value, str):
+                value = [float(x) for x in re.findall(r"-?\d+(?:\.\d+)?", value)]
+            if not isinstance(value, (list, tuple)):
+                raise MalformedToolCall("invalid_arguments", f"{name}={value!r} is not an array")
+            items = spec.get("items")
+            value = [self._coerce(name, items, x) for x in value] if items else list(value)
+            if len(value) < spec.get("minItems", 0):
+                raise MalformedToolCall("invalid_arguments", f"{name}={value!r} needs {spec['minItems']} items")
+            return value[:spec["maxItems"]] if "maxItems" in spec else value
+        return value
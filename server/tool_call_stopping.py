@@ -0,0 +1,181 @@
+import json
+
+import torch
+from transformers import LogitsProcessor, StoppingCriteria
+
+from tool_call_grammar import COMPLETE, INVALID
+
+
+class ToolCallStoppingCriteria(StoppingCriteria):
+    """
+    Stops each sequence of a (batched) generate call as soon as it emits `</tool_call>`.
+
+    `on_done(row, generated_ids)` is called once per row the moment its tool call is
+    closed, so that row can be parsed and answered while the rest of the batch keeps
+    decoding. `on_step(row, generated_ids)` is called every step for rows still running
+    (used for streaming partial output).
+    """
+
+    def __init__(self, tokenizer, prompt_length, on_done=None, on_step=None, stop_text="</tool_call>"):
+        self.stop_ids = tokenizer.encode(stop_text, add_special_tokens=False)
+        self.prompt_length = prompt_length
+        self.on_done = on_done
+        self.on_step = on_step
+        self.done = None
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        if self.done is None:
+            self.done = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+
+        n = len(self.stop_ids)
+        if input_ids.shape[1] - self.prompt_length >= n:
+            stop = torch.tensor(self.stop_ids, dtype=input_ids.dtype, device=input_ids.device)
+            hit = (input_ids[:, -n:] == stop).all(dim=1) & ~self.done
+            for row in hit.nonzero().flatten().tolist():
+                self.done[row] = True
+                if self.on_done is not None:
+                    self.on_done(row, input_ids[row, self.prompt_length:])
+
+        if self.on_step is not None:
+            for row in (~self.done).nonzero().flatten().tolist():
+                self.on_step(row, input_ids[row, self.prompt_length:])
+
+        return self.done.clone()
+
+
+def _byte_decoder():
+    # byte-level BPE 토큰 문자열 (Ġ 등) → 원래 바이트 (GPT-2 bytes_to_unicode의 역변환)
+    printable = list(range(ord("!"), ord("~") + 1)) + list(range(ord("¡"), ord("¬") + 1)) + list(range(ord("®"), ord("ÿ") + 1))
+    chars, n = printable[:], 0
+    for b in range(256):
+        if b not in printable:
+            printable.append(b)
+            chars.append(256 + n)
+            n += 1
+    return {chr(c): b for b, c in zip(printable, chars)}
+
+
+class ToolCallConstraint:
+    """
+    Grammar-constrained decoding of the `<tool_call>` block, per sequence.
+
+    The thought before `<tool_call>` is free text, except that EOS, `</tool_call>` or running
+    past `max_thought_tokens` is replaced by `<tool_call>`. After it, only tokens that keep
+    the output a valid prefix of `grammar` (ToolCallGrammar) are allowed, and `</tool_call>`
+    only once the call is complete. Among the `candidates` highest-scoring tokens the best
+    valid one is kept (decoding is greedy); if none is valid the best single-byte token that
+    the grammar accepts is used, so every sequence closes with a schema-valid call.
+
+    `apply(generated_ids, scores)` works on one row (1D scores) and is shared by the hf
+    logits processor and vLLM's per-request logits_processors.
+    """
+
+    def __init__(self, tokenizer, grammar, max_thought_tokens, eos_token_ids=(), candidates=8):
+        self.tokenizer = tokenizer
+        self.grammar = grammar
+        self.max_thought_tokens = max_thought_tokens
+        self.candidates = candidates
+        self.open_id = tokenizer.convert_tokens_to_ids("<tool_call>")
+        self.close_id = tokenizer.convert_tokens_to_ids("</tool_call>")
+        self.eos_token_ids = set(eos_token_ids)
+        if tokenizer.eos_token_id is not None:
+            self.eos_token_ids.add(tokenizer.eos_token_id)
+        # 특수 토큰 (<|im_end|>, <|vision_start|> 등) 은 tool call 안에 들어갈 수 없음
+        special_ids = set(getattr(tokenizer, "all_special_ids", None) or ()) | set(getattr(tokenizer, "added_tokens_decoder", None) or ())
+        self.special_ids = (special_ids | self.eos_token_ids | {self.open_id}) - {self.close_id}
+        self._byte_decoder = _byte_decoder()
+        self._byte_tokens = {}
+        for char, byte in self._byte_decoder.items():
+            token_id = tokenizer.convert_tokens_to_ids(char)
+            if token_id is not None and token_id != tokenizer.unk_token_id:
+                self._byte_tokens[byte] = token_id
+        self._token_bytes = {}
+
+    def token_bytes(self, token_id) -> bytes:
+        data = self._token_bytes.get(token_id)
+        if data is None:
+            token = self.tokenizer.convert_ids_to_tokens(token_id)
+            try:
+                data = bytes(self._byte_decoder[char] for char in token)
+            except (KeyError, TypeError):
+                data = self.tokenizer.decode([token_id]).encode("utf-8")
+            self._token_bytes[token_id] = data
+        return data
+
+    def allowed(self, token_id, region, state) -> bool:
+        if token_id == self.close_id:
+            return state == COMPLETE
+        if token_id in self.special_ids:
+            return False
+        return self.grammar.match(region + self.token_bytes(token_id)) != INVALID
+
+    def choose(self, generated_ids, scores):
+        """
+        Token to force for this row, or None to leave the scores untouched.
+        """
+        if self.close_id in generated_ids:
+            return None
+        if self.open_id not in generated_ids:
+            if len(generated_ids) >= self.max_thought_tokens or int(scores.argmax()) in self.eos_token_ids | {self.close_id}:
+                return self.open_id
+            return None
+
+        start = len(generated_ids) - generated_ids[::-1].index(self.open_id)
+        region = b"".join(self.token_bytes(token_id) for token_id in generated_ids[start:])
+        state = self.grammar.match(region)
+        if state == INVALID:
+            # 이미 생성된 토큰은 되돌릴 수 없으므로 제약을 풀고 parse_action의 tolerant fallback에 맡김
+            return None
+        for token_id in torch.topk(scores, min(self.candidates, scores.shape[-1])).indices.tolist():
+            if self.allowed(token_id, region, state):
+                return token_id
+        if state == COMPLETE:
+            return self.close_id
+        valid = [token_id for byte, token_id in self._byte_tokens.items() if self.grammar.match(region + bytes([byte])) != INVALID]
+        return valid[int(scores[valid].argmax())] if valid else None
+
+    def apply(self, generated_ids, scores):
+        token_id = self.choose(list(generated_ids), scores)
+        if token_id is None:
+            return scores
+        forced = torch.full_like(scores, float("-inf"))
+        forced[token_id] = 0.0
+        return forced
+
+
+class ToolCallLogitsProcessor(LogitsProcessor):
+    """
+    hf generate / PrefixCache.generate wrapper around ToolCallConstraint for a batch
+    whose generated tokens start at `prompt_length`.
+    """
+
+    def __init__(self, constraint, prompt_length):
+        self.constraint = constraint
+        self.prompt_length = prompt_length
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        generated = input_ids[:, self.prompt_length:].tolist()
+        for row in range(scores.shape[0]):
+            scores[row] = self.constraint.apply(generated[row], scores[row])
+        return scores
+
+
+def tool_call_token_budget(tokenizer, tool_cls, max_text_tokens=64) -> int:
+    """
+    Upper bound on the tokens of one `<tool_call>...</tool_call>` block for `tool_cls`,
+    built from its parameter schema (longest enum values, 4-digit coordinates) plus
+    `max_text_tokens` for free-text arguments such as `type`.
+    """
+    worst_case = {}
+    for name, spec in tool_cls.parameters["properties"].items():
+        if "enum" in spec:
+            worst_case[name] = max(spec["enum"], key=len)
+        elif spec.get("type") == "array":
+            worst_case[name] = [9999, 9999]
+        elif spec.get("type") == "number":
+            worst_case[name] = 9999
+        else:
+            worst_case[name] = ""
+
+    call = json.dumps({"name": tool_cls.name, "arguments": worst_case}, ensure_ascii=False)
+    return len(tokenizer.encode(f"<tool_call>\n{call}\n</tool_call>", add_special_tokens=False)) + max_text_tokens